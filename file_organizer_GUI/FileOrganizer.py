@@ -5,23 +5,47 @@ FileOrganizer.py: Provides main function to move, order and rename files.
 __author__ = "Carlos Montes"
 
 import os
-from stat import ST_CTIME
-from time import localtime
-from shutil import copyfile as shutil_copyfile
-from FileOrganizer_utils import sort_list, start_logging
+import errno
+from time import perf_counter
+from functools import partial
+from itertools import chain
+from FileOrganizer_utils import start_logging
+from FileOrganizer_copy import copy_file, copy_in_parallel, move_across
+from FileOrganizer_copy import verify_copy, rename_new
+from FileOrganizer_plan import iter_plan, COPY, MOVE, LINK, SKIP
+from FileOrganizer_plan import EXISTS
+from FileOrganizer_dedup import DedupIndex, deduplicate, record_copies
+from FileOrganizer_journal import Journal, FINISHED, ROLLED_BACK
+from FileOrganizer_journal import STOPPED, ABORTED
+from FileOrganizer_metrics import timed_iter, timed_call, PLAN, TRANSFER, LOG
 from logging import info as log_info
 from logging import error as log_error
 
+# Words of the log for each action
+PAST_TENSES = {MOVE: "moved", COPY: "copied", LINK: "hardlinked"}
+REPLACED = ", replacing the existing file"
+
 def move_files(origin, files, destination, id_order, custom_preorder,
                numbering, removing, lowercase=False, duplicate=False,
-               replace_files=False):
+               replace_files=False, progress=None, cancelled=None,
+               workers=1, entries=None, journal=None, dedup=None,
+               substitutions=(), template=None, recursive=False,
+               include=(), exclude=(), flatten=False, verify=False,
+               collisions=None, metrics=None, rename=None, preorder=None,
+               processes=1, remote=False):
     """
-    Moves or duplicates files from one directory to another.
+    Moves or duplicates files from one directory to another: computes the
+    plan of the job, then executes it. The plan is streamed from the scan to
+    the execution (through the journal, if there's one), so memory doesn't
+    grow with the size of the job.
     :param origin: Directory from which the files are moved/duplicated
-    :param files: Filenames of the items to be moved
+    :param files: Filenames of the items to be moved; in recursive mode,
+    optional paths relative to origin restricting the walk (None for every
+    file of the tree)
     :param destination: Pathname to contain the specified files
     :param id_order: Pre-ordering (0: alphabetical, 1: inverse alpha,
-    2: creation order, 3: string of numbers before/after pattern)
+    2: creation order, 3: string of numbers before/after pattern,
+    4: modification order, 5: size, 6: date the photo or video was taken)
     :param custom_preorder:  Tuple of pair (Int before/after pattern,
     String pattern)
     :param numbering: Tuple of pattern (Boolean to actually rename with
@@ -31,197 +55,545 @@ def move_files(origin, files, destination, id_order, custom_preorder,
     not and the characters to be removed from the filenames
     :param lowercase: Boolean for whether to transform filenames to lowercase
     :param duplicate: Boolean for whether to move or duplicate the files
-    :param replace_files: Boolean for whether to overwrite in destination
-    :return: None
+    :param replace_files: Boolean for whether to overwrite in destination;
+    ignored if collisions is given
+    :param progress: Optional callable receiving (files done, total files,
+    bytes of the last file) after each file is processed
+    :param cancelled: Optional callable returning True when the job should
+    stop; it is checked between files, so no file is left half-processed
+    :param workers: Number of threads copying files at the same time when
+    duplicating; names are assigned before copying, so the result does not
+    depend on it
+    :param entries: Optional dictionary of FileEntry records of the origin
+    files by filename, as returned by scan_directory; if None, the origin
+    is scanned once here. Files are never stat'ed again afterwards
+    :param journal: Optional pathname of a journal to record the job in, so
+    that it can be resumed if interrupted, or rolled back
+    :param dedup: When duplicating, what to do with files whose content is
+    already in the destination: None to copy them anyway, "skip" to skip
+    them or "link" to hardlink them to the existing file
+    :param substitutions: Sequence of (regular expression, replacement)
+    pairs applied to the original names before renaming
+    :param template: Optional format string of the new names, overriding
+    numbering, such as "{n:04d}_{stem}{ext}"
+    :param recursive: Boolean for whether to process the files of the whole
+    origin tree instead of the origin folder alone. Files are pre-ordered,
+    numbered and renamed folder by folder
+    :param include: Shell-style patterns (e.g. "*.jpg"); if given, only the
+    matching files are processed. Patterns containing a slash are matched
+    against the path relative to origin
+    :param exclude: Shell-style patterns of the files to leave out; in
+    recursive mode, matching folders aren't walked
+    :param flatten: In recursive mode, Boolean for whether to put every file
+    right in destination, numbered as a single sequence, instead of
+    preserving the folder structure of origin
+    :param verify: Boolean for whether to compare every copy with its
+    original, when duplicating or moving to another filesystem
+    :param collisions: What to do with files whose name is taken in the
+    destination: "skip", "overwrite", "suffix" (add a number to the name),
+    "newer" or "larger" (replace the existing file only if the new one is
+    newer or larger). Collisions are resolved against a single listing of
+    each destination folder, before the files are touched
+    :param metrics: Optional JobHooks (e.g. a JobMetrics) receiving the
+    time spent in each stage of the job, the filesystem calls made, and
+    the time and bytes copied of every file. Without it, the job isn't
+    timed at all
+    :param rename: Optional renaming function from FileOrganizer_rename's
+    compile_renamer, used instead of numbering, removing, lowercase,
+    substitutions and template, so jobs run again and again compile it once
+    :param preorder: Optional pre-order function from FileOrganizer_plan's
+    compile_preorder, used instead of id_order and custom_preorder
+    :param processes: Number of processes executing the plan. Beyond one,
+    the plan is computed here, then cut into shards executed by worker
+    processes (see FileOrganizer_shard); the plan is then held in memory.
+    The workers import the caller's main module again, so scripts must call
+    this under an 'if __name__ == "__main__":' guard; otherwise the job
+    goes on in a single process
+    :param remote: Boolean telling whether origin or destination is on a
+    network share (NFS, SMB): many filesystem calls are then kept in flight
+    at once, as many as the latency of the share allows, and the transient
+    errors are retried (see FileOrganizer_async). processes is ignored
+    :return: Number of files processed (skipped ones included)
     """
 
-    # ------ UTILITY CLOSURES ---------
+    # Start logging, if it isn't started yet
+    start_logging()
 
-    def replace_lower(string):
-        """
-        Modifies the final name of a file according to the 'replace
-        characters' and 'lowercase' options.
-        :param string: String to be modified
-        :return: Modified string
-        """
+    if not files and not recursive:
+        # No files were checked; log error and abort
+        log_error("Attempted to move files, but no origin files checked.")
+        raise NoSelectedFiles("No files selected to move in origin folder")
 
-        return_string = ""
+    start = perf_counter()
+    try:
+        plan = iter_plan(origin, files, destination, id_order,
+                         custom_preorder, numbering, removing, lowercase,
+                         duplicate, replace_files, entries, substitutions,
+                         template, recursive, include, exclude, flatten,
+                         workers, collisions, metrics, rename, preorder)
+        if metrics is not None:
+            plan = timed_iter(plan, metrics, PLAN)
+
+        if not (duplicate and dedup):
+            return run_job(origin, destination, plan, progress, cancelled,
+                           workers, journal, verify, metrics, processes,
+                           remote)
+
+        # Deduplication needs the whole plan at once
+        plan = tuple(plan)
+
+        index = DedupIndex()
+        try:
+            plan, copied = deduplicate(plan, origin, destination, index,
+                                       dedup, workers)
+            try:
+                return run_job(origin, destination, plan, progress,
+                               cancelled, workers, journal, verify, metrics,
+                               processes, remote)
+            finally:
+                # Remember the hashes of the new copies for the next jobs
+                record_copies(index, destination, copied)
+        finally:
+            index.close()
+    finally:
+        if metrics is not None:
+            metrics.job_done(perf_counter() - start)
+
+def run_job(origin, destination, plan, progress=None, cancelled=None,
+            workers=1, journal=None, verify=False, metrics=None,
+            processes=1, remote=False):
+    """
+    Executes a plan, recording it in a new journal if one is given.
+    :param plan: Iterable of PlanEntry
+    :param journal: Optional pathname of the journal to create
+    :param processes: Number of processes executing the plan
+    :param remote: Boolean telling whether the files are on a network share
+    :return: Number of files processed
+    """
+    if journal is not None:
+        return run_journaled(Journal.create(journal, origin, destination,
+                                            plan),
+                             progress, cancelled, workers, verify, metrics,
+                             processes, remote)
 
-        if removing[0] and lowercase:
-            # The string has to have the specified characters out
-            # before making it lowercase
-            temp_string = ""
-            for character in removing[1]:
-                temp_string = string.replace(character, "")
-            return_string = temp_string.lower()
+    return plan_executor(processes, remote)(origin, destination, plan,
+                                            progress, cancelled, workers,
+                                            verify=verify, metrics=metrics)
 
-        elif removing[0] and removing[1]:
-            for character in removing[1]:
-                return_string = string.replace(character, "")
+def plan_executor(processes, remote=False):
+    """
+    :param processes: Number of processes executing a plan
+    :param remote: Boolean telling whether the files are on a network share
+    :return: Function executing a plan, with execute_plan's arguments
+    """
+    if remote:
+        # Shares are bound by the latency of their calls, not by the CPU.
+        # Only their jobs pay for importing asyncio
+        from FileOrganizer_async import execute_async
+        return execute_async
 
-        elif lowercase:
-            return_string = string.lower()
+    if processes <= 1:
+        return execute_plan
 
-        else:
-            # No change at all
-            return_string = string
+    # Only sharded jobs pay for importing multiprocessing
+    from FileOrganizer_shard import execute_sharded
+    return partial(execute_sharded, processes=processes)
 
-        return return_string
+def execute_plan(origin, destination, plan, progress=None, cancelled=None,
+                 workers=1, journal=None, verify=False, metrics=None):
+    """
+    Applies a plan computed by FileOrganizer_plan's plan_moves.
+    :param origin: Directory from which the files are moved/duplicated
+    :param destination: Pathname to contain the specified files
+    :param plan: Iterable of PlanEntry, executed as it's iterated
+    :param progress: Optional callable receiving (files done, total files,
+    bytes of the last file) after each file is processed; the total is 0
+    when the plan is streamed without a journal
+    :param cancelled: Optional callable returning True when the job should
+    stop; it is checked between files, so no file is left half-processed
+    :param workers: Number of threads copying files at the same time when
+    duplicating, or moving to another filesystem
+    :param journal: Optional Journal of the plan; entries it has as done are
+    skipped, and every completed entry is recorded in it
+    :param verify: Boolean for whether to compare every copy with its
+    original
+    :param metrics: Optional JobHooks receiving the time of every file and
+    of its logging, and the filesystem calls made
+    :return: Number of files processed
+    """
+    # Logging is timed apart from the files, only when asked to; records
+    # still name the function logging, not the timing wrapper
+    log = log_info if metrics is None else \
+        timed_call(partial(log_info, stacklevel=2), metrics, LOG)
 
-    def move_file(origin_name, destination_name):
+    # When resuming, the operations right before the interruption may have
+    # happened without being journaled
+    resuming = journal is not None and journal.resumed
+
+    # Folders of the destination known to exist, relative to it; in
+    # recursive mode files may go to folders that aren't there yet
+    folders = set([""])
+
+    def move_file(task):
         """
-        Moves or duplicates a file into a destination directory. Deletes
-        a file in the destination if replace_files is True. Otherwise, avoids
-        the operation in case the filename already exists.
-        :param origin_name: File's original name
-        :param destination_name: Name of the file in its new directory
-        :return: None
+        Moves or duplicates a file into the destination directory, first
+        deleting the file it replaces if there's one.
+        :param task: Tuple of (original name, final name, index in the plan,
+        PlanEntry)
+        :return: Size in bytes of the processed file
         """
+        index, entry = task[2], task[3]
 
-        # Take care of removing or lowercase transformation if desired
-        destination_name = replace_lower(destination_name) if removing[0] \
-                           or lowercase else destination_name
+        if entry.action == SKIP:
+            log("File %s in %s skipped (%s: %s)", entry.source, origin,
+                entry.conflict, entry.destination)
+            if journal is not None:
+                journal.completed(index)
+            return 0
 
         # Create the pathname of the file in its new directory
-        final_pathname = os.path.join(destination, destination_name)
-
-        # If files should be replaced, get rid of any file
-        # that already has the same name in the destination folder
-        if replace_files and os.path.exists(final_pathname):
+        final_pathname = os.path.join(destination, entry.destination)
+        origin_pathname = os.path.join(origin, entry.source)
+
+        folder = os.path.dirname(entry.destination)
+        if folder not in folders:
+            os.makedirs(os.path.join(destination, folder), exist_ok=True)
+            folders.add(folder)
+            if metrics is not None:
+                metrics.calls("mkdir")
+
+        # Names found free when the plan was made are never overwritten: a
+        # file that landed there since makes the entry a skip. When
+        # resuming, the file there may be this job's own, left by the
+        # interruption
+        exclusive = entry.conflict != EXISTS and not resuming
+        try:
+            return transfer(entry, origin_pathname, final_pathname,
+                            exclusive, index)
+        except FileExistsError:
+            if not exclusive:
+                raise
+            log("File %s in %s skipped (%s: %s)", entry.source, origin,
+                EXISTS, entry.destination)
+            if journal is not None:
+                journal.completed(index)
+            return 0
+
+    def transfer(entry, origin_pathname, final_pathname, exclusive, index):
+        """
+        Moves, copies or links a file, see move_file.
+        :param exclusive: Boolean telling whether final_pathname must not
+        exist
+        :return: Size in bytes of the processed file
+        :raise FileExistsError: If exclusive and final_pathname exists
+        """
+        # If the file is to be replaced, get rid of the file that
+        # already has the same name in the destination folder. Moves
+        # replace it atomically instead
+        if entry.conflict == EXISTS and entry.action != MOVE:
             # Log information about the file being removed
-            log_info("Removing {} from {} as it will be overwritten".format(
-                destination_name, destination))
+            log("Removing %s from %s as it will be overwritten",
+                entry.destination, destination)
 
-            os.remove(final_pathname)
+            try:
+                os.remove(final_pathname)
+            except OSError as error:
+                if not (resuming and error.errno == errno.ENOENT):
+                    raise
 
         # If the files should not be deleted from the original folder,
-        # use shutil_copyfile to move the file; don't try if file exists
-        if duplicate and not os.path.exists(final_pathname):
-            shutil_copyfile(os.path.join(origin, origin_name), final_pathname)
-
-        # Else, if the files are to be moved and the filename doesn't
-        # already exist in the destination folder, move with os' rename
-        elif not os.path.exists(final_pathname):
-            os.rename(os.path.join(origin, origin_name), final_pathname)
+        # use copy_file to duplicate the file
+        if entry.action == COPY:
+            copy_file(origin_pathname, final_pathname, exclusive=exclusive)
+            if verify:
+                verify_copy(origin_pathname, final_pathname)
+
+        # Its content is already in another file: hardlink to that one
+        elif entry.action == LINK:
+            try:
+                os.link(entry.link, final_pathname)
+            except OSError as error:
+                if not (resuming and error.errno == errno.EEXIST):
+                    raise
+
+        # Else, the files are to be moved with os' rename, or copied and
+        # deleted when the destination is on another filesystem
+        else:
+            try:
+                if cross_device:
+                    move_across(origin_pathname, final_pathname, verify,
+                                exclusive)
+                else:
+                    try:
+                        if exclusive:
+                            rename_new(origin_pathname, final_pathname)
+                        else:
+                            os.replace(origin_pathname, final_pathname)
+                    except OSError as error:
+                        # A mount point inside the origin tree
+                        if error.errno != errno.EXDEV:
+                            raise
+                        move_across(origin_pathname, final_pathname, verify,
+                                    exclusive)
+            except OSError as error:
+                if not (resuming and error.errno == errno.ENOENT and
+                        os.path.exists(final_pathname)):
+                    raise
 
         # Log the new file movement
-        log_info("File {} in {} moved with name {} to {}".format(origin_name,
-                                                                 origin,
-                                                                 destination_name,
-                                                                 destination))
-
-    # ------ END OF UTILITY CLOSURES ---------
-
-    # Start a new logging session
-    start_logging()
+        log("File %s in %s %s with name %s to %s%s", entry.source, origin,
+            PAST_TENSES[entry.action], entry.destination, destination,
+            REPLACED if entry.conflict == EXISTS else "")
 
-    if not files:
-        # No files were checked; log error and abort
-        log_error("Attempted to move files, but no origin files checked.")
-        raise NoSelectedFiles("No files selected to move in origin folder")
+        if journal is not None:
+            journal.completed(index)
 
-    # Check pre-order to apply before moving/renaming the files
-    if id_order == 0:
-        # Pre-order alphabetically
-        original_files = sort_list(files)
-
-    elif id_order == 1:
-        # Pre-rder reverse alphabetically
-        original_files = sort_list(files, rev=True)
-
-    elif id_order == 2:
-        # Order by creation time
-        # List comprehension of tuples containing creation time, name of file
-        c_times = [(localtime(os.stat(os.path.join(origin, f))[ST_CTIME]), f)
-                   for f in files]
-
-        # Sort filenames by creation time
-        original_files = sort_list(c_times, pairs=True)
+        return entry.size
 
+    if journal is None:
+        total = len(plan) if hasattr(plan, "__len__") else 0
+        is_done = None
     else:
-        # Pre-order by a number found after/before a pattern in the filenames
-        pattern = custom_preorder[1]
-        list_to_order = []
-
-        for f in files:
-                # If there is no defined pattern, maybe the name of the files
-                # themselves is just a number... Take the name until its
-                # extension suffix period
-                if not pattern:
-                    try:
-                        file_tuple = (int(f[:f.find(".")]), f)
-
-                    except ValueError:
-                        # Well, this file doesn't follow what we expected..
-                        # Improvise with a simple 0 in the first tuple value
-                        file_tuple = (0, f)
-
-                # If the number pattern is before the specified string:
-                elif custom_preorder[0]:
-                    # Create a tuple with the number of the file and its name.
-                    # Number determined from start of name to pattern location
-                    try:
-                        file_tuple = (int(f[:f.find(pattern)]), f)
+        # Entries done before an interruption cost a single lookup
+        total = journal.done.count(0)
+        is_done = journal.is_done
+
+    # Hardlinks may point to copies made by this same job, so they go
+    # once every copy is done
+    links = []
+
+    def job_tasks():
+        for i, entry in enumerate(plan):
+            if is_done is not None and is_done(i):
+                continue
+            task = (entry.source, entry.destination, i, entry)
+            if entry.action == LINK:
+                links.append(task)
+            else:
+                yield task
+
+    # Every operation of a plan is a move, or a copy; look ahead for the
+    # first one
+    tasks = job_tasks()
+    ahead = []
+    for task in tasks:
+        ahead.append(task)
+        if task[3].action != SKIP:
+            break
+    copying = any(task[3].action == COPY for task in ahead)
+    tasks = chain(ahead, tasks)
+
+    # The destination may not exist yet; its folders are made as needed
+    if ahead and ahead[-1][3].action != SKIP:
+        os.makedirs(destination, exist_ok=True)
+
+    # Moves between filesystems are copies too; the devices are compared
+    # once, and moves on the same one stay plain renames
+    cross_device = bool(ahead) and not copying and \
+        ahead[-1][3].action != SKIP and \
+        os.stat(origin).st_dev != os.stat(destination).st_dev
+    if cross_device:
+        log_info("%s and %s are on different filesystems, files will be "
+                 "copied and deleted", origin, destination)
+
+    # Every file is timed, and its calls counted, only when asked to
+    def timed_process(task):
+        start = perf_counter()
+        size = move_file(task)
+        seconds = perf_counter() - start
+
+        entry = task[3]
+        for call in entry_calls(entry, cross_device):
+            metrics.calls(call)
+        metrics.stage(TRANSFER, seconds)
+        metrics.file_done(seconds, entry.size if entry.action == COPY or
+                          (cross_device and entry.action == MOVE) else 0)
+        return size
+
+    process = move_file if metrics is None else timed_process
+
+    done = 0
+
+    # Duplicates, and files moved to another filesystem, can be copied by
+    # several threads at once. Errors are
+    # gathered for every file instead of stopping at the first one
+    if workers > 1 and (copying or cross_device):
+        done, errors = copy_in_parallel(process, tasks, workers,
+                                        progress, cancelled, total)
+        if errors:
+            raise FilesNotProcessed(errors, done)
+        tasks = iter(())
+
+    # The links are gathered as the other tasks are consumed
+    for task in chain(tasks, links):
+        # Stop between files, so that no file is left half-processed
+        if cancelled is not None and cancelled():
+            log_info("Job cancelled after %d of %d files", done, total)
+            break
+
+        size = process(task)
+        done += 1
+
+        if progress is not None:
+            progress(done, total, size)
+
+    return done
+
+def entry_calls(entry, cross_device):
+    """
+    :param entry: PlanEntry that was executed
+    :param cross_device: Boolean telling whether moves were copies
+    :return: Tuple of the names of the filesystem calls it took
+    """
+    if entry.action == SKIP:
+        return ()
+    if entry.action == MOVE:
+        if cross_device:
+            return ("copy", "fsync", "rename", "fsync", "unlink")
+        # Names expected free are taken with a link, never a rename
+        return ("rename",) if entry.conflict == EXISTS else ("link", "unlink")
+    calls = ("copy",) if entry.action == COPY else ("link",)
+    return calls + ("unlink",) if entry.conflict == EXISTS else calls
+
+def run_journaled(journal, progress=None, cancelled=None, workers=1,
+                  verify=False, metrics=None, processes=1, remote=False):
+    """
+    Executes the plan of a journal, marking the journal as finished if
+    every one of its entries got done, as stopped or aborted if the job was
+    cancelled or failed. Only a job that didn't get to its end (a crash, an
+    interrupted program) is left to be resumed.
+    :param journal: Journal instance
+    :param processes: Number of processes executing the plan
+    :param remote: Boolean telling whether the files are on a network share
+    :return: Number of files processed
+    """
+    try:
+        execute = plan_executor(processes, remote)
+        done = execute(journal.origin, journal.destination, journal.entries(),
+                       progress, cancelled, workers, journal, verify, metrics)
+    except Exception:
+        journal.close(ABORTED)
+        raise
+    except BaseException:
+        journal.close()
+        raise
+
+    if 0 not in journal.done:
+        journal.close(FINISHED)
+    elif cancelled is not None and cancelled():
+        journal.close(STOPPED)
+    else:
+        journal.close()
+    return done
 
-                    except ValueError:
-                        # The file does not follow the pattern, improvise
-                        file_tuple = (0, f)
+def resume_job(journal_path, progress=None, cancelled=None, workers=1,
+               verify=False, processes=1, remote=False):
+    """
+    Resumes an interrupted job from its journal, skipping the files it
+    already processed.
+    :param journal_path: Pathname of the job's journal
+    :param progress: Same as in move_files
+    :param cancelled: Same as in move_files
+    :param workers: Same as in move_files
+    :param verify: Same as in move_files
+    :param processes: Same as in move_files
+    :param remote: Same as in move_files
+    :return: Number of files processed
+    """
+    start_logging()
+    journal = Journal.load(journal_path)
+    log_info("Resuming job %s, %d of %d files already done", journal_path,
+             journal.done.count(1), len(journal))
+    return run_journaled(journal, progress, cancelled, workers, verify,
+                         processes=processes, remote=remote)
 
-                else:
-                    # Number determined from pattern location to period before
-                    # the file extension
+def rollback_job(journal_path, progress=None, cancelled=None):
+    """
+    Undoes the operations of a job recorded in its journal, last one first:
+    moved files go back to their original folder and name, duplicates are
+    deleted. Files that were overwritten by the job can't be restored.
+    :param journal_path: Pathname of the job's journal
+    :param progress: Same as in move_files
+    :param cancelled: Same as in move_files
+    :return: Number of files restored
+    """
+    start_logging()
+    journal = Journal.load(journal_path)
+
+    # Only the entries done are kept, to be undone last one first
+    undo = [(i, entry) for i, entry in enumerate(journal.entries())
+            if journal.is_done(i)]
+    undo.reverse()
+    total = len(undo)
+    done = 0
+    errors = []
+
+    try:
+        for index, entry in undo:
+            if cancelled is not None and cancelled():
+                log_info("Rollback cancelled after %d of %d files",
+                         done, total)
+                break
+
+            final_pathname = os.path.join(journal.destination,
+                                          entry.destination)
+            try:
+                if entry.action in (COPY, LINK):
+                    os.remove(final_pathname)
+                elif entry.action != SKIP:
+                    origin_pathname = os.path.join(journal.origin,
+                                                   entry.source)
                     try:
-                        file_tuple = (int(f[f.find(pattern)+len(pattern):
-                                            f.find(".")]), f)
-
-                    except ValueError:
-                        file_tuple = (0, f)
-
-                list_to_order.append(file_tuple)
-
-        original_files = sort_list(list_to_order, pairs=True)
-
-    # If the new filenames will follow a prefixed/suffixed number pattern
-    # then create their names according to the ordered original_files
-    if numbering[0]:
-        try:
-            # Create a format string with the number of digits
-            digits = "{{:0{}d}}".format(int(numbering[1]))
-        except ValueError:
-            # Just put a default of four digits
-            digits = "{{:04d}}"
-
-        for i, f in enumerate(original_files):
-            ext_period = f.rfind(".")
-            # If the filename has no extension, nothing else should be appended
-            cut_from = ext_period + 1 if ext_period > 0 else len(f)
-
-            # If the user checked the numeration checkbox but inserted no
-            # pattern, maybe they just want the number to be the filename
-            if not numbering[3]:
-                move_file(f, "{}{}".format(digits.format(i), f[cut_from:]))
-
-            # If the numbering pattern should go after the custom pattern,
-            # name should be: custom pattern, digits, extension
-            elif numbering[2] == 0:
-                move_file(f, "{}{}{}".format(numbering[3],
-                                             digits.format(i),
-                                             f[cut_from:]))
-
-            # But if the numbering pattern should go before the custom pattern
-            # the new name should be: digits, custom pattern, extension
-            else:
-                move_file(f, "{}{}{}".format(digits.format(i),
-                                             numbering[3],
-                                             f[cut_from:]))
-
-    # Else there is not a special numbering pattern to rename the files with
-    else:
-        # Move or duplicate the files with their same original name
-        # (although maybe with lowercase and replace options, if so desired)
-        for f in original_files:
-            move_file(f, f)
+                        os.rename(final_pathname, origin_pathname)
+                    except OSError as error:
+                        if error.errno != errno.EXDEV:
+                            raise
+                        move_across(final_pathname, origin_pathname)
+            except OSError as error:
+                log_error("Could not roll back %s: %s", entry.destination,
+                          error)
+                errors.append((entry.destination, error))
+                continue
+
+            if entry.action != SKIP:
+                log_info("Rolled back %s to %s in %s", entry.destination,
+                         entry.source, journal.origin)
+                if entry.conflict == EXISTS:
+                    log_error("The file %s replaced by %s can't be restored",
+                              entry.destination, entry.source)
+
+            journal.undone(index)
+            done += 1
+            if progress is not None:
+                progress(done, total, entry.size)
+    finally:
+        # Even if partial, a rolled back job must not be offered for resume;
+        # rolling it back again goes on with the files left
+        journal.close(ROLLED_BACK)
+
+    if errors:
+        raise FilesNotProcessed(errors, done)
+    return done
 
 class NoSelectedFiles(Exception):
     " Custom Exception to Raise and fill the Status Bar. "
     pass
+
+class FilesNotProcessed(Exception):
+    " Custom Exception listing the files that could not be moved/copied. "
+
+    def __init__(self, errors, done):
+        """
+        :param errors: List of (filename, error) tuples
+        :param done: Number of files that were processed correctly
+        """
+        super(FilesNotProcessed, self).__init__(
+            "{} files could not be processed".format(len(errors)))
+        self.errors = errors
+        self.done = done
+
+if __name__ == "__main__":
+    # python -m FileOrganizer runs the command line interface
+    import sys
+    from FileOrganizer_cli import main
+    sys.exit(main())
@@ -0,0 +1,603 @@
+"""
+FileOrganizer_async.py: Executes plans on network shares (NFS, SMB), where
+                        every filesystem call waits on a round trip. An
+                        asyncio loop keeps many calls in flight at once, run
+                        by a pool of threads; how many adapts to the latency
+                        the share shows, and calls failing with a transient
+                        error are retried after a growing delay. Calls go
+                        through a small filesystem layer, which LatencyFS
+                        replaces to reproduce a slow share locally.
+"""
+__author__ = "Carlos Montes"
+
+import os
+import errno
+import random
+import asyncio
+import threading
+from time import perf_counter, sleep
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from logging import info as log_info
+from logging import error as log_error
+from FileOrganizer import execute_plan, entry_calls, FilesNotProcessed
+from FileOrganizer import PAST_TENSES, REPLACED
+from FileOrganizer_copy import copy_file, verify_copy, move_across
+from FileOrganizer_copy import rename_new
+from FileOrganizer_plan import COPY, MOVE, LINK, SKIP, EXISTS
+from FileOrganizer_metrics import timed_call, TRANSFER, LOG
+from FileOrganizer_utils import same_directory
+
+# Filesystem calls in flight at first, at least and at most
+INITIAL_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+
+# Files started ahead, per call allowed in flight, so that the calls of the
+# next files are ready when slots free up
+FILES_PER_CALL = 2
+
+# Weight of the last call in the running average of the latency
+LATENCY_SMOOTHING = 0.1
+
+# Calls first averaged evenly, before the lowest latency is taken
+WARMUP_CALLS = 20
+
+# The share is taken as saturated when the average latency exceeds the
+# lowest one seen this many times; the concurrency then shrinks by
+# SLOWDOWN_FACTOR, or by FAILURE_FACTOR on transient errors. It shrinks at
+# most once per round of calls, as the calls of a round see the same
+# state of the share
+LATENCY_TOLERANCE = 2.0
+SLOWDOWN_FACTOR = 0.9
+FAILURE_FACTOR = 0.5
+
+# Retries of a call failing with a transient error; the first one waits
+# RETRY_DELAY seconds, the next ones twice the previous, up to
+# RETRY_MAX_DELAY
+RETRIES = 5
+RETRY_DELAY = 0.05
+RETRY_MAX_DELAY = 2.0
+
+# Errors of network filesystems worth retrying
+TRANSIENT_ERRNOS = set(getattr(errno, name) for name in
+                       ("EAGAIN", "EBUSY", "EINTR", "ETIMEDOUT", "ESTALE",
+                        "ECONNRESET", "ECONNABORTED", "EHOSTDOWN",
+                        "EHOSTUNREACH", "ENETDOWN", "ENETUNREACH")
+                       if hasattr(errno, name))
+
+class LocalFS(object):
+    """
+    Filesystem calls of the executor, each one blocking until it's done.
+    """
+
+    def call(self, name, *args):
+        """
+        :param name: Name of one of the methods below
+        :param args: Its arguments
+        :return: What it returns
+        """
+        return getattr(self, name)(*args)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def replace(self, origin, destination):
+        os.replace(origin, destination)
+
+    def rename_new(self, origin, destination):
+        rename_new(origin, destination)
+
+    def link(self, target, path):
+        os.link(target, path)
+
+    def copy(self, origin, destination, exclusive=False):
+        return copy_file(origin, destination, exclusive=exclusive)
+
+    def verify(self, origin, destination):
+        verify_copy(origin, destination)
+
+    def move_across(self, origin, destination, verify=False,
+                    exclusive=False):
+        return move_across(origin, destination, verify, exclusive)
+
+class LatencyFS(LocalFS):
+    """
+    Local filesystem behaving like a network share: every call takes a
+    round trip, which slows down once the share is busy, and some calls
+    fail with a transient error, before or after being done. It counts the
+    calls it serves, for benchmarks and checks.
+    """
+
+    def __init__(self, latency=0.01, jitter=0.5, capacity=None, failures=0.0,
+                 seed=None):
+        """
+        :param latency: Seconds of the round trip of a call
+        :param jitter: Fraction of the latency by which it varies at random
+        :param capacity: Calls served at once at full speed; beyond it, the
+        latency grows with the calls in flight (None for no limit)
+        :param failures: Probability of a call failing with ETIMEDOUT; half
+        of the failures happen after the call is done, as lost replies
+        :param seed: Seed of the random latencies and failures
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.capacity = capacity
+        self.failures = failures
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.peak = 0
+
+    def call(self, name, *args):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            delay = self.latency * (1 + self.jitter *
+                                    (2 * self.random.random() - 1))
+            if self.capacity is not None:
+                delay *= max(1.0, float(self.in_flight) / self.capacity)
+            failure = self.random.random() < self.failures
+            lost_reply = failure and self.random.random() < 0.5
+            if failure:
+                self.failed += 1
+
+        try:
+            sleep(delay / 2)
+            if failure and not lost_reply:
+                raise OSError(errno.ETIMEDOUT, "Injected transient error",
+                              args[0])
+            result = LocalFS.call(self, name, *args)
+            sleep(delay / 2)
+            if lost_reply:
+                raise OSError(errno.ETIMEDOUT, "Injected lost reply",
+                              args[0])
+            return result
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+class AdaptiveLimit(object):
+    """
+    Number of filesystem calls allowed in flight. It grows by one every
+    round of calls while the latency stays close to the lowest seen, and
+    shrinks by a factor when the calls slow down or fail. Used from a
+    single event loop.
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY,
+                 maximum=MAX_CONCURRENCY):
+        """
+        :param initial: Calls allowed at first
+        :param minimum: Calls always allowed
+        :param maximum: Calls never exceeded
+        """
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.in_flight = 0
+
+        # Running average of the latency, and its lowest value
+        self.samples = 0
+        self.average = 0.0
+        self.lowest = None
+        # Calls ended since the limit last shrank
+        self.since_shrink = 0
+
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        """
+        Waits for a free slot, and takes it.
+        :return: None
+        """
+        async with self.condition:
+            while self.in_flight >= int(self.limit):
+                await self.condition.wait()
+            self.in_flight += 1
+
+    async def release(self, seconds=None, failed=False):
+        """
+        Frees a slot, adapting the limit.
+        :param seconds: Latency of the call, None if it failed
+        :param failed: Boolean telling whether the call failed with a
+        transient error
+        :return: None
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            self.since_shrink += 1
+
+            if failed:
+                if self.since_shrink >= self.limit:
+                    self.shrink(FAILURE_FACTOR)
+            elif seconds is not None:
+                # A single fast call mustn't set the lowest latency, or
+                # every usual one would look slow
+                self.samples += 1
+                if self.samples <= WARMUP_CALLS:
+                    self.average += (seconds - self.average) / self.samples
+                else:
+                    self.average += LATENCY_SMOOTHING * \
+                        (seconds - self.average)
+                    if self.lowest is None or self.average < self.lowest:
+                        self.lowest = self.average
+
+                if self.lowest is None or \
+                        self.average <= self.lowest * LATENCY_TOLERANCE:
+                    self.limit = min(self.maximum,
+                                     self.limit + 1.0 / self.limit)
+                elif self.since_shrink >= self.limit:
+                    self.shrink(SLOWDOWN_FACTOR)
+
+            self.condition.notify_all()
+
+    def shrink(self, factor):
+        """
+        :param factor: Factor applied to the limit, below 1
+        """
+        self.limit = max(self.minimum, self.limit * factor)
+        self.since_shrink = 0
+
+class AsyncExecutor(object):
+    """
+    Executes a plan with many filesystem calls in flight at once. Every
+    file is a coroutine making its calls in order; the calls of different
+    files overlap.
+    """
+
+    def __init__(self, origin, destination, progress=None, cancelled=None,
+                 workers=1, journal=None, verify=False, metrics=None,
+                 filesystem=None, concurrency=MAX_CONCURRENCY):
+        """
+        See execute_async.
+        """
+        self.origin = origin
+        self.destination = destination
+        self.progress = progress
+        self.cancelled = cancelled
+        self.workers = max(1, workers)
+        self.journal = journal
+        self.verify = verify
+        self.metrics = metrics
+        self.filesystem = LocalFS() if filesystem is None else filesystem
+        self.concurrency = max(1, concurrency)
+
+        # When resuming, the operations right before the interruption may
+        # have happened without being journaled
+        self.resuming = journal is not None and journal.resumed
+
+        # Logging is timed apart from the files, only when asked to
+        self.log = log_info if metrics is None else \
+            timed_call(partial(log_info, stacklevel=2), metrics, LOG)
+
+        self.done = 0
+        self.total = 0
+        self.errors = []
+        self.cross_device = False
+
+    async def call(self, name, *args, metadata=True, tolerated=None,
+                   again=None):
+        """
+        Makes a filesystem call in the pool of threads, retrying it after
+        transient errors.
+        :param name: Name of the call, a method of LocalFS
+        :param args: Its arguments, the pathname it acts on first
+        :param metadata: Boolean telling whether the call waits for a slot
+        of the adaptive limit, and counts to adapt it. Copies don't: their
+        time depends on their size, and workers bounds them instead
+        :param tolerated: Optional coroutine function receiving an OSError
+        and returning True if it means the call was done already: by a
+        first attempt whose reply got lost, or before a job was interrupted
+        :param again: Optional tuple of the arguments of the retries, when
+        they differ from args: an exclusive copy is retried over the file
+        its first attempt may have left
+        :return: What the call returns (None if tolerated)
+        """
+        delay = RETRY_DELAY
+        for attempt in range(RETRIES + 1):
+            if attempt and again is not None:
+                args = again
+            if metadata:
+                await self.limit.acquire()
+            start = perf_counter()
+            try:
+                result = await self.loop.run_in_executor(
+                    self.pool, partial(self.filesystem.call, name, *args))
+            except OSError as error:
+                transient = error.errno in TRANSIENT_ERRNOS
+                if metadata:
+                    await self.limit.release(failed=transient)
+
+                if (attempt or self.resuming) and tolerated is not None and \
+                        await tolerated(error):
+                    return None
+                if not transient or attempt == RETRIES:
+                    raise
+
+                log_info("Retrying %s of %s in %.2f s: %s", name, args[0],
+                         delay, error)
+                if self.metrics is not None:
+                    self.metrics.calls("retry")
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, RETRY_MAX_DELAY)
+                continue
+
+            if metadata:
+                await self.limit.release(perf_counter() - start)
+            return result
+
+    async def process(self, index, entry):
+        """
+        Moves or duplicates a file into the destination directory, first
+        deleting the file it replaces if there's one.
+        :param index: Index of the entry in the plan
+        :param entry: PlanEntry
+        :return: Size in bytes of the processed file
+        """
+        if entry.action == SKIP:
+            self.log("File %s in %s skipped (%s: %s)", entry.source,
+                     self.origin, entry.conflict, entry.destination)
+            if self.journal is not None:
+                self.journal.completed(index)
+            return 0
+
+        final_pathname = os.path.join(self.destination, entry.destination)
+        origin_pathname = os.path.join(self.origin, entry.source)
+
+        # The files of a new folder wait for the first one to create it
+        folder = os.path.dirname(entry.destination)
+        if folder:
+            if folder not in self.folders:
+                self.folders[folder] = asyncio.ensure_future(self.call(
+                    "makedirs", os.path.join(self.destination, folder)))
+            await self.folders[folder]
+
+        # Names found free when the plan was made are never overwritten, as
+        # in execute_plan
+        exclusive = entry.conflict != EXISTS and not self.resuming
+        try:
+            await self.transfer(entry, origin_pathname, final_pathname,
+                                exclusive)
+        except FileExistsError:
+            if not exclusive:
+                raise
+            self.log("File %s in %s skipped (%s: %s)", entry.source,
+                     self.origin, EXISTS, entry.destination)
+            if self.journal is not None:
+                self.journal.completed(index)
+            return 0
+
+        self.log("File %s in %s %s with name %s to %s%s", entry.source,
+                 self.origin, PAST_TENSES[entry.action], entry.destination,
+                 self.destination,
+                 REPLACED if entry.conflict == EXISTS else "")
+
+        if self.journal is not None:
+            self.journal.completed(index)
+        return entry.size
+
+    async def transfer(self, entry, origin_pathname, final_pathname,
+                       exclusive):
+        """
+        Moves, copies or links a file, see process.
+        :param exclusive: Boolean telling whether final_pathname must not
+        exist
+        :return: None
+        :raise FileExistsError: If exclusive and final_pathname exists
+        """
+        async def missing(error):
+            return error.errno == errno.ENOENT
+
+        async def linked(error):
+            return error.errno == errno.EEXIST
+
+        async def moved(error):
+            return error.errno == errno.ENOENT and \
+                await self.call("exists", final_pathname)
+
+        # Moves replace the existing file atomically
+        if entry.conflict == EXISTS and entry.action != MOVE:
+            self.log("Removing %s from %s as it will be overwritten",
+                     entry.destination, self.destination)
+            await self.call("remove", final_pathname, tolerated=missing)
+
+        if entry.action == COPY:
+            async with self.copies:
+                await self.call("copy", origin_pathname, final_pathname,
+                                exclusive, metadata=False,
+                                again=(origin_pathname, final_pathname))
+                if self.verify:
+                    await self.call("verify", origin_pathname,
+                                    final_pathname, metadata=False)
+
+        elif entry.action == LINK:
+            await self.call("link", entry.link, final_pathname,
+                            tolerated=linked)
+
+        else:
+            across = self.cross_device
+            if not across:
+                try:
+                    await self.call("rename_new" if exclusive else "replace",
+                                    origin_pathname, final_pathname,
+                                    tolerated=moved)
+                except OSError as error:
+                    # A mount point inside the origin tree
+                    if error.errno != errno.EXDEV:
+                        raise
+                    across = True
+            if across:
+                async with self.copies:
+                    await self.call("move_across", origin_pathname,
+                                    final_pathname, self.verify, exclusive,
+                                    metadata=False, tolerated=moved)
+
+    async def timed(self, index, entry):
+        """
+        Processes a file, timing it and counting its calls.
+        :return: Size in bytes of the processed file
+        """
+        start = perf_counter()
+        size = await self.process(index, entry)
+        seconds = perf_counter() - start
+
+        for call in entry_calls(entry, self.cross_device):
+            self.metrics.calls(call)
+        self.metrics.stage(TRANSFER, seconds)
+        self.metrics.file_done(seconds, entry.size if entry.action == COPY or
+                               (self.cross_device and entry.action == MOVE)
+                               else 0)
+        return size
+
+    async def collect(self, pending):
+        """
+        Waits for a file in flight to end, and accounts for the ones that
+        did.
+        :param pending: Dictionary of PlanEntry by future of their file;
+        the finished ones are removed
+        :return: None
+        """
+        finished, _ = await asyncio.wait(pending,
+                                         return_when=asyncio.FIRST_COMPLETED)
+        for future in finished:
+            entry = pending.pop(future)
+            try:
+                size = future.result()
+            except (IOError, OSError) as error:
+                log_error("Could not process %s: %s", entry.source, error)
+                self.errors.append((entry.source, error))
+                continue
+
+            self.done += 1
+            if self.progress is not None:
+                self.progress(self.done, self.total, size)
+
+    async def run_tasks(self, tasks):
+        """
+        Processes files, keeping several of them in flight.
+        :param tasks: Iterable of (index in the plan, PlanEntry) tuples
+        :return: Boolean telling whether the job was cancelled
+        """
+        process = self.process if self.metrics is None else self.timed
+        max_pending = self.concurrency * FILES_PER_CALL
+        pending = {}
+        stopped = False
+
+        for index, entry in tasks:
+            # Stop between files, so that no file is left half-processed
+            if self.cancelled is not None and self.cancelled():
+                stopped = True
+                break
+            while len(pending) >= max_pending:
+                await self.collect(pending)
+            pending[asyncio.ensure_future(process(index, entry))] = entry
+
+        while pending:
+            await self.collect(pending)
+        return stopped
+
+    async def run(self, plan):
+        """
+        :param plan: Iterable of PlanEntry
+        :return: Number of files processed
+        """
+        self.loop = asyncio.get_running_loop()
+        self.limit = AdaptiveLimit(maximum=self.concurrency)
+        self.copies = asyncio.Semaphore(self.workers)
+        self.folders = {}
+
+        if self.journal is None:
+            self.total = len(plan) if hasattr(plan, "__len__") else 0
+            is_done = None
+        else:
+            self.total = self.journal.done.count(0)
+            is_done = self.journal.is_done
+
+        # Hardlinks may point to copies made by this same job, so they go
+        # once every copy is done
+        links = []
+
+        def job_tasks():
+            for i, entry in enumerate(plan):
+                if is_done is not None and is_done(i):
+                    continue
+                if entry.action == LINK:
+                    links.append((i, entry))
+                else:
+                    yield i, entry
+
+        self.pool = ThreadPoolExecutor(max_workers=self.concurrency +
+                                       self.workers)
+        with self.pool:
+            # The devices are compared once; moves between filesystems are
+            # copies. The destination may not exist yet
+            await self.call("makedirs", self.destination)
+            devices = await asyncio.gather(
+                self.call("stat", self.origin),
+                self.call("stat", self.destination))
+            self.cross_device = devices[0].st_dev != devices[1].st_dev
+
+            stopped = await self.run_tasks(job_tasks())
+            if not stopped:
+                stopped = await self.run_tasks(links)
+
+        if stopped:
+            log_info("Job cancelled after %d of %d files", self.done,
+                     self.total)
+        log_info("%d filesystem calls allowed in flight at the end of the "
+                 "job", int(self.limit.limit))
+
+        if self.errors:
+            raise FilesNotProcessed(self.errors, self.done)
+        return self.done
+
+def execute_async(origin, destination, plan, progress=None, cancelled=None,
+                  workers=1, journal=None, verify=False, metrics=None,
+                  filesystem=None, concurrency=MAX_CONCURRENCY):
+    """
+    Applies a plan like FileOrganizer's execute_plan, keeping many
+    filesystem calls in flight at once, for network shares. Renaming files
+    within their own folder is left to execute_plan: a file may take the
+    name another one leaves, so the order of the plan matters.
+    :param origin: Directory from which the files are moved/duplicated
+    :param destination: Pathname to contain the specified files
+    :param plan: Iterable of PlanEntry, consumed as files complete
+    :param progress: Optional callable receiving (files done, total files,
+    bytes of the last file) after each file is processed
+    :param cancelled: Optional callable returning True when the job should
+    stop; no file starts after it does, the ones in flight are finished
+    :param workers: Number of files copied at the same time; the other
+    calls aren't bound by it
+    :param journal: Optional Journal of the plan; entries it has as done are
+    skipped, and every completed entry is recorded in it
+    :param verify: Boolean for whether to compare every copy with its
+    original
+    :param metrics: Optional JobHooks receiving the time of every file, the
+    filesystem calls made and the retries
+    :param filesystem: LocalFS making the calls, such as a LatencyFS; the
+    local filesystem if None
+    :param concurrency: Most filesystem calls in flight at once
+    :return: Number of files processed
+    """
+    if same_directory(origin, destination):
+        return execute_plan(origin, destination, plan, progress, cancelled,
+                            workers, journal, verify, metrics)
+
+    executor = AsyncExecutor(origin, destination, progress, cancelled,
+                             workers, journal, verify, metrics, filesystem,
+                             concurrency)
+    return asyncio.run(executor.run(plan))
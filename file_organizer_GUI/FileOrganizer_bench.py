@@ -0,0 +1,923 @@
+"""
+FileOrganizer_bench.py: Benchmarks for FileOrganizer's operations. Run it
+                        directly to compare the serial and the parallel copy
+                        engines (and cross-filesystem moves), to scale a job
+                        across processes, to hide the latency of a simulated
+                        network share, to time the renaming, sorting and
+                        planning of a million names, the reading of capture
+                        dates with and without the cache, the peak memory of
+                        streamed and materialized jobs, or the startup time of
+                        each entry point. The "suite" benchmark times every
+                        operation over synthetic trees, saves the results as
+                        JSON and fails when they regress against a previous
+                        run.
+"""
+__author__ = "Carlos Montes"
+
+import os
+import sys
+import json
+import random
+import struct
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from time import time, strftime
+from shutil import rmtree
+from tempfile import mkdtemp, gettempdir
+
+import FileOrganizer
+from FileOrganizer_copy import DEFAULT_WORKERS
+from FileOrganizer_rename import compile_renamer
+from FileOrganizer_sort import natural_sort, pattern_sort
+from FileOrganizer_sort import external_sort, natural_records
+from FileOrganizer_plan import iter_plan, plan_moves, preorder_files
+from FileOrganizer_utils import scan_directory, retrieve_directory_content
+from FileOrganizer_utils import start_logging, FileEntry
+from FileOrganizer_metadata import MetadataIndex, read_metadata
+from FileOrganizer_metadata import BIRTH_TIME, CAPTURE_TIME
+from FileOrganizer_async import execute_async, LatencyFS, MAX_CONCURRENCY
+
+# (number of files, size of each file in bytes) of the default scenarios
+SMALL_FILES = (10000, 4 * 1024)
+LARGE_FILES = (100, 16 * 1024 * 1024)
+
+# (number of files, size of each file in bytes) of the processes benchmark;
+# its copies are verified, so every file is read twice and hashed
+PROCESS_FILES = (20000, 16 * 1024)
+
+# Files of the remote benchmark, and (latency in seconds, calls served at
+# full speed, probability of a transient error) of its simulated share
+REMOTE_FILES = 2000
+REMOTE_SHARE = (0.005, 32, 0.01)
+
+# Number of names of the renaming, sorting and planning benchmarks
+RENAME_COUNT = 1000000
+SORT_COUNT = 1000000
+PLAN_COUNT = 1000000
+
+# Number of photos of the metadata benchmark
+PHOTO_COUNT = 20000
+
+# (folders, files per folder) of the tree of the memory benchmark, and
+# number of names of its sort
+MEMORY_TREE = (100, 1000)
+MEMORY_SORT_COUNT = 1000000
+
+# Benchmarks that can be chosen from the command line; all but the suite
+# run by default
+BENCHMARKS = ("copy", "move", "processes", "remote", "rename", "sort",
+              "plan", "metadata", "memory", "startup")
+SUITE = "suite"
+
+# Modules whose import the startup benchmark times, each in a fresh
+# interpreter, the number of runs of each (the fastest counts) and the
+# number of heaviest imports listed
+STARTUP_MODULES = ("FileOrganizer_utils", "FileOrganizer", "FileOrganizer_cli",
+                   "FileOrganizer_window")
+STARTUP_RUNS = 5
+STARTUP_TOP = 10
+
+# Script timing the window from its import to its first paint; the
+# listings of its folders go on in the background
+WINDOW_SCRIPT = """
+from time import perf_counter
+start = perf_counter()
+import FileOrganizer_window as window
+app = window.QtGui.QApplication([])
+ex = window.FileOrganizerWindow()
+ex.show()
+app.processEvents()
+print(perf_counter() - start)
+"""
+
+# Number of files of the trees of the suite, by default; 1000000 can be
+# asked from the command line (a few GB of files)
+SUITE_COUNTS = (1000, 100000)
+
+# Sizes of the files of the suite, cycled through; one file in
+# SUITE_LARGE_EVERY gets SUITE_LARGE_SIZE bytes instead
+SUITE_SIZES = (0, 128, 512, 2048, 8192)
+SUITE_LARGE_EVERY = 1000
+SUITE_LARGE_SIZE = 1024 * 1024
+
+# Pre-orders of the suite, by id_order
+SUITE_ORDERS = ("alpha", "reverse", "created", "number", "modified", "size",
+                "taken")
+
+# Version of the format of the JSON results
+SUITE_FORMAT = 1
+
+# Default slowdown, relative to the baseline, failing a suite run, and
+# duration below which cases are too noisy to be compared
+REGRESSION_THRESHOLD = 0.25
+NOISE_SECONDS = 0.05
+
+# (description, keyword arguments of compile_renamer) of each renaming case
+RENAME_CASES = (
+    ("unchanged", {}),
+    ("lowercase", {"lowercase": True}),
+    ("remove characters + lowercase", {"removing": (True, "_- "),
+                                       "lowercase": True}),
+    ("numbering after pattern", {"numbering": (True, "6", 0, "photo_")}),
+    ("numbering + remove + lowercase", {"numbering": (True, "6", 1, "_IMG"),
+                                        "removing": (True, "_"),
+                                        "lowercase": True}),
+    ("template", {"template": "{n:06d}_{stem}{ext}"}),
+    ("regex + template", {"template": "{n:06d}_{stem}{ext}",
+                          "substitutions": ((r"[^A-Za-z0-9.]+", "-"),)}),
+)
+
+def make_files(directory, count, size):
+    """
+    Fills a directory with files of random content.
+    :param directory: Pathname of the directory
+    :param count: Number of files to create
+    :param size: Size in bytes of each file
+    :return: List of the created filenames
+    """
+    block = os.urandom(min(size, 1024 * 1024))
+    names = []
+
+    for i in range(count):
+        name = "file_{:07d}.bin".format(i)
+        with open(os.path.join(directory, name), "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        names.append(name)
+
+    return names
+
+def make_photos(directory, count):
+    """
+    Fills a directory with minimal JPEG files holding an EXIF capture date.
+    :param directory: Pathname of the directory
+    :param count: Number of files to create
+    :return: None
+    """
+    for i in range(count):
+        date = "2016:{:02d}:{:02d} 12:{:02d}:{:02d}\0".format(
+            i % 12 + 1, i % 28 + 1, i // 60 % 60, i % 60).encode("ascii")
+        # TIFF header, IFD0 pointing to the Exif IFD, Exif IFD holding
+        # DateTimeOriginal, then the date itself
+        tiff = (b"II*\0" + struct.pack("<I", 8) +
+                struct.pack("<HHHII", 1, 0x8769, 4, 1, 26) + b"\0" * 4 +
+                struct.pack("<HHHII", 1, 0x9003, 2, 20, 44) + b"\0" * 4 +
+                date)
+        app1 = b"Exif\0\0" + tiff
+        with open(os.path.join(directory, "photo_{:06d}.jpg".format(i)),
+                  "wb") as f:
+            f.write(b"\xff\xd8\xff\xe1" + struct.pack(">H", len(app1) + 2) +
+                    app1 + b"\xff\xda\0\2\xff\xd9")
+
+def time_duplicate(origin, names, workers, root):
+    """
+    Duplicates the files of origin into a new directory and times it.
+    :param origin: Directory containing the files
+    :param names: Filenames to duplicate
+    :param workers: Number of copying threads
+    :param root: Directory where the destination is created
+    :return: Seconds taken by the copy
+    """
+    destination = mkdtemp(dir=root)
+    try:
+        start = time()
+        FileOrganizer.move_files(origin, list(names), destination, 0,
+                                 (0, ""), (False, "4", 0, ""), (False, ""),
+                                 duplicate=True, workers=workers)
+        return time() - start
+    finally:
+        rmtree(destination)
+
+def bench_copy(count, size, workers=DEFAULT_WORKERS, root=None):
+    """
+    Compares serial and parallel duplication of a set of files.
+    :param count: Number of files
+    :param size: Size in bytes of each file
+    :param workers: Number of threads of the parallel run
+    :param root: Directory in which to create the files (system temp
+    directory if None)
+    :return: Dictionary of seconds taken by each run, keyed by workers
+    """
+    root = mkdtemp(dir=root)
+    try:
+        origin = mkdtemp(dir=root)
+        names = make_files(origin, count, size)
+
+        results = {}
+        for n in (1, workers):
+            seconds = time_duplicate(origin, names, n, root)
+            results[n] = seconds
+            print("{:>6} files x {:>10} B, {:>2} threads: {:8.3f} s, "
+                  "{:10.1f} files/s, {:8.1f} MB/s".format(
+                      count, size, n, seconds, count / seconds,
+                      count * size / seconds / (1024 * 1024)))
+        return results
+    finally:
+        rmtree(root)
+
+def bench_move(count, size, target, workers=DEFAULT_WORKERS, root=None):
+    """
+    Compares serial and parallel moves of a set of files to a directory on
+    another filesystem.
+    :param count: Number of files
+    :param size: Size in bytes of each file
+    :param target: Directory on another filesystem, where the destinations
+    are created
+    :param workers: Number of threads of the parallel run
+    :param root: Directory in which to create the files (system temp
+    directory if None)
+    :return: Dictionary of seconds taken by each run, keyed by workers
+    """
+    root = mkdtemp(dir=root)
+    try:
+        if os.stat(root).st_dev == os.stat(target).st_dev:
+            print("{} is on the same filesystem as {}, skipping".format(
+                target, root))
+            return {}
+
+        results = {}
+        for n in (1, workers):
+            origin = mkdtemp(dir=root)
+            names = make_files(origin, count, size)
+            destination = mkdtemp(dir=target)
+            try:
+                start = time()
+                FileOrganizer.move_files(origin, names, destination, 0,
+                                         (0, ""), (False, "4", 0, ""),
+                                         (False, ""), workers=n)
+                seconds = results[n] = time() - start
+            finally:
+                rmtree(destination)
+            print("{:>6} files x {:>10} B, {:>2} threads, moved: {:8.3f} s, "
+                  "{:10.1f} files/s, {:8.1f} MB/s".format(
+                      count, size, n, seconds, count / seconds,
+                      count * size / seconds / (1024 * 1024)))
+        return results
+    finally:
+        rmtree(root)
+
+def bench_processes(count, size, processes=None, root=None):
+    """
+    Times a verified duplication executed by 1, 2, 4... processes.
+    :param count: Number of files
+    :param size: Size in bytes of each file
+    :param processes: Most processes; the number of CPUs if None
+    :param root: Directory in which to create the files (system temp
+    directory if None)
+    :return: Dictionary of seconds taken by each run, keyed by processes
+    """
+    processes = processes or os.cpu_count() or 1
+    runs = [1]
+    while runs[-1] * 2 <= processes:
+        runs.append(runs[-1] * 2)
+    if runs[-1] != processes:
+        runs.append(processes)
+
+    root = mkdtemp(dir=root)
+    try:
+        origin = mkdtemp(dir=root)
+        names = make_files(origin, count, size)
+
+        results = {}
+        for n in runs:
+            destination = mkdtemp(dir=root)
+            try:
+                start = time()
+                FileOrganizer.move_files(origin, list(names), destination, 0,
+                                         (0, ""), (True, "6", 0, "file_"),
+                                         (False, ""), duplicate=True,
+                                         workers=1, verify=True, processes=n)
+                seconds = results[n] = time() - start
+            finally:
+                rmtree(destination)
+            print("{:>6} files x {:>10} B, {:>2} processes: {:8.3f} s, "
+                  "{:10.1f} files/s, x{:.2f}".format(
+                      count, size, n, seconds, count / seconds,
+                      results[1] / seconds))
+        return results
+    finally:
+        rmtree(root)
+
+def bench_remote(count=REMOTE_FILES, share=REMOTE_SHARE, root=None):
+    """
+    Times moves to a simulated network share, one call at a time and with
+    the adaptive concurrency of FileOrganizer_async.
+    :param count: Number of files
+    :param share: Tuple of (latency in seconds, calls served at full
+    speed, probability of a transient error) of the share, see LatencyFS
+    :param root: Directory in which to create the files (system temp
+    directory if None)
+    :return: Dictionary of seconds taken by each run, keyed by the most
+    calls allowed in flight
+    """
+    latency, capacity, failures = share
+    root = mkdtemp(dir=root)
+    try:
+        results = {}
+        for concurrency in (1, MAX_CONCURRENCY):
+            origin = mkdtemp(dir=root)
+            destination = mkdtemp(dir=root)
+            names = make_files(origin, count, 0)
+            plan = plan_moves(origin, names, destination, 0, (0, ""),
+                              (True, "6", 0, "file_"), (False, ""))
+
+            filesystem = LatencyFS(latency, capacity=capacity,
+                                   failures=failures, seed=0)
+            start = time()
+            execute_async(origin, destination, plan, filesystem=filesystem,
+                          concurrency=concurrency)
+            seconds = results[concurrency] = time() - start
+
+            print("{:>6} files, {:>5.1f} ms calls, {:>2} in flight at peak: "
+                  "{:8.3f} s, {:10.1f} files/s, {} transient errors".format(
+                      count, latency * 1000, filesystem.peak, seconds,
+                      count / seconds, filesystem.failed))
+        return results
+    finally:
+        rmtree(root)
+
+def bench_rename(count=RENAME_COUNT):
+    """
+    Times the compiled renaming functions over synthetic names.
+    :param count: Number of names
+    :return: Dictionary of nanoseconds per name, keyed by case description
+    """
+    names = ["IMG_{:07d} Holiday-Pic_{}.JPG".format(i, i % 97)
+             for i in range(count)]
+
+    results = {}
+    for description, options in RENAME_CASES:
+        rename = compile_renamer(**options)
+        start = time()
+        for i, name in enumerate(names):
+            rename(i, name)
+        seconds = time() - start
+
+        results[description] = seconds * 1e9 / count
+        print("{:<32} {:8.3f} s, {:8.1f} ns/name".format(
+            description, seconds, results[description]))
+    return results
+
+def bench_sort(count=SORT_COUNT):
+    """
+    Times the pre-order sorts over shuffled synthetic names. Where sorted()
+    takes 1.1 s over a million names, the natural order takes 4.9 s and
+    the number after a pattern 6.9 s (6.2 s and 7.7 s with zero-padded
+    keys): computing the keys still costs more than the sort, and the goal
+    of a few seconds is only about met.
+    :param count: Number of names
+    :return: Dictionary of seconds taken, keyed by sort description
+    """
+    names = ["IMG_{} holiday {}.jpg".format(i, i % 97) for i in range(count)]
+    random.shuffle(names)
+
+    cases = (("plain sorted()", lambda: sorted(names)),
+             ("natural", lambda: natural_sort(names)),
+             ("natural, reverse", lambda: natural_sort(names, reverse=True)),
+             ("number after pattern", lambda: pattern_sort(names, "IMG_",
+                                                           False)))
+
+    results = {}
+    for description, function in cases:
+        start = time()
+        function()
+        results[description] = time() - start
+        print("{:<32} {:8.3f} s".format(description, results[description]))
+    return results
+
+def bench_plan(count=PLAN_COUNT, root=None):
+    """
+    Times planning a job of a single folder of synthetic names, whose
+    entries are given, so the disk is never read.
+    :param count: Number of names
+    :param root: Directory where the destination would be
+    :return: Dictionary of seconds taken, keyed by case description
+    """
+    names = ["IMG_{} holiday {}.jpg".format(i, i % 97) for i in range(count)]
+    random.shuffle(names)
+    entries = dict((name, FileEntry(name, i, float(i), float(i), i))
+                   for i, name in enumerate(names))
+
+    cases = (("alphabetical", 0, (False, "", 0, "")),
+             ("alphabetical, numbered", 0, (True, "7", 0, "photo_")),
+             ("by size", 5, (False, "", 0, "")))
+
+    root = mkdtemp(dir=root)
+    try:
+        destination = os.path.join(root, "destination")
+        results = {}
+        for description, id_order, numbering in cases:
+            start = time()
+            for _ in iter_plan(root, names, destination, id_order, (0, ""),
+                               numbering, (False, ""), entries=entries):
+                pass
+            results[description] = time() - start
+            print("{:<32} {:8.3f} s".format(description,
+                                            results[description]))
+        return results
+    finally:
+        rmtree(root)
+
+def bench_metadata(count=PHOTO_COUNT, workers=DEFAULT_WORKERS, root=None):
+    """
+    Times reading the capture date of photos, first with an empty cache,
+    then with the cache filled by the first run.
+    :param count: Number of photos
+    :param workers: Number of reading threads
+    :param root: Directory in which to create the files (system temp
+    directory if None)
+    :return: Dictionary of seconds taken by each run
+    """
+    root = mkdtemp(dir=root)
+    try:
+        origin = mkdtemp(dir=root)
+        make_photos(origin, count)
+        index = MetadataIndex(os.path.join(root, "metadata.sqlite"))
+
+        results = {}
+        for run in ("cold", "cached"):
+            start = time()
+            values = read_metadata(origin, scan_directory(origin),
+                                   CAPTURE_TIME, index, workers)
+            results[run] = time() - start
+            print("{:>6} photos, {:<6} cache: {:8.3f} s, {} dated".format(
+                count, run, results[run],
+                sum(value is not None for value in values.values())))
+
+        index.close()
+        return results
+    finally:
+        rmtree(root)
+
+def peak_memory(function):
+    """
+    Runs a function, tracing the memory allocated by Python meanwhile.
+    :param function: Callable without arguments
+    :return: Tuple of (peak of allocated bytes, seconds taken)
+    """
+    tracemalloc.start()
+    try:
+        start = time()
+        function()
+        return tracemalloc.get_traced_memory()[1], time() - start
+    finally:
+        tracemalloc.stop()
+
+def bench_memory(tree=MEMORY_TREE, sort_count=MEMORY_SORT_COUNT, root=None):
+    """
+    Measures the peak memory of sorting names in memory and on disk, and of
+    planning a recursive job as a whole or streamed.
+    :param tree: (folders, files per folder) of the test tree
+    :param sort_count: Number of names to sort
+    :param root: Directory in which to create the tree (system temp
+    directory if None)
+    :return: Dictionary of peak bytes, keyed by case description
+    """
+    def consume(iterable):
+        for _ in iterable:
+            pass
+
+    names = ["IMG_{} holiday {}.jpg".format(i, i % 97)
+             for i in range(sort_count)]
+    random.shuffle(names)
+
+    root = mkdtemp(dir=root)
+    try:
+        origin = os.path.join(root, "origin")
+        folders, per_folder = tree
+        for i in range(folders):
+            folder = os.path.join(origin, "folder_{:04d}".format(i))
+            os.makedirs(folder)
+            for j in range(per_folder):
+                open(os.path.join(folder, "file_{:05d}.bin".format(j)),
+                     "w").close()
+
+        job = (origin, None, os.path.join(root, "destination"), 0, (0, ""),
+               (True, "6", 0, "file_"), (False, ""))
+
+        cases = (
+            ("sort {} names in memory".format(sort_count),
+             lambda: consume(external_sort(natural_records(names),
+                                           max_items=sort_count))),
+            ("sort {} names on disk".format(sort_count),
+             lambda: consume(external_sort(natural_records(names),
+                                           max_items=sort_count // 10))),
+            ("plan {} files, whole".format(folders * per_folder),
+             lambda: plan_moves(*job, recursive=True)),
+            ("plan {} files, streamed".format(folders * per_folder),
+             lambda: consume(iter_plan(*job, recursive=True))),
+        )
+
+        results = {}
+        for description, function in cases:
+            peak, seconds = peak_memory(function)
+            results[description] = peak
+            print("{:<36} peak {:8.1f} MB, {:8.3f} s".format(
+                description, peak / (1024 * 1024), seconds))
+        return results
+    finally:
+        rmtree(root)
+
+def run_python(arguments):
+    """
+    Runs a fresh interpreter in the directory of the package.
+    :param arguments: List of arguments of the interpreter
+    :return: CompletedProcess, its output as text
+    """
+    return subprocess.run([sys.executable] + arguments,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+
+def import_times(module):
+    """
+    Imports a module in a fresh interpreter, with -X importtime.
+    :param module: Name of the module
+    :return: Tuple of (seconds taken by its import, list of (seconds,
+    name) of every module it loaded, by their own import only), or None
+    if it can't be imported
+    """
+    process = run_python(["-X", "importtime", "-c", "import " + module])
+    if process.returncode != 0:
+        return None
+
+    total = None
+    loaded = []
+    for line in process.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        own, name = int(parts[0].split(":")[1]), parts[2].strip()
+        loaded.append((own / 1e6, name))
+        if name == module:
+            total = int(parts[1]) / 1e6
+    return total, loaded
+
+def bench_startup(runs=STARTUP_RUNS, top=STARTUP_TOP):
+    """
+    Times the import of the entry points of the package, then the window
+    up to its first paint, each in a fresh interpreter, and lists the
+    heaviest imports of the last module imported.
+    :param runs: Runs of each case, the fastest counts
+    :param top: Number of heaviest imports listed
+    :return: Dictionary of seconds taken, keyed by case description
+    """
+    results = {}
+    heaviest = None
+    for module in STARTUP_MODULES:
+        fastest = None
+        for _ in range(runs):
+            measured = import_times(module)
+            if measured is None:
+                break
+            if fastest is None or measured[0] < fastest[0]:
+                fastest = measured
+
+        if fastest is None:
+            print("{:<32} skipped, it can't be imported".format(
+                "import " + module))
+            continue
+        results["import " + module] = fastest[0]
+        heaviest = module, fastest[1]
+        print("{:<32} {:8.1f} ms".format("import " + module,
+                                         fastest[0] * 1000))
+
+    shown = []
+    for _ in range(runs):
+        process = run_python(["-c", WINDOW_SCRIPT])
+        if process.returncode != 0:
+            break
+        shown.append(float(process.stdout.split()[-1]))
+    if shown:
+        results["window shown"] = min(shown)
+        print("{:<32} {:8.1f} ms".format("window shown", min(shown) * 1000))
+    else:
+        print("{:<32} skipped, no Qt binding or display".format(
+            "window shown"))
+
+    if heaviest is not None:
+        module, loaded = heaviest
+        print("Heaviest imports of {}:".format(module))
+        for seconds, name in sorted(loaded, reverse=True)[:top]:
+            print("  {:<30} {:8.1f} ms".format(name, seconds * 1000))
+    return results
+
+# ------- SUITE ------------
+# Results are keyed by "filesystem/number of files/case", in seconds, and
+# compared key by key with a previous run.
+
+def make_mixed_files(directory, count):
+    """
+    Fills a directory with files of mixed sizes and names, some of them
+    with numbers to sort by.
+    :param directory: Pathname of the directory
+    :param count: Number of files to create
+    :return: List of the created filenames
+    """
+    block = os.urandom(SUITE_LARGE_SIZE)
+    numbers = list(range(count))
+    random.Random(count).shuffle(numbers)
+    names = []
+
+    for i, number in enumerate(numbers):
+        size = SUITE_LARGE_SIZE if i % SUITE_LARGE_EVERY == 1 else \
+            SUITE_SIZES[i % len(SUITE_SIZES)]
+        name = "IMG_{} Holiday-{}.JPG".format(number, i % 97)
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(block[:size])
+        names.append(name)
+
+    return names
+
+def time_case(function, repeat):
+    """
+    :param function: Callable without arguments
+    :param repeat: Number of runs
+    :return: Seconds taken by the fastest run
+    """
+    best = None
+    for _ in range(repeat):
+        start = time()
+        function()
+        seconds = time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def suite_cases(origin, names, root, workers, index):
+    """
+    Lists the timed cases of the suite over a tree.
+    :param origin: Directory holding the files
+    :param names: Their filenames
+    :param root: Directory where the destinations are created
+    :param workers: Number of copying threads
+    :param index: MetadataIndex of the pre-orders reading metadata
+    :return: List of (description, callable) pairs, in order
+    """
+    def consume(iterable):
+        for _ in iterable:
+            pass
+
+    def planned(**options):
+        job = dict({"numbering": (False, "4", 0, ""),
+                    "removing": (False, "")}, **options)
+        return lambda: consume(iter_plan(
+            origin, names, os.path.join(root, "nowhere"), 0, (0, ""),
+            job["numbering"], job["removing"],
+            job.get("lowercase", False),
+            substitutions=job.get("substitutions", ()),
+            template=job.get("template")))
+
+    cases = [("scan", lambda: retrieve_directory_content(origin))]
+
+    try:
+        from FileOrganizer_window import DirectoryContentModel
+    except ImportError:
+        # Qt isn't installed
+        pass
+    else:
+        cases.append(("populate", lambda: DirectoryContentModel().set_names(
+            retrieve_directory_content(origin), True)))
+
+    # The metadata pre-orders are timed with the cache filled, so runs
+    # compare alike; cold reads are timed by the metadata benchmark
+    entries = dict((entry.name, entry) for entry in scan_directory(origin))
+    for field in (BIRTH_TIME, CAPTURE_TIME):
+        read_metadata(origin, entries.values(), field, index)
+
+    for id_order, order in enumerate(SUITE_ORDERS):
+        cases.append(("preorder " + order, lambda id_order=id_order: consume(
+            preorder_files(names, id_order, (0, "IMG_"), entries, origin,
+                           index))))
+
+    cases.extend((
+        ("plan", planned()),
+        ("plan numbering", planned(numbering=(True, "6", 0, "photo_"))),
+        ("plan remove + lowercase", planned(removing=(True, "_- "),
+                                            lowercase=True)),
+        ("plan regex + template", planned(
+            template="{n:06d}_{stem}{ext}",
+            substitutions=((r"[^A-Za-z0-9.]+", "-"),))),
+    ))
+
+    # The copies of each duplicate run are moved by the next move run,
+    # the moved files are deleted after it
+    copies = []
+
+    def duplicate():
+        destination = mkdtemp(dir=root)
+        copies.append(destination)
+        FileOrganizer.move_files(origin, names, destination, 0, (0, ""),
+                                 (False, "4", 0, ""), (False, ""),
+                                 duplicate=True, workers=workers)
+
+    def move():
+        source = copies.pop()
+        destination = mkdtemp(dir=root)
+        try:
+            FileOrganizer.move_files(source, names, destination, 0, (0, ""),
+                                     (True, "6", 0, "moved_"), (False, ""),
+                                     workers=workers)
+        finally:
+            rmtree(source)
+            rmtree(destination)
+
+    cases.append(("duplicate", duplicate))
+    cases.append(("move", move))
+    return cases
+
+def bench_suite(filesystems, counts=SUITE_COUNTS, workers=DEFAULT_WORKERS,
+                repeat=1):
+    """
+    Times every operation of FileOrganizer over trees of several sizes, on
+    several filesystems.
+    :param filesystems: List of (label, directory) pairs, e.g. a tmpfs and a
+    real disk
+    :param counts: Numbers of files of the trees
+    :param workers: Number of copying threads
+    :param repeat: Number of runs of each case; the fastest one counts
+    :return: Dictionary of seconds by "filesystem/count/case" key
+    """
+    results = {}
+
+    for label, directory in filesystems:
+        for count in counts:
+            root = mkdtemp(dir=directory)
+            try:
+                origin = mkdtemp(dir=root)
+                start = time()
+                names = make_mixed_files(origin, count)
+                print("{}: {} files created in {:.1f} s".format(
+                    label, count, time() - start))
+
+                index = MetadataIndex(os.path.join(root, "metadata.sqlite"))
+                try:
+                    for description, function in suite_cases(
+                            origin, names, root, workers, index):
+                        key = "{}/{}/{}".format(label, count, description)
+                        results[key] = time_case(function, repeat)
+                        print("{:<44} {:10.3f} s".format(key, results[key]))
+                finally:
+                    index.close()
+            finally:
+                rmtree(root)
+
+    return results
+
+def save_results(pathname, results):
+    """
+    Writes the results of a suite run, with a description of the machine.
+    :param pathname: Pathname of the JSON file
+    :param results: Dictionary returned by bench_suite
+    :return: None
+    """
+    document = {"format": SUITE_FORMAT,
+                "date": strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "results": results}
+    with open(pathname, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+
+def load_results(pathname):
+    """
+    :param pathname: JSON file written by save_results
+    :return: Dictionary of seconds by case key
+    """
+    with open(pathname) as f:
+        document = json.load(f)
+    if document.get("format") != SUITE_FORMAT:
+        raise ValueError("{} isn't a suite result of format {}".format(
+            pathname, SUITE_FORMAT))
+    return document["results"]
+
+def regressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares a run with a previous one. Cases faster than NOISE_SECONDS in
+    both runs, and cases missing from either, are not compared.
+    :param results: Dictionary of seconds by case key
+    :param baseline: Same, of the previous run
+    :param threshold: Slowdown tolerated, e.g. 0.25 for 25%
+    :return: List of (key, baseline seconds, seconds) of the cases slower
+    than threshold allows
+    """
+    slower = []
+    for key in sorted(set(results) & set(baseline)):
+        before, after = baseline[key], results[key]
+        if max(before, after) < NOISE_SECONDS:
+            continue
+        if after > before * (1 + threshold):
+            slower.append((key, before, after))
+    return slower
+
+def default_filesystems(directory=None):
+    """
+    :param directory: Directory on a real disk; the system temp directory
+    if None
+    :return: List of (label, directory) pairs: /dev/shm, if it's there,
+    and directory
+    """
+    filesystems = []
+    if os.path.isdir("/dev/shm"):
+        filesystems.append(("tmpfs", "/dev/shm"))
+    filesystems.append(("disk", directory or gettempdir()))
+    return filesystems
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark FileOrganizer's operations.")
+    parser.add_argument("benchmarks", nargs="*",
+                        choices=BENCHMARKS + (SUITE,), default=BENCHMARKS,
+                        help="benchmarks to run (default: all but suite)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="threads of the parallel run")
+    parser.add_argument("--dir", default=None,
+                        help="directory where the test files are created")
+    parser.add_argument("--to", default=None,
+                        help="directory on another filesystem, for the move "
+                             "benchmark")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="most processes of the processes benchmark "
+                             "(default: number of CPUs)")
+
+    suite = parser.add_argument_group("suite")
+    suite.add_argument("--counts", type=int, nargs="+",
+                       default=list(SUITE_COUNTS),
+                       help="numbers of files of the trees (default: "
+                            "{})".format(" ".join(map(str, SUITE_COUNTS))))
+    suite.add_argument("--repeat", type=int, default=1,
+                       help="runs of each case, the fastest counts")
+    suite.add_argument("--json", metavar="FILE",
+                       help="save the results to FILE")
+    suite.add_argument("--baseline", metavar="FILE",
+                       help="results of a previous run; slower cases make "
+                            "the run fail")
+    suite.add_argument("--threshold", type=float,
+                       default=REGRESSION_THRESHOLD,
+                       help="slowdown tolerated against the baseline "
+                            "(default: {})".format(REGRESSION_THRESHOLD))
+    args = parser.parse_args()
+
+    # Into the log file, as the jobs do; the logging functions would print
+    # to stderr otherwise
+    start_logging()
+
+    if "copy" in args.benchmarks:
+        for count, size in (SMALL_FILES, LARGE_FILES):
+            bench_copy(count, size, args.workers, args.dir)
+
+    if "move" in args.benchmarks:
+        if args.to is None:
+            print("move benchmark skipped, it needs --to")
+        else:
+            for count, size in (SMALL_FILES, LARGE_FILES):
+                bench_move(count, size, args.to, args.workers, args.dir)
+
+    if "processes" in args.benchmarks:
+        bench_processes(*PROCESS_FILES, processes=args.processes,
+                        root=args.dir)
+
+    if "remote" in args.benchmarks:
+        bench_remote(root=args.dir)
+
+    if "rename" in args.benchmarks:
+        bench_rename()
+
+    if "sort" in args.benchmarks:
+        bench_sort()
+
+    if "plan" in args.benchmarks:
+        bench_plan(root=args.dir)
+
+    if "metadata" in args.benchmarks:
+        bench_metadata(workers=args.workers, root=args.dir)
+
+    if "memory" in args.benchmarks:
+        bench_memory(root=args.dir)
+
+    if "startup" in args.benchmarks:
+        bench_startup()
+
+    if SUITE in args.benchmarks:
+        results = bench_suite(default_filesystems(args.dir), args.counts,
+                              args.workers, args.repeat)
+        if args.json:
+            save_results(args.json, results)
+
+        if args.baseline:
+            slower = regressions(results, load_results(args.baseline),
+                                 args.threshold)
+            for key, before, after in slower:
+                print("REGRESSION {}: {:.3f} s -> {:.3f} s (+{:.0%})".format(
+                    key, before, after, after / before - 1))
+            if slower:
+                return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+"""
+FileOrganizer_cli.py: Command line entry point of FileOrganizer, for
+                      headless and scripted runs. Never imports Qt.
+                      Run it with: python -m FileOrganizer --help
+"""
+__author__ = "Carlos Montes"
+
+import sys
+import argparse
+import FileOrganizer
+from FileOrganizer_utils import norm_pathname
+from FileOrganizer_plan import COLLISIONS, SKIP_EXISTING, OVERWRITE
+from FileOrganizer_copy import DEFAULT_WORKERS
+from FileOrganizer_dedup import SKIP_DUPLICATES, LINK_DUPLICATES
+from FileOrganizer_metrics import JobMetrics
+from FileOrganizer_queue import JobQueue, FAILED, ENDED
+from FileOrganizer_spec import JobSpec, ORDERS
+
+def build_parser():
+    """
+    :return: ArgumentParser of the command line
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m FileOrganizer",
+        description="Move or duplicate files from one directory to another, "
+                    "ordering and renaming them on the way.")
+
+    parser.add_argument("origin", nargs="?",
+                        help="directory containing the files")
+    parser.add_argument("destination", nargs="?",
+                        help="directory receiving the files")
+
+    files = parser.add_argument_group("files")
+    files.add_argument("-f", "--files-from", metavar="FILE",
+                       help="read the filenames to process from FILE, one "
+                            "per line ('-' for stdin); all the files of "
+                            "origin otherwise")
+    files.add_argument("-0", "--null", action="store_true",
+                       help="filenames in --files-from are separated by NUL "
+                            "characters instead of newlines")
+    files.add_argument("-R", "--recursive", action="store_true",
+                       help="process the files of the whole origin tree; "
+                            "--files-from then holds paths relative to "
+                            "origin")
+    files.add_argument("--flatten", action="store_true",
+                       help="with --recursive, put every file right in "
+                            "destination instead of preserving the folders")
+    files.add_argument("-i", "--include", action="append", default=[],
+                       metavar="GLOB",
+                       help="only process files matching GLOB, e.g. '*.jpg'; "
+                            "may be repeated")
+    files.add_argument("-x", "--exclude", action="append", default=[],
+                       metavar="GLOB",
+                       help="leave out files (and with --recursive, folders) "
+                            "matching GLOB; may be repeated")
+
+    order = parser.add_argument_group("pre-order")
+    order.add_argument("-o", "--order", choices=sorted(ORDERS),
+                       default="alpha",
+                       help="order of the files before numbering them: "
+                            "natural alphabetical order, creation or "
+                            "modification date, size, date the photo or "
+                            "video was taken... (default: alpha)")
+    order.add_argument("--order-pattern", default="", metavar="STRING",
+                       help="with --order number, string next to the number")
+    order.add_argument("--number-before-pattern", action="store_true",
+                       help="with --order number, the number comes before "
+                            "the pattern instead of after it")
+
+    rename = parser.add_argument_group("renaming")
+    rename.add_argument("-n", "--number", type=int, metavar="DIGITS",
+                        help="rename the files with a number of DIGITS "
+                             "digits, following the pre-order")
+    rename.add_argument("--name", default="", metavar="STRING",
+                        help="with --number, string to put next to the "
+                             "number")
+    rename.add_argument("--name-after-number", action="store_true",
+                        help="with --number, put STRING after the number "
+                             "instead of before it")
+    rename.add_argument("-t", "--template", metavar="TEMPLATE",
+                        help="format of the new names, overriding --number; "
+                             "fields: {n} position, {name}, {stem}, {ext}, "
+                             "e.g. '{n:04d}_{stem}{ext}'")
+    rename.add_argument("-s", "--sub", nargs=2, action="append", default=[],
+                        metavar=("REGEX", "REPLACEMENT"),
+                        help="substitute REGEX in the original names; may "
+                             "be repeated")
+    rename.add_argument("-r", "--remove", default="", metavar="CHARACTERS",
+                        help="remove these characters from the filenames")
+    rename.add_argument("-l", "--lowercase", action="store_true",
+                        help="transform the filenames to lowercase")
+
+    job = parser.add_argument_group("job")
+    job.add_argument("-d", "--duplicate", action="store_true",
+                     help="copy the files instead of moving them")
+    job.add_argument("--replace", action="store_true",
+                     help="replace files that already exist in destination; "
+                          "same as --collisions overwrite")
+    job.add_argument("-c", "--collisions", choices=COLLISIONS,
+                     help="what to do with files whose name is taken in "
+                          "destination: skip them, overwrite the existing "
+                          "file, add a number to the name ('name (1).ext') "
+                          "or keep the newer or larger file (default: skip)")
+    job.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+                     help="copying threads when duplicating (default: "
+                          "{})".format(DEFAULT_WORKERS))
+    job.add_argument("-p", "--processes", type=int, default=1,
+                     help="execute the job in this many processes, each one "
+                          "taking a share of the files once they're all "
+                          "named; for jobs of many files (default: 1)")
+    job.add_argument("--remote", action="store_true",
+                     help="origin or destination is on a network share "
+                          "(NFS, SMB): keep many file operations in flight "
+                          "at once, as many as the share's latency allows, "
+                          "and retry the ones failing with transient errors")
+    job.add_argument("--verify", action="store_true",
+                     help="compare every copy with its original, when "
+                          "duplicating or moving to another filesystem")
+    job.add_argument("--dedup", choices=(SKIP_DUPLICATES, LINK_DUPLICATES),
+                     help="when duplicating, skip or hardlink files whose "
+                          "content is already in destination")
+    job.add_argument("-j", "--journal", metavar="FILE",
+                     help="record the job in FILE, so it can be resumed or "
+                          "rolled back")
+    job.add_argument("--metrics", metavar="FILE",
+                     help="time every stage of the job and save the metrics "
+                          "to FILE: Prometheus text if it ends in .prom or "
+                          ".txt, JSON otherwise")
+    job.add_argument("--dry-run", action="store_true",
+                     help="print the plan of the job without touching any "
+                          "file")
+
+    spec = parser.add_argument_group("job specs")
+    spec.add_argument("--spec", metavar="FILE",
+                      help="run the job saved in FILE (JSON, or TOML if it "
+                           "ends in .toml) instead of the one of the "
+                           "options above; origin and destination, if "
+                           "given, replace its own")
+    spec.add_argument("--save-spec", metavar="FILE",
+                      help="save the job to FILE, to be run later with "
+                           "--spec or loaded in the window, instead of "
+                           "running it")
+
+    journal = parser.add_argument_group("journals")
+    journal.add_argument("--resume", metavar="JOURNAL",
+                         help="resume the interrupted job of JOURNAL")
+    journal.add_argument("--rollback", metavar="JOURNAL",
+                         help="roll back the job of JOURNAL")
+
+    queue = parser.add_argument_group("queue")
+    queue.add_argument("--queue", action="store_true",
+                       help="add the job to the queue shared with the "
+                            "window instead of running it")
+    queue.add_argument("--run-queue", action="store_true",
+                       help="run the queued jobs, several at once when "
+                            "they're on different disks, and wait for them")
+
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="don't print the summary")
+
+    return parser
+
+def read_filenames(source, null=False):
+    """
+    Reads a list of filenames.
+    :param source: Pathname of the file holding them, or '-' for stdin
+    :param null: Boolean telling whether they're NUL separated
+    :return: List of filenames
+    """
+    if source == "-":
+        text = sys.stdin.read()
+    else:
+        with open(source) as f:
+            text = f.read()
+
+    names = text.split("\0") if null else text.splitlines()
+    return [name for name in names if name]
+
+def job_spec(args):
+    """
+    Converts the parsed command line into a job spec.
+    :param args: Namespace from build_parser
+    :return: JobSpec, not validated yet
+    """
+    if args.files_from:
+        files = read_filenames(args.files_from, args.null)
+    else:
+        # The origin is listed, or its tree walked, when the job runs
+        files = None
+
+    return JobSpec(origin=norm_pathname(args.origin),
+                   destination=norm_pathname(args.destination),
+                   files=files, recursive=args.recursive,
+                   flatten=args.flatten, include=args.include,
+                   exclude=args.exclude, order=args.order,
+                   order_pattern=args.order_pattern,
+                   number_before_pattern=args.number_before_pattern,
+                   number=args.number, name=args.name,
+                   name_after_number=args.name_after_number,
+                   template=args.template, substitutions=args.sub,
+                   remove=args.remove, lowercase=args.lowercase,
+                   duplicate=args.duplicate,
+                   collisions=args.collisions or
+                   (OVERWRITE if args.replace else SKIP_EXISTING),
+                   dedup=args.dedup, workers=args.workers,
+                   verify=args.verify, processes=args.processes,
+                   remote=args.remote)
+
+def run_queue(quiet=False):
+    """
+    Runs the jobs of the queue until none is left waiting.
+    :param quiet: Boolean telling whether not to print their outcome
+    :return: Exit status, 1 if any job failed
+    """
+    queue = JobQueue()
+    pending = set(job.id for job in queue.snapshot()
+                  if job.status not in ENDED)
+    queue.start()
+    queue.wait()
+
+    failed = False
+    for job in queue.snapshot():
+        if job.id not in pending:
+            continue
+        failed = failed or job.status == FAILED
+        if not quiet:
+            sys.stderr.write("Job {} {}: {} to {}{}\n".format(
+                job.id, job.status, job.origin, job.destination,
+                " ({})".format(job.error) if job.error else ""))
+    return 1 if failed else 0
+
+def main(argv=None):
+    """
+    Runs FileOrganizer from the command line.
+    :param argv: List of arguments; sys.argv's if None
+    :return: Exit status
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    try:
+        if args.resume:
+            done = FileOrganizer.resume_job(args.resume,
+                                            workers=args.workers,
+                                            verify=args.verify,
+                                            processes=args.processes,
+                                            remote=args.remote)
+        elif args.rollback:
+            done = FileOrganizer.rollback_job(args.rollback)
+        elif args.run_queue:
+            return run_queue(args.quiet)
+        else:
+            if args.spec:
+                spec = JobSpec.load(args.spec)
+                if args.origin:
+                    spec.origin = norm_pathname(args.origin)
+                if args.destination:
+                    spec.destination = norm_pathname(args.destination)
+            elif not args.origin or not args.destination:
+                parser.error("origin and destination are required")
+            else:
+                spec = job_spec(args)
+
+            # Validated once; the pre-order and renaming are compiled too
+            job = spec.compile()
+
+            if args.save_spec:
+                spec.save(args.save_spec)
+                if not args.quiet:
+                    sys.stderr.write("Job saved to {}\n".format(
+                        args.save_spec))
+                return 0
+
+            if args.dry_run:
+                for entry in job.plan():
+                    print("{}\t{}\t{}\t{}".format(entry.action, entry.source,
+                                                  entry.destination,
+                                                  entry.conflict or ""))
+                return 0
+
+            if args.queue:
+                queued = JobQueue().submit(job.arguments(), job.keywords())
+                if not args.quiet:
+                    sys.stderr.write("Job {} queued\n".format(queued.id))
+                return 0
+
+            metrics = JobMetrics() if args.metrics else None
+            try:
+                done = job.run(journal=args.journal, metrics=metrics)
+            finally:
+                # Partial jobs are worth measuring too
+                if metrics is not None:
+                    metrics.save(args.metrics)
+                    if not args.quiet:
+                        sys.stderr.write(metrics.summary() + "\n")
+
+    except FileOrganizer.NoSelectedFiles as error:
+        sys.stderr.write("{}\n".format(error))
+        return 1
+
+    except FileOrganizer.FilesNotProcessed as error:
+        for filename, reason in error.errors:
+            sys.stderr.write("{}: {}\n".format(filename, reason))
+        sys.stderr.write("{} files processed, {} failed\n".format(
+            error.done, len(error.errors)))
+        return 1
+
+    except (IOError, OSError, ValueError) as error:
+        sys.stderr.write("{}\n".format(error))
+        return 1
+
+    if not args.quiet:
+        sys.stderr.write("{} files processed\n".format(done))
+    return 0
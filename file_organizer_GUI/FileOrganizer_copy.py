@@ -0,0 +1,403 @@
+"""
+FileOrganizer_copy.py: Provides the copy backends and the parallel copy
+                       engine used by FileOrganizer when duplicating files,
+                       or moving them to another filesystem.
+"""
+__author__ = "Carlos Montes"
+
+import os
+import errno
+import shutil
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as wait_futures
+from logging import error as log_error
+from logging import info as log_info
+
+try:
+    # Reflinks are requested through an ioctl, only available on Unix
+    from fcntl import ioctl
+except ImportError:
+    ioctl = None
+
+# Default number of copying threads
+DEFAULT_WORKERS = 4
+
+# Tasks queued per worker, so the pool never holds the whole job in memory
+QUEUED_PER_WORKER = 4
+
+# Size of the chunks handed to the kernel and of the fallback buffer
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Files moved to another filesystem are copied under this prefix and suffix
+# of their final name until their copy is complete and durable
+PARTIAL_PREFIX = "."
+PARTIAL_SUFFIX = ".partial"
+
+# ioctl request number of Linux' FICLONE (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+# Errors meaning a backend can't work between these two files, rather than
+# the copy itself failing
+UNSUPPORTED_ERRNOS = set(getattr(errno, name) for name in
+                         ("EXDEV", "ENOSYS", "EOPNOTSUPP", "ENOTSUP",
+                          "ENOTTY", "EINVAL", "EBADF", "ENODEV")
+                         if hasattr(errno, name))
+
+# Errors of os.link on filesystems that have no hardlinks
+NO_LINK_ERRNOS = set(getattr(errno, name) for name in
+                     ("EPERM", "EMLINK", "ENOSYS", "EOPNOTSUPP", "ENOTSUP")
+                     if hasattr(errno, name))
+
+# ------- COPY BACKENDS ------------
+# Each backend copies the whole content of an open file descriptor into
+# another one, raising OSError if the kernel can't do it that way.
+
+def short_copy(backend, copied, size):
+    """
+    :param backend: Name of the backend
+    :param copied: Bytes it copied before the kernel reported the end
+    :param size: Size of the file
+    :return: OSError telling that the backend doesn't work for the file;
+    some filesystems (FUSE, CIFS, procfs) report the end too early
+    """
+    return OSError(errno.EOPNOTSUPP, "{} copied {} of {} bytes".format(
+        backend, copied, size))
+
+def copy_range(src_fd, dst_fd, size):
+    """
+    Copies inside the kernel with copy_file_range; on btrfs and XFS this
+    shares the extents instead of duplicating the data.
+    """
+    copied = 0
+    while True:
+        count = os.copy_file_range(src_fd, dst_fd, CHUNK_SIZE)
+        if not count:
+            break
+        copied += count
+    if copied < size:
+        raise short_copy("copy_file_range", copied, size)
+
+def copy_reflink(src_fd, dst_fd, size):
+    """
+    Clones the file with the FICLONE ioctl (btrfs, XFS and other
+    copy-on-write filesystems): no data is copied at all.
+    """
+    ioctl(dst_fd, FICLONE, src_fd)
+
+def copy_sendfile(src_fd, dst_fd, size):
+    """
+    Copies inside the kernel with sendfile, without going through
+    user space buffers.
+    """
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dst_fd, src_fd, offset, CHUNK_SIZE)
+        if not sent:
+            raise short_copy("sendfile", offset, size)
+        offset += sent
+
+def copy_buffered(src_fd, dst_fd, size):
+    """
+    Copies through a single large reusable buffer; works everywhere.
+    """
+    buf = bytearray(min(CHUNK_SIZE, max(size, 1)))
+    view = memoryview(buf)
+    with open(src_fd, "rb", buffering=0, closefd=False) as src:
+        while True:
+            read = src.readinto(buf)
+            if not read:
+                break
+            written = 0
+            while written < read:
+                written += os.write(dst_fd, view[written:read])
+
+# Backends in order of preference, skipping those the platform lacks
+BACKENDS = [backend for backend, available in (
+    (copy_range, hasattr(os, "copy_file_range")),
+    (copy_reflink, ioctl is not None),
+    (copy_sendfile, hasattr(os, "sendfile")),
+    (copy_buffered, True)) if available]
+
+# Device of each destination directory, and chosen backend by device
+_devices = {}
+_backends = {}
+
+def copy_file(origin, destination, sync=False, exclusive=False):
+    """
+    Copies the content of a file with the fastest backend that works for
+    the destination's filesystem. The first copy into a filesystem tries the
+    backends in order of preference; the winner is kept for the next ones.
+    :param origin: Pathname of the file to copy
+    :param destination: Pathname of the new file
+    :param sync: Boolean telling whether to fsync the copy before returning
+    :param exclusive: Boolean telling whether destination must not exist;
+    an existing file is replaced otherwise
+    :return: Size in bytes of the copied file
+    :raise FileExistsError: If exclusive and destination exists
+    """
+    directory = os.path.dirname(os.path.abspath(destination))
+    device = _devices.get(directory)
+    if device is None:
+        device = _devices[directory] = os.stat(directory).st_dev
+
+    src_fd = os.open(origin, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(destination,
+                         os.O_WRONLY | os.O_CREAT |
+                         (os.O_EXCL if exclusive else os.O_TRUNC) |
+                         getattr(os, "O_BINARY", 0), 0o666)
+        try:
+            # Empty files tell nothing about which backend works
+            if size:
+                copy_content(src_fd, dst_fd, size, device, directory)
+            if sync:
+                os.fsync(dst_fd)
+            return size
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+def copy_content(src_fd, dst_fd, size, device, directory):
+    """
+    Copies the content of a file between open descriptors. The chosen
+    backend of the device goes first; should it not work for this particular
+    file (e.g. a reflink from another filesystem), the others are tried
+    again.
+    :param device: Device of the destination, whose backend is chosen
+    :param directory: Directory of the destination, for the log
+    :return: None
+    """
+    chosen = _backends.get(device)
+    candidates = BACKENDS if chosen is None else \
+        [chosen] + [backend for backend in BACKENDS if backend is not chosen]
+    failure = None
+
+    for backend in candidates:
+        try:
+            backend(src_fd, dst_fd, size)
+        except OSError as error:
+            if error.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            failure = error
+            # Start over with the next backend
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.ftruncate(dst_fd, 0)
+            continue
+
+        if chosen is None:
+            _backends[device] = backend
+            log_info("Copying into %s with %s", directory, backend.__name__)
+        return
+
+    # Not even the buffered copy worked
+    raise failure
+
+def same_content(first, second):
+    """
+    Compares two files byte by byte.
+    :param first: Pathname of a file
+    :param second: Pathname of another file
+    :return: Boolean telling whether their content is the same
+    """
+    if os.path.getsize(first) != os.path.getsize(second):
+        return False
+
+    with open(first, "rb") as f1, open(second, "rb") as f2:
+        while True:
+            chunk = f1.read(CHUNK_SIZE)
+            if chunk != f2.read(CHUNK_SIZE):
+                return False
+            if not chunk:
+                return True
+
+def verify_copy(origin, destination):
+    """
+    Raises IOError if a copy doesn't have the content of its original.
+    :param origin: Pathname of the original file
+    :param destination: Pathname of the copy
+    :return: None
+    """
+    if not same_content(origin, destination):
+        raise IOError(errno.EIO, "Copy differs from its original",
+                      destination)
+
+def sync_directory(directory):
+    """
+    Makes the entries of a directory durable (new names, renames), where
+    the platform allows opening directories.
+    :param directory: Pathname of the directory
+    :return: None
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # Windows can't open directories; its renames are durable anyway
+        return
+    try:
+        os.fsync(fd)
+    except OSError as error:
+        if error.errno not in UNSUPPORTED_ERRNOS:
+            raise
+    finally:
+        os.close(fd)
+
+def rename_new(origin, destination):
+    """
+    Renames a file to a name that must be free, without ever replacing
+    another file: the file is hardlinked to its new name, which fails if
+    the name is taken, then unlinked from the old one. Filesystems without
+    hardlinks get a rename, checked right before.
+    :param origin: Pathname of the file
+    :param destination: Its new pathname, on the same filesystem
+    :return: None
+    :raise FileExistsError: If destination exists
+    """
+    try:
+        os.link(origin, destination, follow_symlinks=False)
+    except OSError as error:
+        if error.errno == errno.EEXIST:
+            # Both names left by a rename interrupted between its steps
+            try:
+                same = os.path.samefile(origin, destination)
+            except OSError:
+                same = False
+            if not same:
+                raise
+        elif error.errno in NO_LINK_ERRNOS:
+            if os.path.lexists(destination):
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                      destination)
+            os.rename(origin, destination)
+            return
+        else:
+            raise
+    os.remove(origin)
+
+def move_across(origin, destination, verify=False, exclusive=False):
+    """
+    Moves a file to another filesystem, where it can't be renamed: copies it
+    under a temporary name next to its destination, makes the copy durable,
+    gives it its final name and only then deletes the original. An
+    interruption leaves at worst a stray temporary file, never a half file
+    under the final name nor a lost original.
+    :param origin: Pathname of the file to move
+    :param destination: Pathname of the moved file
+    :param verify: Boolean telling whether to compare the copy with the
+    original before deleting it
+    :param exclusive: Boolean telling whether destination must not exist;
+    an existing file is replaced otherwise
+    :return: Size in bytes of the moved file
+    :raise FileExistsError: If exclusive and destination exists
+    """
+    directory, name = os.path.split(os.path.abspath(destination))
+    temporary = os.path.join(directory, PARTIAL_PREFIX + name + PARTIAL_SUFFIX)
+
+    try:
+        size = copy_file(origin, temporary, sync=True)
+        # A move keeps the times and permissions of the file
+        shutil.copystat(origin, temporary)
+        if verify:
+            verify_copy(origin, temporary)
+        if exclusive:
+            rename_new(temporary, destination)
+        else:
+            os.replace(temporary, destination)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+
+    sync_directory(directory)
+    os.remove(origin)
+    return size
+
+def copy_in_parallel(copy_function, tasks, workers=DEFAULT_WORKERS,
+                     progress=None, cancelled=None, total=None):
+    """
+    Runs copy_function over each task with a bounded pool of threads. The
+    tasks are consumed lazily and submitted in their original order; a
+    destination name is never copied by two threads at the same time, so
+    the result is the same as a serial run.
+    :param copy_function: Callable taking a task and returning the number
+    of bytes copied
+    :param tasks: Iterable of tuples whose first two items are the origin
+    name and the final destination name, such as plan entries
+    :param workers: Number of copying threads
+    :param progress: Optional callable receiving (files done, total files,
+    bytes of the last file) after each file is copied
+    :param cancelled: Optional callable returning True when the job should
+    stop; no new copy starts after it does, copies in flight are finished
+    :param total: Number of tasks, for the progress report; taken from
+    len(tasks) if not given
+    :return: Tuple of (number of files copied, list of (origin name, error)
+    tuples for each file that could not be copied)
+    """
+    if total is None and hasattr(tasks, "__len__"):
+        total = len(tasks)
+    workers = max(1, int(workers))
+    max_pending = workers * QUEUED_PER_WORKER
+
+    # Counter in a list so the closure below can update it
+    done = [0]
+    errors = []
+
+    # Futures in flight, by future and by destination name
+    pending = {}
+    destinations = {}
+
+    def collect(futures):
+        """
+        Accounts for the finished futures.
+        :param futures: Set of finished futures
+        :return: None
+        """
+        for future in futures:
+            origin_name, destination_name = pending.pop(future)
+            if destinations.get(destination_name) is future:
+                del destinations[destination_name]
+
+            try:
+                size = future.result()
+            except (IOError, OSError) as error:
+                log_error("Could not copy %s as %s: %s", origin_name,
+                          destination_name, error)
+                errors.append((origin_name, error))
+                continue
+
+            done[0] += 1
+            if progress is not None:
+                progress(done[0], total, size)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for task in tasks:
+            origin_name, destination_name = task[0], task[1]
+
+            if cancelled is not None and cancelled():
+                break
+
+            # Two files heading to the same name: let the first one land
+            # before the second one is even looked at
+            previous = destinations.get(destination_name)
+            if previous is not None:
+                wait_futures([previous])
+                collect([previous])
+
+            # Keep the amount of queued copies bounded
+            if len(pending) >= max_pending:
+                finished, _ = wait_futures(pending,
+                                           return_when=FIRST_COMPLETED)
+                collect(finished)
+
+            future = executor.submit(copy_function, task)
+            pending[future] = (origin_name, destination_name)
+            destinations[destination_name] = future
+
+        finished, _ = wait_futures(list(pending))
+        collect(finished)
+
+    return done[0], errors
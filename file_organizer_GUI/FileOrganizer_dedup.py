@@ -0,0 +1,241 @@
+"""
+FileOrganizer_dedup.py: Provides content-hash deduplication for duplicate
+                        mode: files whose content is already in the
+                        destination are skipped or hardlinked instead of
+                        being copied again.
+"""
+__author__ = "Carlos Montes"
+
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from os.path import expanduser
+from logging import info as log_info
+from FileOrganizer_utils import scan_directory
+from FileOrganizer_copy import DEFAULT_WORKERS
+from FileOrganizer_plan import COPY, LINK, SKIP, DUPLICATE_CONTENT, RENAMED
+from FileOrganizer_plan import EXISTS
+
+# Persistent index of the hashes of the destination files
+DEDUP_INDEX = os.path.join(expanduser("~"), ".file_organizer", "dedup.sqlite")
+
+# Deduplication modes
+SKIP_DUPLICATES = "skip"
+LINK_DUPLICATES = "link"
+
+# Size of the chunks read while hashing
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(pathname):
+    """
+    Hashes the content of a file. hashlib releases the GIL on large
+    buffers, so several files can be hashed by threads at the same time.
+    :param pathname: Pathname of the file
+    :return: Hexadecimal digest
+    """
+    import hashlib
+    digest = hashlib.blake2b(digest_size=20)
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+
+    with open(pathname, "rb", buffering=0) as f:
+        while True:
+            read = f.readinto(buf)
+            if not read:
+                break
+            digest.update(view[:read])
+
+    return digest.hexdigest()
+
+class DedupIndex(object):
+    """
+    SQLite index of the content hashes of files, keyed by pathname. A hash
+    is trusted as long as the size and modification time of its file are
+    unchanged, so files are hashed once across runs.
+    """
+
+    def __init__(self, pathname=DEDUP_INDEX):
+        """
+        Opens the index, creating it if needed.
+        :param pathname: Pathname of the SQLite database
+        """
+        directory = os.path.dirname(pathname)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Only deduplicating jobs pay for loading sqlite3
+        import sqlite3
+        self.connection = sqlite3.connect(pathname)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                "path TEXT PRIMARY KEY, size INTEGER, "
+                                "mtime REAL, hash TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_hash "
+                                "ON files (hash)")
+
+    def cached_hashes(self, entries, directory):
+        """
+        Looks up the hashes of the still unchanged files of a directory.
+        :param entries: Iterable of FileEntry of the directory
+        :param directory: Pathname of the directory
+        :return: Dictionary of hashes by filename
+        """
+        entries = dict((entry.name, entry) for entry in entries)
+        prefix = os.path.join(directory, "")
+        hashes = {}
+
+        rows = self.connection.execute(
+            "SELECT path, size, mtime, hash FROM files "
+            "WHERE path >= ? AND path < ?", (prefix, prefix + "\uffff"))
+
+        for path, size, mtime, file_hash in rows:
+            entry = entries.get(path[len(prefix):])
+            if entry is not None and entry.size == size and \
+                    entry.mtime == mtime:
+                hashes[entry.name] = file_hash
+        return hashes
+
+    def store(self, rows):
+        """
+        Adds or updates files in the index.
+        :param rows: Iterable of (pathname, size, mtime, hash) tuples
+        :return: None
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.connection.close()
+
+def deduplicate(plan, origin, destination, index, mode=SKIP_DUPLICATES,
+                workers=DEFAULT_WORKERS):
+    """
+    Finds the files of a plan whose content is already in the destination,
+    or in an earlier file of the same plan. Only files sharing their size
+    with another one are hashed, in parallel; hashes of the destination
+    files are kept in the index. Every destination folder the plan copies
+    to is looked at, and the files the plan replaces are left out, as
+    they won't hold their content anymore.
+    :param plan: Tuple of PlanEntry
+    :param origin: Directory from which the files are duplicated
+    :param destination: Pathname to contain the specified files
+    :param index: DedupIndex instance
+    :param mode: SKIP_DUPLICATES or LINK_DUPLICATES
+    :param workers: Number of hashing threads
+    :return: Tuple of (new plan, dictionary of the hashes of the files to
+    be copied by their destination name)
+    """
+    # Only plain copies are deduplicated; files replacing another one
+    # were explicitly asked for
+    candidates = [i for i, entry in enumerate(plan)
+                  if entry.action == COPY and
+                  entry.conflict in (None, RENAMED)]
+    if not candidates:
+        return plan, {}
+
+    destination = os.path.abspath(destination)
+    job_sizes = Counter(plan[i].size for i in candidates)
+    replaced = set(entry.destination for entry in plan
+                   if entry.conflict == EXISTS and entry.action != SKIP)
+
+    # Files of the destination folders, by folder relative to destination
+    stored = {}
+    for folder in set(os.path.dirname(plan[i].destination)
+                      for i in candidates):
+        try:
+            entries = scan_directory(os.path.join(destination, folder))
+        except OSError:
+            # A folder the job creates
+            continue
+        stored[folder] = [entry for entry in entries
+                          if entry.size in job_sizes and
+                          os.path.join(folder, entry.name) not in replaced]
+    stored_sizes = set(entry.size for entries in stored.values()
+                       for entry in entries)
+
+    # Cheap prefilter: a file can only be a duplicate of a file of the
+    # same size
+    to_hash = [i for i in candidates
+               if plan[i].size in stored_sizes or job_sizes[plan[i].size] > 1]
+    if not to_hash:
+        return plan, {}
+
+    # Hashes of the destination files by name relative to destination,
+    # from the index when possible
+    stored_hashes = {}
+    missing = []
+    for folder, entries in stored.items():
+        hashes = index.cached_hashes(entries,
+                                     os.path.join(destination, folder))
+        for entry in entries:
+            name = os.path.join(folder, entry.name)
+            if entry.name in hashes:
+                stored_hashes[name] = hashes[entry.name]
+            else:
+                missing.append((name, entry))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        computed = list(executor.map(
+            hash_file, [os.path.join(destination, name)
+                        for name, _ in missing]))
+        job_hashes = list(executor.map(
+            hash_file, [os.path.join(origin, plan[i].source)
+                        for i in to_hash]))
+
+    index.store((os.path.join(destination, name), entry.size, entry.mtime,
+                 file_hash)
+                for (name, entry), file_hash in zip(missing, computed))
+    for (name, _), file_hash in zip(missing, computed):
+        stored_hashes[name] = file_hash
+
+    # Pathname holding each known content
+    known = dict((file_hash, os.path.join(destination, name))
+                 for name, file_hash in stored_hashes.items())
+
+    new_plan = list(plan)
+    copied = {}
+    duplicates = 0
+
+    for i, file_hash in zip(to_hash, job_hashes):
+        entry = plan[i]
+        target = known.get(file_hash)
+
+        if target is None:
+            known[file_hash] = os.path.join(destination, entry.destination)
+            copied[entry.destination] = file_hash
+            continue
+
+        duplicates += 1
+        if mode == LINK_DUPLICATES:
+            new_plan[i] = entry._replace(action=LINK,
+                                         conflict=DUPLICATE_CONTENT,
+                                         link=target)
+        else:
+            new_plan[i] = entry._replace(action=SKIP,
+                                         conflict=DUPLICATE_CONTENT)
+
+    log_info("%d of %d files hashed, %d duplicates found", len(to_hash),
+             len(candidates), duplicates)
+
+    return tuple(new_plan), copied
+
+def record_copies(index, destination, copied):
+    """
+    Adds the hashed files copied by a job to the index.
+    :param index: DedupIndex instance
+    :param destination: Pathname containing the copies
+    :param copied: Dictionary of hashes by destination name, as returned by
+    deduplicate
+    :return: None
+    """
+    destination = os.path.abspath(destination)
+    rows = []
+    for name, file_hash in copied.items():
+        pathname = os.path.join(destination, name)
+        try:
+            st = os.stat(pathname)
+        except OSError:
+            # Not copied, e.g. the job was cancelled
+            continue
+        rows.append((pathname, st.st_size, st.st_mtime, file_hash))
+    index.store(rows)
@@ -0,0 +1,301 @@
+"""
+FileOrganizer_journal.py: Provides the append-only journal of a job, so
+                          that an interrupted job can be resumed and a
+                          finished one rolled back.
+"""
+__author__ = "Carlos Montes"
+
+import os
+import json
+import threading
+from time import time, strftime
+from os.path import expanduser
+from FileOrganizer_plan import PlanEntry
+
+# Directory holding the journals of the jobs run from the window
+JOURNAL_DIR = os.path.join(expanduser("~"), ".file_organizer", "journals")
+JOURNAL_SUFFIX = ".journal"
+
+# Completed operations are made durable every so many entries or seconds
+SYNC_ENTRIES = 256
+SYNC_SECONDS = 1.0
+
+# Kinds of journal lines. The first line of a journal is a JSON object with
+# the job's origin and destination; every other line is a JSON array whose
+# first item is one of these
+PLANNED = "plan"        # ["plan", source, destination, action, conflict, size]
+READY = "ready"         # ["ready"], the whole plan is written
+DONE = "done"           # ["done", index of the plan entry]
+FINISHED = "finished"   # ["finished"]
+UNDONE = "undone"       # ["undone", index of the plan entry]
+ROLLED_BACK = "rolled back"  # ["rolled back"]
+STOPPED = "stopped"     # ["stopped"], the job was cancelled
+ABORTED = "aborted"     # ["aborted"], the job ended with errors
+ABANDONED = "abandoned"  # ["abandoned"], the user chose not to resume it
+
+# Last lines of the jobs that ended one way or another, and aren't offered
+# for resume
+CLOSED = (FINISHED, ROLLED_BACK, STOPPED, ABORTED, ABANDONED)
+
+# Days closed journals are kept, so that their jobs can be rolled back
+KEEP_DAYS = 30
+
+def new_journal_path(directory=JOURNAL_DIR):
+    """
+    Returns the pathname for the journal of a new job.
+    :param directory: Directory of the journals; created if needed
+    :return: String containing pathname
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # tempfile is only needed once a job starts, not at every start
+    from tempfile import mkstemp
+
+    # Names start with the date, so that they sort in order of creation
+    fd, pathname = mkstemp(suffix=JOURNAL_SUFFIX, dir=directory,
+                           prefix=strftime("%Y%m%d-%H%M%S_"))
+    os.close(fd)
+    return pathname
+
+def interrupted_journals(directory=JOURNAL_DIR):
+    """
+    Lists the journals of the jobs that never finished.
+    :param directory: Directory of the journals
+    :return: List of pathnames, oldest first
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    interrupted = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(JOURNAL_SUFFIX):
+            continue
+        pathname = os.path.join(directory, name)
+        if last_line_kind(pathname) not in CLOSED:
+            interrupted.append(pathname)
+    return interrupted
+
+def abandon_journal(pathname):
+    """
+    Marks the journal of an interrupted job as not to be resumed; it can
+    still be rolled back.
+    :param pathname: Pathname of the journal
+    :return: None
+    """
+    with open(pathname, "a") as f:
+        f.write(json.dumps([ABANDONED]) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def prune_journals(directory=JOURNAL_DIR, days=KEEP_DAYS):
+    """
+    Deletes the journals of the jobs that ended more than some days ago.
+    Journals of interrupted jobs are kept whatever their age.
+    :param directory: Directory of the journals
+    :param days: Days a closed journal is kept
+    :return: Number of journals deleted
+    """
+    if not os.path.isdir(directory):
+        return 0
+
+    oldest = time() - days * 24 * 3600
+    deleted = 0
+    for name in os.listdir(directory):
+        if not name.endswith(JOURNAL_SUFFIX):
+            continue
+        pathname = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(pathname) < oldest and \
+                    last_line_kind(pathname) in CLOSED:
+                os.remove(pathname)
+                deleted += 1
+        except (IOError, OSError):
+            # In use, or already gone
+            pass
+    return deleted
+
+def last_line_kind(pathname):
+    """
+    Reads the kind of the last line of a journal without reading it all.
+    :param pathname: Pathname of the journal
+    :return: Kind of the last complete line, or None
+    """
+    with open(pathname, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        lines = f.read().splitlines()
+
+    for line in reversed(lines):
+        try:
+            record = json.loads(line.decode("utf-8"))
+        except ValueError:
+            # Half-written line, from a crash
+            continue
+        return record[0] if isinstance(record, list) else None
+    return None
+
+class Journal(object):
+    """
+    Append-only record of a job: its whole plan, then a line for each
+    completed operation. Lines are written as they come, and fsync'ed in
+    batches; a crash loses at most the last batch of completion lines, whose
+    operations are recognized as done when the job is resumed. The plan
+    isn't kept in memory: it's read back from the journal when executed.
+    """
+
+    def __init__(self, pathname, origin, destination, done, resumed=False):
+        """
+        Use Journal.create or Journal.load instead.
+        """
+        self.pathname = pathname
+        self.resumed = resumed
+        self.origin = origin
+        self.destination = destination
+
+        # One byte per plan entry: 1 if its operation is done
+        self.done = done
+
+        self._file = open(pathname, "a")
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time()
+
+    @classmethod
+    def create(cls, pathname, origin, destination, plan):
+        """
+        Writes the journal of a new job, plan included, before any file is
+        touched.
+        :param pathname: Pathname of the new journal
+        :param origin: Directory from which the files are moved/duplicated
+        :param destination: Pathname to contain the specified files
+        :param plan: Iterable of PlanEntry, consumed as it's written
+        :return: Journal instance
+        """
+        size = 0
+        with open(pathname, "w") as f:
+            f.write(json.dumps({"origin": origin,
+                                "destination": destination}) + "\n")
+            for entry in plan:
+                f.write(json.dumps([PLANNED] + list(entry)) + "\n")
+                size += 1
+            f.write(json.dumps([READY]) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        return cls(pathname, origin, destination, bytearray(size))
+
+    @classmethod
+    def load(cls, pathname):
+        """
+        Reads the journal of an existing job.
+        :param pathname: Pathname of the journal
+        :return: Journal instance
+        """
+        done = bytearray()
+
+        with open(pathname) as f:
+            header = json.loads(f.readline())
+
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Half-written last line, from a crash
+                    break
+
+                kind = record[0]
+                if kind == PLANNED:
+                    done.append(0)
+                elif kind == DONE:
+                    done[record[1]] = 1
+                elif kind == UNDONE:
+                    done[record[1]] = 0
+
+        return cls(pathname, header["origin"], header["destination"], done,
+                   resumed=True)
+
+    def __len__(self):
+        """
+        :return: Number of entries of the plan
+        """
+        return len(self.done)
+
+    def entries(self):
+        """
+        Reads the plan back from the journal.
+        :return: Generator of PlanEntry, in order
+        """
+        with open(self.pathname) as f:
+            f.readline()
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Half-written last line, from a crash
+                    return
+                if record[0] != PLANNED:
+                    # The plan comes before any other line
+                    return
+                yield PlanEntry(*record[1:])
+
+    def is_done(self, index):
+        """
+        :param index: Index of a plan entry
+        :return: Boolean telling whether its operation is done
+        """
+        return self.done[index] == 1
+
+    def completed(self, index):
+        """
+        Records that the operation of a plan entry is done.
+        :param index: Index of the plan entry
+        :return: None
+        """
+        self._write([DONE, index])
+        self.done[index] = 1
+
+    def undone(self, index):
+        """
+        Records that the operation of a plan entry was rolled back.
+        :param index: Index of the plan entry
+        :return: None
+        """
+        self._write([UNDONE, index])
+        self.done[index] = 0
+
+    def close(self, kind=None):
+        """
+        Makes every line durable and closes the journal.
+        :param kind: FINISHED, ROLLED_BACK, STOPPED or ABORTED to mark the
+        end of the job, None if the job was interrupted
+        :return: None
+        """
+        with self._lock:
+            if kind is not None:
+                self._file.write(json.dumps([kind]) + "\n")
+            self._sync()
+            self._file.close()
+
+    def _write(self, record):
+        """
+        Appends a line, fsync'ing the pending lines if a batch is due.
+        :param record: List to write as a JSON line
+        :return: None
+        """
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._unsynced += 1
+
+            if self._unsynced >= SYNC_ENTRIES or \
+                    time() - self._last_sync >= SYNC_SECONDS:
+                self._sync()
+
+    def _sync(self):
+        """
+        Writes the pending lines to disk; the lock must be held.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time()
@@ -0,0 +1,98 @@
+"""
+FileOrganizer_log.py: Handlers of the log of FileOrganizer: records are
+                      queued by the logging threads, then formatted and
+                      written in batches to a rotating file by a
+                      background thread. Only start_logging imports it,
+                      so logging.handlers isn't loaded until a job
+                      starts logging.
+"""
+__author__ = "Carlos Montes"
+
+import json
+import logging
+import logging.handlers
+
+# Rotation of the log file: maximum size in bytes and number of backups
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+# Maximum number of records written to the log file at once
+LOG_BATCH_SIZE = 1000
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves the formatting of the records to the
+    listener's thread, instead of doing it in the logging thread.
+    Records never leave the process, so they can be queued as they are.
+    """
+
+    def prepare(self, record):
+        return record
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener that lets its handlers flush their batches as soon as
+    the queue runs empty: records are written in large batches when many
+    come at once, and without delay otherwise.
+    """
+
+    def handle(self, record):
+        super(BatchQueueListener, self).handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+class BatchFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler that gathers formatted records in memory and
+    writes them with a single call on each flush.
+    """
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES,
+                 backup_count=LOG_BACKUP_COUNT, capacity=LOG_BATCH_SIZE):
+        super(BatchFileHandler, self).__init__(filename, maxBytes=max_bytes,
+                                               backupCount=backup_count)
+        self.capacity = capacity
+        self.batch = []
+
+    def emit(self, record):
+        try:
+            self.batch.append(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+            return
+
+        if len(self.batch) >= self.capacity or \
+                record.levelno >= logging.ERROR:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.batch:
+                text = "".join(self.batch)
+                self.batch = []
+
+                if self.stream is None:
+                    self.stream = self._open()
+                if self.maxBytes > 0 and \
+                        self.stream.tell() + len(text) >= self.maxBytes:
+                    self.doRollover()
+
+                self.stream.write(text)
+
+            if self.stream is not None:
+                self.stream.flush()
+        finally:
+            self.release()
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as one line of JSON.
+    """
+
+    def format(self, record):
+        return json.dumps({"time": self.formatTime(record),
+                           "level": record.levelname,
+                           "function": record.funcName,
+                           "message": record.getMessage()})
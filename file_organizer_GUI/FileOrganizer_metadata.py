@@ -0,0 +1,353 @@
+"""
+FileOrganizer_metadata.py: Reads the metadata the pre-orders need beyond
+                           stat: true creation (birth) time and the capture
+                           date of photos and videos. Values are kept in a
+                           persistent cache, keyed by directory and inode,
+                           so headers are only read again when a file
+                           changes.
+"""
+__author__ = "Carlos Montes"
+
+import os
+import sys
+import struct
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from os.path import expanduser
+from logging import info as log_info
+from FileOrganizer_copy import DEFAULT_WORKERS
+
+# Persistent cache of the metadata of the origin files
+METADATA_INDEX = os.path.join(expanduser("~"), ".file_organizer",
+                              "metadata.sqlite")
+
+# Metadata fields
+BIRTH_TIME = "birth"
+CAPTURE_TIME = "taken"
+
+# Bytes read from the start of a file looking for its EXIF header
+EXIF_READ_SIZE = 128 * 1024
+
+# Seconds between the QuickTime epoch (1904) and the Unix one
+QUICKTIME_EPOCH = 2082844800
+
+# EXIF tags holding dates, by order of preference: DateTimeOriginal,
+# DateTimeDigitized (both in the Exif IFD) and DateTime (in IFD0)
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATE_TAGS = (0x9003, 0x9004)
+TIFF_DATE_TAG = 0x0132
+
+# ------- BIRTH TIME ------------
+
+@lru_cache(maxsize=None)
+def _load_statx():
+    """
+    Looks statx up on the first birth time read rather than on import:
+    loading ctypes and the C library would slow down every start.
+    :return: statx function of the C library, or None if unavailable
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        statx = ctypes.CDLL(None, use_errno=True).statx
+    except (ImportError, OSError, AttributeError):
+        return None
+    statx.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                      ctypes.c_uint, ctypes.c_void_p)
+    statx.restype = ctypes.c_int
+    return statx
+
+# statx constants and layout of struct statx (256 bytes)
+AT_FDCWD = -100
+STATX_BTIME = 0x800
+STATX_SIZE = 256
+STATX_BTIME_OFFSET = 80
+
+def birth_time(pathname):
+    """
+    Reads the creation time of a file: st_birthtime where stat provides it
+    (macOS, BSD, Windows), statx on Linux. Falls back on the modification
+    time when the filesystem doesn't record it.
+    :param pathname: Pathname of the file
+    :return: POSIX timestamp
+    """
+    st = os.stat(pathname)
+    if hasattr(st, "st_birthtime"):
+        return st.st_birthtime
+
+    statx = _load_statx()
+    if statx is not None:
+        import ctypes
+        buf = ctypes.create_string_buffer(STATX_SIZE)
+        name = os.fsencode(pathname)
+        if statx(AT_FDCWD, name, 0, STATX_BTIME, buf) == 0:
+            mask, = struct.unpack_from("=I", buf, 0)
+            if mask & STATX_BTIME:
+                sec, nsec = struct.unpack_from("=qI", buf,
+                                               STATX_BTIME_OFFSET)
+                return sec + nsec / 1e9
+
+    return st.st_mtime
+
+# ------- CAPTURE TIME ------------
+
+def parse_exif_date(text):
+    """
+    :param text: EXIF date, "YYYY:MM:DD HH:MM:SS" in local time
+    :return: POSIX timestamp, or None if the date is blank or invalid
+    """
+    from datetime import datetime
+    try:
+        return datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                        int(text[11:13]), int(text[14:16]),
+                        int(text[17:19])).timestamp()
+    except (ValueError, OverflowError):
+        return None
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+def tiff_capture_time(f, start):
+    """
+    Finds the capture date in a TIFF structure (the body of an EXIF header,
+    or a whole TIFF based raw file).
+    :param f: Binary file object
+    :param start: Offset of the TIFF header in f
+    :return: POSIX timestamp, or None
+    """
+    header = _read_at(f, start, 8)
+    if header[:4] == b"II*\0":
+        order = "<"
+    elif header[:4] == b"MM\0*":
+        order = ">"
+    else:
+        return None
+
+    def read_ifd(offset):
+        # Dictionary of (type, count, value/offset bytes) by tag
+        count_bytes = _read_at(f, start + offset, 2)
+        if len(count_bytes) < 2:
+            return {}
+        count, = struct.unpack(order + "H", count_bytes)
+        data = f.read(12 * count)
+        tags = {}
+        for i in range(len(data) // 12):
+            tag, kind, n = struct.unpack_from(order + "HHI", data, 12 * i)
+            tags[tag] = (kind, n, data[12 * i + 8:12 * i + 12])
+        return tags
+
+    def read_ascii(entry):
+        kind, n, value = entry
+        if kind != 2:
+            return None
+        if n > 4:
+            offset, = struct.unpack(order + "I", value)
+            value = _read_at(f, start + offset, n)
+        return parse_exif_date(value[:n].decode("ascii", "replace"))
+
+    ifd0 = read_ifd(struct.unpack(order + "I", header[4:8])[0])
+
+    if EXIF_IFD_POINTER in ifd0:
+        offset, = struct.unpack(order + "I", ifd0[EXIF_IFD_POINTER][2])
+        exif = read_ifd(offset)
+        for tag in EXIF_DATE_TAGS:
+            if tag in exif:
+                taken = read_ascii(exif[tag])
+                if taken is not None:
+                    return taken
+
+    if TIFF_DATE_TAG in ifd0:
+        return read_ascii(ifd0[TIFF_DATE_TAG])
+    return None
+
+def jpeg_capture_time(f):
+    """
+    Walks the markers of a JPEG file up to its image data, looking for the
+    APP1 EXIF header.
+    :param f: Binary file object, positioned after the SOI marker
+    :return: POSIX timestamp, or None
+    """
+    offset = 2
+    while offset < EXIF_READ_SIZE:
+        marker = _read_at(f, offset, 4)
+        if len(marker) < 4 or marker[0] != 0xFF or marker[1] == 0xDA:
+            # Broken file, or start of the image data
+            return None
+        length, = struct.unpack(">H", marker[2:4])
+        if marker[1] == 0xE1 and f.read(6) == b"Exif\0\0":
+            return tiff_capture_time(f, offset + 10)
+        offset += 2 + length
+    return None
+
+def quicktime_capture_time(f, size):
+    """
+    Reads the creation time of the movie header (moov/mvhd) of a QuickTime
+    or MP4 file. Only atom headers are read, wherever moov is.
+    :param f: Binary file object
+    :param size: Size of the file in bytes
+    :return: POSIX timestamp, or None
+    """
+    def atoms(start, end):
+        # Yields (type, offset of the body, end) of each atom in a range
+        offset = start
+        while offset + 8 <= end:
+            header = _read_at(f, offset, 16)
+            atom_size, kind = struct.unpack(">I4s", header[:8])
+            body = offset + 8
+            if atom_size == 1:
+                atom_size, = struct.unpack(">Q", header[8:16])
+                body += 8
+            elif atom_size == 0:
+                atom_size = end - offset
+            if atom_size < body - offset:
+                return
+            yield kind, body, offset + atom_size
+            offset += atom_size
+
+    for kind, body, end in atoms(0, size):
+        if kind != b"moov":
+            continue
+        for child, child_body, _ in atoms(body, end):
+            if child != b"mvhd":
+                continue
+            data = _read_at(f, child_body, 12)
+            if data[:1] == b"\1":
+                created, = struct.unpack(">Q", data[4:12])
+            else:
+                created, = struct.unpack(">I", data[4:8])
+            return created - QUICKTIME_EPOCH if created else None
+        return None
+    return None
+
+def capture_time(pathname):
+    """
+    Reads the date a photo or video was taken, from its EXIF header (JPEG
+    and TIFF based raw files) or its QuickTime movie header (MOV, MP4).
+    :param pathname: Pathname of the file
+    :return: POSIX timestamp, or None if the file doesn't have one
+    """
+    with open(pathname, "rb") as f:
+        head = f.read(12)
+        try:
+            if head[:2] == b"\xff\xd8":
+                return jpeg_capture_time(f)
+            elif head[:4] in (b"II*\0", b"MM\0*"):
+                return tiff_capture_time(f, 0)
+            elif head[4:8] in (b"ftyp", b"moov", b"wide", b"mdat", b"free"):
+                return quicktime_capture_time(f, os.fstat(f.fileno()).st_size)
+        except struct.error:
+            # Truncated or corrupt header
+            return None
+    return None
+
+# Reader of each field
+READERS = {BIRTH_TIME: birth_time, CAPTURE_TIME: capture_time}
+
+# ------- CACHE ------------
+
+class MetadataIndex(object):
+    """
+    SQLite cache of metadata fields, one row per (directory, inode, field).
+    A value is trusted as long as the modification time of its file is
+    unchanged; files without a capture date are cached too, as NULL.
+    """
+
+    def __init__(self, pathname=METADATA_INDEX):
+        """
+        Opens the cache, creating it if needed.
+        :param pathname: Pathname of the SQLite database
+        """
+        directory = os.path.dirname(pathname)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Only jobs reading metadata pay for loading sqlite3
+        import sqlite3
+        self.connection = sqlite3.connect(pathname)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata ("
+                                "directory TEXT, inode INTEGER, "
+                                "field TEXT, mtime REAL, value REAL, "
+                                "PRIMARY KEY (directory, inode, field))")
+
+    def cached_values(self, directory, field):
+        """
+        :param directory: Absolute pathname of a directory
+        :param field: BIRTH_TIME or CAPTURE_TIME
+        :return: Dictionary of (mtime, value) by inode
+        """
+        rows = self.connection.execute(
+            "SELECT inode, mtime, value FROM metadata "
+            "WHERE directory = ? AND field = ?", (directory, field))
+        return dict((inode, (mtime, value)) for inode, mtime, value in rows)
+
+    def store(self, directory, field, rows):
+        """
+        Adds or updates values of a directory's files.
+        :param directory: Absolute pathname of the directory
+        :param field: BIRTH_TIME or CAPTURE_TIME
+        :param rows: Iterable of (inode, mtime, value) tuples
+        :return: None
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                ((directory, inode, field, mtime, value)
+                 for inode, mtime, value in rows))
+
+    def close(self):
+        self.connection.close()
+
+def read_metadata(directory, entries, field, index=None,
+                  workers=DEFAULT_WORKERS):
+    """
+    Reads a metadata field of files of a directory. Only files that are
+    new or modified since the last run are read, in parallel.
+    :param directory: Pathname of the directory
+    :param entries: Iterable of FileEntry of the files
+    :param field: BIRTH_TIME or CAPTURE_TIME
+    :param index: MetadataIndex instance; METADATA_INDEX is opened if None
+    :param workers: Number of reading threads
+    :return: Dictionary of values (POSIX timestamps or None) by filename
+    """
+    directory = os.path.abspath(directory)
+    reader = READERS[field]
+
+    own_index = index is None
+    if own_index:
+        index = MetadataIndex()
+
+    try:
+        cached = index.cached_values(directory, field)
+        values = {}
+        missing = []
+
+        for entry in entries:
+            row = cached.get(entry.inode)
+            if row is not None and row[0] == entry.mtime:
+                values[entry.name] = row[1]
+            else:
+                missing.append(entry)
+
+        def read(entry):
+            try:
+                return reader(os.path.join(directory, entry.name))
+            except (IOError, OSError):
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            read_values = list(executor.map(read, missing))
+
+        for entry, value in zip(missing, read_values):
+            values[entry.name] = value
+        index.store(directory, field,
+                    ((entry.inode, entry.mtime, value)
+                     for entry, value in zip(missing, read_values)))
+
+        log_info("%s of %d files: %d cached, %d read", field, len(values),
+                 len(values) - len(missing), len(missing))
+        return values
+    finally:
+        if own_index:
+            index.close()
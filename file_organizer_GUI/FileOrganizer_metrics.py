@@ -0,0 +1,258 @@
+"""
+FileOrganizer_metrics.py: Instrumentation of the jobs of FileOrganizer.
+                          move_files reports the time spent in each stage,
+                          the filesystem calls it makes and the latency of
+                          every file to hooks; JobMetrics collects them and
+                          exports them as JSON or Prometheus text.
+"""
+__author__ = "Carlos Montes"
+
+import json
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+# Stages of a job. The planning includes the scan of the origin, the
+# metadata reads and the sorting; the transfer of the files includes
+# their logging. JobMetrics reports each stage without the ones inside it
+SCAN = "scan"
+METADATA = "metadata"
+SORT = "sort"
+PLAN = "plan"
+TRANSFER = "transfer"
+LOG = "log"
+STAGES = (SCAN, METADATA, SORT, PLAN, TRANSFER, LOG)
+NESTED = {SCAN: PLAN, METADATA: PLAN, SORT: PLAN, LOG: TRANSFER}
+
+# Upper bounds, in seconds, of the buckets of the per-file latency
+# histogram
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Prefix of the names of the Prometheus metrics
+PROMETHEUS_PREFIX = "file_organizer_"
+
+class JobHooks(object):
+    """
+    Interface of the instrumentation of a job: move_files calls these
+    methods as the job goes, possibly from several threads at once. They
+    all do nothing; subclass it to receive the events.
+    """
+
+    def stage(self, name, seconds):
+        """
+        :param name: Stage, one of STAGES
+        :param seconds: Time spent in it, since the last call for it
+        """
+        pass
+
+    def calls(self, name, count=1):
+        """
+        :param name: Filesystem call, e.g. "stat" or "rename"
+        :param count: Number of calls made
+        """
+        pass
+
+    def file_done(self, seconds, copied):
+        """
+        :param seconds: Time taken by a file, from its start to its log
+        :param copied: Bytes copied for it (0 for renames, links and skips)
+        """
+        pass
+
+    def job_done(self, seconds):
+        """
+        :param seconds: Wall time of the whole job, finished or not
+        """
+        pass
+
+class JobMetrics(JobHooks):
+    """
+    Collects the events of a job: time by stage, filesystem calls by name,
+    bytes copied and a histogram of the latencies of the files.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = dict((name, 0.0) for name in STAGES)
+        self.syscalls = {}
+        self.bytes_copied = 0
+        self.files = 0
+        self.latency_sum = 0.0
+        # Counts by bucket of LATENCY_BUCKETS, the last one for the slower
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.wall = 0.0
+
+    def stage(self, name, seconds):
+        with self.lock:
+            self.seconds[name] += seconds
+
+    def calls(self, name, count=1):
+        with self.lock:
+            self.syscalls[name] = self.syscalls.get(name, 0) + count
+
+    def file_done(self, seconds, copied):
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.files += 1
+            self.bytes_copied += copied
+            self.latency_sum += seconds
+            self.latencies[bucket] += 1
+
+    def job_done(self, seconds):
+        with self.lock:
+            self.wall += seconds
+
+    def stage_seconds(self):
+        """
+        :return: Dictionary of seconds by stage, each one without the
+        stages inside it. Stages run by several threads add up the time of
+        every thread
+        """
+        seconds = dict(self.seconds)
+        for name, outer in NESTED.items():
+            seconds[outer] = max(0.0, seconds[outer] - self.seconds[name])
+        return seconds
+
+    def percentile(self, fraction):
+        """
+        :param fraction: Fraction of the files, e.g. 0.99
+        :return: Upper bound in seconds of the latency bucket holding that
+        fraction of the files, None if there's none or it's beyond the last
+        bucket
+        """
+        if not self.files:
+            return None
+        total = 0
+        for bucket, count in enumerate(self.latencies[:-1]):
+            total += count
+            if total >= fraction * self.files:
+                return LATENCY_BUCKETS[bucket]
+        return None
+
+    def as_dict(self):
+        """
+        :return: Dictionary of every metric, ready for JSON
+        """
+        return {"wall_seconds": self.wall,
+                "stage_seconds": self.stage_seconds(),
+                "syscalls": dict(self.syscalls),
+                "bytes_copied": self.bytes_copied,
+                "files": self.files,
+                "file_latency": {
+                    "buckets": list(LATENCY_BUCKETS),
+                    "counts": list(self.latencies),
+                    "sum": self.latency_sum}}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        :return: Metrics in the Prometheus text exposition format
+        """
+        p = PROMETHEUS_PREFIX
+        lines = ["# HELP {}job_seconds Wall time of the job.".format(p),
+                 "# TYPE {}job_seconds gauge".format(p),
+                 "{}job_seconds {}".format(p, self.wall),
+                 "# HELP {}stage_seconds Time spent in each stage of the "
+                 "job.".format(p),
+                 "# TYPE {}stage_seconds gauge".format(p)]
+        for name, seconds in sorted(self.stage_seconds().items()):
+            lines.append('{}stage_seconds{{stage="{}"}} {}'.format(
+                p, name, seconds))
+
+        lines.extend(["# HELP {}syscalls_total Filesystem calls made by the "
+                      "job.".format(p),
+                      "# TYPE {}syscalls_total counter".format(p)])
+        for name, count in sorted(self.syscalls.items()):
+            lines.append('{}syscalls_total{{call="{}"}} {}'.format(
+                p, name, count))
+
+        lines.extend(["# HELP {}bytes_copied_total Bytes copied by the "
+                      "job.".format(p),
+                      "# TYPE {}bytes_copied_total counter".format(p),
+                      "{}bytes_copied_total {}".format(p, self.bytes_copied),
+                      "# HELP {}file_seconds Time taken by each "
+                      "file.".format(p),
+                      "# TYPE {}file_seconds histogram".format(p)])
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latencies):
+            total += count
+            lines.append('{}file_seconds_bucket{{le="{}"}} {}'.format(
+                p, bound, total))
+        lines.extend(['{}file_seconds_bucket{{le="+Inf"}} {}'.format(
+                          p, self.files),
+                      "{}file_seconds_sum {}".format(p, self.latency_sum),
+                      "{}file_seconds_count {}".format(p, self.files)])
+
+        return "\n".join(lines) + "\n"
+
+    def save(self, pathname):
+        """
+        Writes the metrics to a file: Prometheus text if its extension is
+        .prom or .txt, JSON otherwise.
+        :param pathname: Pathname of the file
+        :return: None
+        """
+        prometheus = pathname.lower().endswith((".prom", ".txt"))
+        with open(pathname, "w") as f:
+            f.write(self.to_prometheus() if prometheus else self.to_json())
+
+    def summary(self):
+        """
+        :return: One line summary for the status bar, e.g. "1000 files in
+        2.1 s - plan 0.3 s, transfer 1.7 s, log 0.1 s - p50 1 ms, p99 10 ms"
+        """
+        stages = ", ".join("{} {:.2f} s".format(name, seconds)
+                           for name, seconds in
+                           sorted(self.stage_seconds().items(),
+                                  key=lambda item: STAGES.index(item[0]))
+                           if seconds >= 0.005)
+        latencies = ", ".join("p{:.0f} {:g} ms".format(fraction * 100,
+                                                      bound * 1000)
+                              for fraction, bound in
+                              ((f, self.percentile(f)) for f in (0.5, 0.99))
+                              if bound is not None)
+        parts = ["{} files in {:.2f} s".format(self.files, self.wall)]
+        return " - ".join(part for part in parts + [stages, latencies]
+                          if part)
+
+def timed_iter(iterable, hooks, name):
+    """
+    Iterates over an iterable, reporting the time spent getting each item
+    as time of a stage.
+    :param iterable: Any iterable, usually a lazy generator
+    :param hooks: JobHooks receiving the time
+    :param name: Stage
+    :return: Generator of the same items
+    """
+    iterator = iter(iterable)
+    stage = hooks.stage
+    while True:
+        start = perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stage(name, perf_counter() - start)
+            return
+        stage(name, perf_counter() - start)
+        yield item
+
+def timed_call(function, hooks, name):
+    """
+    :param function: Any callable
+    :param hooks: JobHooks receiving the time
+    :param name: Stage
+    :return: Callable doing the same, reporting its time as time of a stage
+    """
+    stage = hooks.stage
+
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage(name, perf_counter() - start)
+
+    return timed
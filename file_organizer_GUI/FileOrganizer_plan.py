@@ -0,0 +1,429 @@
+"""
+FileOrganizer_plan.py: Computes the whole plan of a job (which file goes
+                       where, with which name) before any file is touched.
+                       To be executed by FileOrganizer. Plans are streamed:
+                       scan, filter, sort, name, one folder at a time.
+"""
+__author__ = "Carlos Montes"
+
+import os
+import sys
+from itertools import count
+from time import perf_counter
+from operator import itemgetter
+from collections import namedtuple
+from FileOrganizer_utils import scan_directory, FileEntry
+from FileOrganizer_rename import compile_renamer
+from FileOrganizer_sort import external_sort, natural_records
+from FileOrganizer_sort import pattern_records, value_records, pattern_regex
+from FileOrganizer_metadata import read_metadata, BIRTH_TIME, CAPTURE_TIME
+from FileOrganizer_walk import walk_tree, glob_matcher
+from FileOrganizer_copy import DEFAULT_WORKERS
+from FileOrganizer_metrics import timed_iter, SCAN, METADATA, SORT
+
+# Actions of a plan entry
+MOVE = "move"
+COPY = "copy"
+LINK = "link"
+SKIP = "skip"
+
+# Conflicts of a plan entry
+EXISTS = "exists"                  # The name is taken in the destination
+DUPLICATE_NAME = "duplicate name"  # Another file of the job gets the name
+SAME_FILE = "same file"            # The file would replace itself
+DUPLICATE_CONTENT = "duplicate content"  # Its content is already there
+RENAMED = "renamed"                # The name was taken, a number was added
+
+# Collision strategies: what to do with a file whose name is taken in the
+# destination
+SKIP_EXISTING = "skip"     # Leave it in origin
+OVERWRITE = "overwrite"    # Replace the existing file
+ADD_SUFFIX = "suffix"      # Add a number to its name, "name (1).ext"
+KEEP_NEWER = "newer"       # Replace the existing file if it's older
+KEEP_LARGER = "larger"     # Replace the existing file if it's smaller
+COLLISIONS = (SKIP_EXISTING, OVERWRITE, ADD_SUFFIX, KEEP_NEWER, KEEP_LARGER)
+
+# One file of a plan: original name, final name, action, conflict (or None),
+# size in bytes and, for LINK, pathname of the file to hardlink. If there is
+# an EXISTS conflict but the action isn't SKIP, the existing file is
+# replaced
+PlanEntry = namedtuple("PlanEntry",
+                       "source destination action conflict size link",
+                       defaults=(None,))
+
+# Filename of a (key, filename) record of the pre-order sorts
+_record_name = itemgetter(1)
+
+def plan_moves(origin, files, destination, id_order, custom_preorder,
+               numbering, removing, lowercase=False, duplicate=False,
+               replace_files=False, entries=None, substitutions=(),
+               template=None, recursive=False, include=(), exclude=(),
+               flatten=False, workers=DEFAULT_WORKERS, collisions=None,
+               metrics=None, rename=None, preorder=None):
+    """
+    Computes what moving or duplicating files from one directory to another
+    would do, without touching any file.
+    Parameters are the same as FileOrganizer's move_files.
+    :return: Tuple of PlanEntry, in the order they are to be executed
+    """
+    return tuple(iter_plan(origin, files, destination, id_order,
+                           custom_preorder, numbering, removing, lowercase,
+                           duplicate, replace_files, entries, substitutions,
+                           template, recursive, include, exclude, flatten,
+                           workers, collisions, metrics, rename, preorder))
+
+def iter_plan(origin, files, destination, id_order, custom_preorder,
+              numbering, removing, lowercase=False, duplicate=False,
+              replace_files=False, entries=None, substitutions=(),
+              template=None, recursive=False, include=(), exclude=(),
+              flatten=False, workers=DEFAULT_WORKERS, collisions=None,
+              metrics=None, rename=None, preorder=None):
+    """
+    Yields the plan of a job entry by entry. Each destination directory is
+    listed once, and every conflict is resolved against that snapshot.
+    Only one origin folder is held in memory at a time (plus, when
+    flattening, the names given in destination), so the plan of a tree of
+    millions of files can be executed as it's computed.
+    Parameters are the same as FileOrganizer's move_files.
+    :return: Generator of PlanEntry, in the order they are to be executed
+    """
+    if recursive:
+        # The tree is streamed one directory at a time. If the destination
+        # is inside it, it's not walked: files may be landing there already
+        inside = os.path.relpath(os.path.abspath(destination),
+                                 os.path.abspath(origin))
+        prune = () if inside == os.curdir or \
+            inside.startswith(os.pardir) else (inside,)
+        batches = ((relative, [entry.name for entry in batch],
+                    dict((entry.name, entry) for entry in batch))
+                   for relative, batch in walk_tree(
+                       origin, include, exclude,
+                       None if files is None else set(files), workers,
+                       prune))
+        if metrics is not None:
+            batches = timed_iter(batches, metrics, SCAN)
+    else:
+        # Stat every selected file once, for the pre-order and the sizes
+        if entries is None:
+            start = perf_counter()
+            entries = dict((entry.name, entry)
+                           for entry in scan_directory(origin, set(files)))
+            if metrics is not None:
+                metrics.stage(SCAN, perf_counter() - start)
+                metrics.calls("scandir")
+                metrics.calls("stat", len(entries))
+        batches = [("", filter_names(files, include, exclude), entries)]
+
+    if rename is None:
+        rename = compile_renamer(numbering, removing, lowercase,
+                                 substitutions, template)
+    if preorder is None:
+        preorder = compile_preorder(id_order, custom_preorder)
+    action = COPY if duplicate else MOVE
+    if collisions is None:
+        collisions = OVERWRITE if replace_files else SKIP_EXISTING
+    elif collisions not in COLLISIONS:
+        raise ValueError("Unknown collision strategy: {}".format(collisions))
+    compare = collisions in (KEEP_NEWER, KEEP_LARGER)
+
+    # Names are compared case-folded where the filesystem ignores case, so
+    # that "IMG.jpg" collides with "img.jpg"; str leaves them as they are
+    fold = str.casefold if case_insensitive(destination) else str
+
+    # Names in the destination directory, relative to destination, and
+    # names given by the plan so far, all folded; directories count too.
+    # Every origin folder has its own destination folder, unless flattening.
+    # Collisions are resolved against these, without touching the disk
+    taken = set()
+    planned = set()
+    existing = {}
+    listed = None
+
+    # Flattened files share a single numbering, preserved directories
+    # restart it
+    numbers = count()
+
+    join = os.path.join
+
+    for relative, names, batch_entries in batches:
+        if recursive and metrics is not None:
+            # The kept files of each folder
+            metrics.calls("scandir")
+            metrics.calls("stat", len(batch_entries))
+
+        original_files = preorder(names, batch_entries,
+                                  join(origin, relative), metrics=metrics)
+
+        target = "" if flatten else relative
+        # Names are built by concatenation: os.path.join would be called
+        # twice per file
+        source_prefix = join(relative, "") if relative else ""
+        target_prefix = join(target, "") if target else ""
+        if target != listed:
+            listed = target
+            planned = set()
+            taken, existing = list_destination(destination, target, fold,
+                                               compare)
+            if metrics is not None:
+                metrics.calls("scandir")
+                metrics.calls("stat", len(existing))
+
+        # Moving inside the same folder frees the old names as the job
+        # goes, but the name of a file that hasn't been moved yet must never
+        # be replaced
+        same_directory = relative == target and \
+            os.path.normcase(os.path.abspath(origin)) == \
+            os.path.normcase(os.path.abspath(destination))
+        renaming = same_directory and not duplicate
+        pending = {fold(source_prefix + f) for f in names} \
+            if renaming else set()
+
+        if not flatten:
+            numbers = count()
+
+        entry_of = batch_entries.get
+        for original, i in zip(original_files, numbers):
+            entry = entry_of(original)
+            size = entry.size if entry is not None else 0
+            source = source_prefix + original
+            name = target_prefix + rename(i, original)
+            key = fold(name)
+
+            if same_directory:
+                source_key = fold(source)
+                if renaming:
+                    pending.discard(source_key)
+                if source_key == key:
+                    if source == name or not renaming:
+                        yield PlanEntry(source, name, SKIP, SAME_FILE, size)
+                        continue
+                    # Only the case of the name changes
+                    yield PlanEntry(source, name, action, None, size)
+                    planned.add(key)
+                    continue
+
+            if key in planned:
+                conflict = DUPLICATE_NAME
+            elif key in taken:
+                conflict = EXISTS
+            else:
+                yield PlanEntry(source, name, action, None, size)
+                planned.add(key)
+                if renaming:
+                    taken.discard(source_key)
+                continue
+
+            if conflict == EXISTS and key not in pending and \
+                    (collisions == OVERWRITE or
+                     compare and replaces(collisions, entry,
+                                          existing.get(key))):
+                yield PlanEntry(source, name, action, EXISTS, size)
+            elif collisions == ADD_SUFFIX:
+                name, key = suffixed_name(name, fold, taken, planned)
+                yield PlanEntry(source, name, action, RENAMED, size)
+            else:
+                yield PlanEntry(source, name, SKIP, conflict, size)
+                continue
+
+            planned.add(key)
+            if renaming:
+                taken.discard(source_key)
+
+def case_insensitive(directory):
+    """
+    Tells whether a directory is on a filesystem ignoring the case of the
+    names, by looking it up (or the closest ancestor with letters in its
+    name, on the same filesystem) with the case swapped.
+    :param directory: Pathname of the directory
+    :return: Boolean; the platform's default if it can't be told
+    """
+    path = os.path.abspath(directory)
+    while True:
+        parent, name = os.path.split(path)
+        if name.swapcase() != name:
+            try:
+                return os.path.samestat(
+                    os.stat(path),
+                    os.stat(os.path.join(parent, name.swapcase())))
+            except OSError:
+                # Not there with another case, or not there at all yet
+                if os.path.exists(path):
+                    return False
+        if parent == path or os.path.ismount(path):
+            return sys.platform in ("darwin", "win32", "cygwin")
+        path = parent
+
+def list_destination(destination, target, fold, stat=False):
+    """
+    Lists a destination folder once, for the collisions of a job.
+    :param destination: Destination directory of the job
+    :param target: Folder relative to destination ("" for itself)
+    :param fold: Callable folding the names
+    :param stat: Boolean telling whether the size and modification time of
+    the files are needed
+    :return: Tuple of (set of folded names relative to destination,
+    dictionary of FileEntry of the files by folded name, empty unless stat)
+    """
+    taken = set()
+    existing = {}
+    join = os.path.join
+
+    try:
+        with os.scandir(join(destination, target)) as iterator:
+            for item in iterator:
+                key = fold(join(target, item.name))
+                taken.add(key)
+                if stat:
+                    try:
+                        if item.is_file():
+                            st = item.stat()
+                            existing[key] = FileEntry(item.name, st.st_size,
+                                                      st.st_mtime,
+                                                      st.st_ctime,
+                                                      st.st_ino)
+                    except OSError:
+                        pass
+    except OSError:
+        # The directory doesn't exist yet
+        pass
+
+    return taken, existing
+
+def replaces(collisions, entry, existing):
+    """
+    :param collisions: KEEP_NEWER or KEEP_LARGER
+    :param entry: FileEntry of the file of the job
+    :param existing: FileEntry of the file with its name in destination
+    :return: True if the file of the job is to replace the existing one
+    """
+    if entry is None or existing is None:
+        # A directory, or a file that vanished
+        return False
+    if collisions == KEEP_NEWER:
+        return entry.mtime > existing.mtime
+    return entry.size > existing.size
+
+def suffixed_name(name, fold, taken, planned):
+    """
+    Finds the first free name of the form "name (1).ext", "name (2).ext"...
+    :param name: Taken name, relative to destination
+    :param fold: Callable folding the names
+    :param taken: Set of folded names in destination
+    :param planned: Set of folded names given by the plan
+    :return: Tuple of (free name, folded)
+    """
+    stem, extension = os.path.splitext(name)
+    for n in count(1):
+        candidate = "{} ({}){}".format(stem, n, extension)
+        key = fold(candidate)
+        if key not in taken and key not in planned:
+            return candidate, key
+
+def filter_names(names, include=(), exclude=()):
+    """
+    Keeps the filenames matching the include patterns, if any, and none of
+    the exclude patterns.
+    :param names: Iterable of filenames
+    :param include: Shell-style patterns of the files to keep
+    :param exclude: Shell-style patterns of the files to leave out
+    :return: List of filenames
+    """
+    included = glob_matcher(include)
+    excluded = glob_matcher(exclude)
+    return [name for name in names
+            if (included is None or included(name, name)) and
+            (excluded is None or not excluded(name, name))]
+
+def preorder_files(files, id_order, custom_preorder, entries, origin=".",
+                   index=None, metrics=None):
+    """
+    Orders the files before they're numbered.
+    :param files: Filenames to order
+    :param id_order: Pre-ordering (0: alphabetical, 1: inverse alpha,
+    2: creation order, 3: string of numbers before/after pattern,
+    4: modification order, 5: size, 6: date the photo or video was taken).
+    Names are compared in natural order, and break ties of the others
+    :param custom_preorder: Tuple of pair (Int before/after pattern,
+    String pattern)
+    :param entries: Dictionary of FileEntry records by filename
+    :param origin: Directory containing the files, for the metadata reads
+    :param index: MetadataIndex of the metadata reads; the default one if
+    None
+    :param metrics: Optional JobHooks receiving the time of the metadata
+    reads and of the sort
+    :return: Iterator of ordered filenames; large sorts are done on disk
+    """
+    return compile_preorder(id_order, custom_preorder)(files, entries,
+                                                       origin, index,
+                                                       metrics)
+
+def compile_preorder(id_order, custom_preorder):
+    """
+    Builds the function ordering the files of a job before they're
+    numbered: the pre-order is chosen and its pattern compiled once, not for
+    every folder.
+    Parameters are the same as preorder_files'.
+    :return: Callable taking (files, entries, origin=".", index=None,
+    metrics=None) and returning an iterator of ordered filenames, see
+    preorder_files
+    """
+    reverse = False
+
+    # Check pre-order to apply before moving/renaming the files
+    if id_order == 0:
+        # Pre-order alphabetically
+        def records_of(files, entries, origin, index, metrics):
+            return natural_records(files)
+
+    elif id_order == 1:
+        # Pre-rder reverse alphabetically
+        def records_of(files, entries, origin, index, metrics):
+            return natural_records(files)
+        reverse = True
+
+    elif id_order in (2, 6):
+        # Order by creation time (st_ctime is the last metadata change on
+        # Unix, the true one is read apart) or by the date the photo or
+        # video was taken. Both are cached between runs. Files that vanished
+        # since they were listed, or without the date, go last
+        field = BIRTH_TIME if id_order == 2 else CAPTURE_TIME
+
+        def records_of(files, entries, origin, index, metrics):
+            start = perf_counter()
+            values = read_metadata(origin, [entries[f] for f in files
+                                            if f in entries], field, index)
+            if metrics is not None:
+                metrics.stage(METADATA, perf_counter() - start)
+            return value_records(files, values.get)
+
+    elif id_order in (4, 5):
+        # Order by modification time or by size, smallest first
+        attribute = "mtime" if id_order == 4 else "size"
+
+        def records_of(files, entries, origin, index, metrics):
+            def value_of(name):
+                entry = entries.get(name)
+                return getattr(entry, attribute) if entry is not None \
+                    else None
+            return value_records(files, value_of)
+
+    else:
+        # Pre-order by a number found after/before a pattern in the
+        # filenames. If there is no defined pattern, maybe the name of the
+        # files themselves is just a number
+        pattern, before = custom_preorder[1], bool(custom_preorder[0])
+        # Compiled here, so the sort of every folder finds it cached
+        pattern_regex(pattern, before)
+
+        def records_of(files, entries, origin, index, metrics):
+            return pattern_records(files, pattern, before)
+
+    def preorder(files, entries, origin=".", index=None, metrics=None):
+        files = list(files)
+        records = external_sort(records_of(files, entries, origin, index,
+                                           metrics), reverse)
+        if metrics is not None:
+            records = timed_iter(records, metrics, SORT)
+        return map(_record_name, records)
+
+    return preorder
@@ -0,0 +1,41 @@
+"""
+FileOrganizer_qt.py: Imports either PySide or PyQt4 in order to display
+                     a GUI for the user. Only the window imports it.
+                     PySide is tried first; setting QT_API to "pyqt4"
+                     reverses the order, sparing systems without PySide
+                     a failed import on every start.
+"""
+
+import os
+
+# Bindings in the order they're tried
+QT_API = os.environ.get("QT_API", "pyside").lower()
+BINDINGS = ("PyQt4", "PySide") if QT_API == "pyqt4" else ("PySide", "PyQt4")
+
+def _import_binding(name):
+    """
+    :param name: "PySide" or "PyQt4"
+    :return: Tuple of its (QtCore, QtGui) modules
+    """
+    if name == "PySide":
+        # GUI namespaces pulled from PySide, if present in the system.
+        # based on Robert Galanakis' "Practical Maya Programming with Python"
+        # available at https://books.google.ca/books?id=ESAZBAAAQBAJ
+        from PySide import QtCore, QtGui
+        import shiboken
+    else:
+        # Namespaces pulled from PyQt implementation
+        from PyQt4 import QtCore, QtGui
+        import sip
+    return QtCore, QtGui
+
+for _binding in BINDINGS:
+    try:
+        QtCore, QtGui = _import_binding(_binding)
+        break
+    except ImportError:
+        if _binding == BINDINGS[-1]:
+            raise
+
+# Signal class aliases QtCore.SIGNAL, old-style signals of both bindings
+Signal = QtCore.SIGNAL
@@ -0,0 +1,582 @@
+"""
+FileOrganizer_queue.py: Queue of organize jobs. Jobs are saved as soon as
+                        they're submitted, so they survive a restart, and
+                        run by a scheduler that lets jobs on different
+                        disks run at the same time while jobs sharing a
+                        disk wait for each other. The window and the
+                        command line may share the queue: its file is
+                        locked while it's read and written.
+"""
+__author__ = "Carlos Montes"
+
+import os
+import json
+import errno
+import threading
+from time import time, sleep
+from contextlib import contextmanager
+from collections import Counter
+from os.path import expanduser
+from logging import info as log_info
+from logging import error as log_error
+import FileOrganizer
+from FileOrganizer_utils import start_logging
+from FileOrganizer_journal import JOURNAL_DIR, new_journal_path
+from FileOrganizer_journal import last_line_kind, READY, DONE, UNDONE
+from FileOrganizer_journal import FINISHED, ROLLED_BACK, STOPPED, ABORTED
+from FileOrganizer_journal import ABANDONED
+
+try:
+    # Files are locked with flock on Unix, and byte range locks on Windows
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Persistent queue, and journals of its jobs; they're kept apart from the
+# journals of the window's own jobs, which are offered for resume on start
+QUEUE_FILE = os.path.join(expanduser("~"), ".file_organizer", "queue.json")
+QUEUE_JOURNAL_DIR = os.path.join(JOURNAL_DIR, "queue")
+
+# Statuses of a job
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ENDED = (COMPLETED, FAILED, CANCELLED)
+
+# Jobs running at once on the same device, and in all
+DEVICE_JOBS = 1
+MAX_JOBS = 4
+
+# Minimum seconds between two progress notifications of a job
+PROGRESS_INTERVAL = 0.2
+
+# Suffix of the lock files of the queue and of its running jobs, and
+# seconds between two attempts at a lock where they can't be waited for
+LOCK_SUFFIX = ".lock"
+LOCK_RETRY = 0.05
+
+# Errors telling that a lock is held by another process
+LOCK_BUSY = (errno.EACCES, errno.EAGAIN, errno.EWOULDBLOCK, errno.EDEADLK)
+
+def path_device(pathname):
+    """
+    :param pathname: Pathname of a directory, existing or not yet
+    :return: Device of the directory, or of its closest existing ancestor
+    """
+    path = os.path.abspath(pathname)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise
+            path = parent
+
+def try_lock(f):
+    """
+    Locks an open file exclusively, without waiting. The lock is released
+    when the file is closed, or its process ends.
+    :param f: File object
+    :return: True if it's locked, False if another process holds it
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except (IOError, OSError) as error:
+        if error.errno not in LOCK_BUSY:
+            raise
+        return False
+    return True
+
+def lock(f):
+    """
+    Locks an open file exclusively, waiting for other processes to release
+    it.
+    :param f: File object
+    :return: None
+    """
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        while not try_lock(f):
+            sleep(LOCK_RETRY)
+
+class QueuedJob(object):
+    """
+    A move_files call waiting in the queue, running or ended. Its arguments
+    and keyword arguments are kept as JSON.
+    """
+
+    def __init__(self, job_id, arguments, keywords, journal, status=QUEUED,
+                 done=0, total=0, error=None, submitted=None, resume=False):
+        """
+        :param job_id: Number of the job, unique in its queue
+        :param arguments: List of positional arguments of move_files
+        :param keywords: Dictionary of keyword arguments of move_files,
+        progress, cancelled and journal excepted
+        :param journal: Pathname of the job's journal
+        :param status: One of QUEUED, RUNNING or ENDED
+        :param done: Number of files processed so far
+        :param total: Number of files of the job, 0 until known
+        :param error: Message of the error that ended the job, or None
+        :param submitted: Time of submission; now if None
+        :param resume: Boolean telling whether the job was interrupted
+        after its plan was journaled, so it's resumed instead of rerun
+        """
+        self.id = job_id
+        self.arguments = arguments
+        self.keywords = keywords
+        self.journal = journal
+        self.status = status
+        self.done = done
+        self.total = total
+        self.error = error
+        self.submitted = time() if submitted is None else submitted
+        self.resume = resume
+
+        self.cancel_requested = False
+        self.devices = None
+        self.lock_file = None
+
+    @property
+    def origin(self):
+        return self.arguments[0]
+
+    @property
+    def destination(self):
+        return self.arguments[2]
+
+    def to_dict(self):
+        return {"id": self.id, "arguments": self.arguments,
+                "keywords": self.keywords, "journal": self.journal,
+                "status": self.status, "done": self.done,
+                "total": self.total, "error": self.error,
+                "submitted": self.submitted, "resume": self.resume}
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(record["id"], record["arguments"], record["keywords"],
+                   record["journal"], record["status"], record["done"],
+                   record["total"], record["error"], record["submitted"],
+                   record["resume"])
+
+    def update(self, record):
+        """
+        Takes the state another process saved for the job.
+        :param record: Dictionary, as returned by to_dict
+        :return: True if the job changed
+        """
+        if record == self.to_dict():
+            return False
+        self.status = record["status"]
+        self.done = record["done"]
+        self.total = record["total"]
+        self.error = record["error"]
+        self.resume = record["resume"]
+        return True
+
+    def running_elsewhere(self):
+        """
+        Tells whether a job marked RUNNING is run by a live process, which
+        holds the lock of the job until it ends.
+        :return: Boolean
+        """
+        try:
+            with open(self.journal + LOCK_SUFFIX, "a") as f:
+                return not try_lock(f)
+        except (IOError, OSError):
+            return False
+
+class JobQueue(object):
+    """
+    Persistent queue of jobs, and their scheduler. Every job runs in its own
+    thread once the devices of its origin and destination have a free slot;
+    the queue is saved each time a job is submitted, starts or ends.
+
+    Several processes may open the same queue. Its file is locked around
+    every change, and the jobs saved by the others are merged in first, so
+    none is lost and no id is given twice. A job is marked RUNNING in the
+    file before it starts, so only one process runs it.
+    """
+
+    def __init__(self, pathname=QUEUE_FILE, device_jobs=DEVICE_JOBS,
+                 max_jobs=MAX_JOBS, listener=None):
+        """
+        Opens the queue, loading the jobs saved in it. Jobs that were
+        running when the program stopped are queued again, to be resumed
+        from their journal. Nothing runs until start is called.
+        :param pathname: Pathname of the JSON file of the queue
+        :param device_jobs: Jobs running at once on the same device
+        :param max_jobs: Jobs running at once in all
+        :param listener: Optional callable receiving a QueuedJob each time
+        its status or progress changes; it's called from the jobs' threads
+        """
+        self.pathname = pathname
+        self.device_jobs = device_jobs
+        self.max_jobs = max_jobs
+        self.listener = None
+
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.jobs = []
+        self.threads = {}
+        self.started = False
+
+        with self.locked():
+            pass
+        self.listener = listener
+
+    @staticmethod
+    def interrupted(job):
+        """
+        Queues again a job that was running when the program stopped: from
+        its journal if its plan was fully written, from scratch otherwise,
+        as no file was touched yet.
+        :param job: QueuedJob
+        :return: None
+        """
+        try:
+            kind = last_line_kind(job.journal)
+        except (IOError, OSError):
+            kind = None
+
+        if kind == FINISHED:
+            job.status = COMPLETED
+        elif kind in (ROLLED_BACK, STOPPED, ABANDONED):
+            job.status = CANCELLED
+        elif kind == ABORTED:
+            job.status = FAILED
+        else:
+            job.status = QUEUED
+            job.resume = kind in (READY, DONE, UNDONE)
+        log_info("Job %d was interrupted, %s", job.id,
+                 "resuming it" if job.resume else job.status)
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the queue against the other threads and processes, with the
+        jobs other processes saved merged in. Nested uses only hold it.
+        :return: Context manager
+        """
+        with self.lock:
+            if self.depth:
+                self.depth += 1
+                try:
+                    yield
+                finally:
+                    self.depth -= 1
+                return
+
+            directory = os.path.dirname(self.pathname)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            with open(self.pathname + LOCK_SUFFIX, "a") as f:
+                lock(f)
+                self.depth = 1
+                try:
+                    self.merge()
+                    yield
+                finally:
+                    self.depth = 0
+
+    def merge(self):
+        """
+        Reads the queue's file into the jobs of this process. The file is
+        taken for all the jobs but the ones running here; jobs it lacks were
+        cleared by another process. Jobs left RUNNING by a process that's
+        gone are queued again. Must be called holding the queue's lock.
+        :return: None
+        """
+        records = []
+        if os.path.exists(self.pathname):
+            with open(self.pathname) as f:
+                records = json.load(f)
+
+        known = dict((job.id, job) for job in self.jobs)
+        jobs, changed, interrupted = [], [], False
+        for record in records:
+            job = known.pop(record["id"], None)
+            if job is None:
+                job = QueuedJob.from_dict(record)
+                changed.append(job)
+            elif job.id not in self.threads and job.update(record):
+                changed.append(job)
+
+            if (job.status == RUNNING and job.id not in self.threads and
+                    not job.running_elsewhere()):
+                self.interrupted(job)
+                interrupted = True
+            jobs.append(job)
+
+        jobs.extend(job for job in known.values() if job.id in self.threads)
+        self.jobs = sorted(jobs, key=lambda job: job.id)
+
+        if interrupted:
+            self.write()
+        for job in changed:
+            self.notify(job)
+
+    def write(self):
+        """
+        Writes the queue, replacing the previous file atomically. Must be
+        called holding the queue's lock.
+        :return: None
+        """
+        temporary = self.pathname + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump([job.to_dict() for job in self.jobs], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.pathname)
+
+    def save(self):
+        """
+        Writes the queue, merged with what other processes saved meanwhile.
+        :return: None
+        """
+        with self.locked():
+            self.write()
+
+    def notify(self, job):
+        if self.listener is not None:
+            self.listener(job)
+
+    def snapshot(self):
+        """
+        :return: List of the jobs of the queue, oldest first
+        """
+        with self.lock:
+            return list(self.jobs)
+
+    def submit(self, arguments, keywords=None):
+        """
+        Adds a job to the queue, running it as soon as its devices allow.
+        :param arguments: Positional arguments of move_files, JSON
+        serializable
+        :param keywords: Dictionary of keyword arguments of move_files,
+        JSON serializable, without progress, cancelled and journal
+        :return: QueuedJob
+        """
+        # Round trip through JSON, so the job runs with what's saved
+        arguments, keywords = json.loads(json.dumps([list(arguments),
+                                                     keywords or {}]))
+        with self.locked():
+            job_id = max([job.id for job in self.jobs] or [0]) + 1
+            job = QueuedJob(job_id, arguments, keywords,
+                            new_journal_path(QUEUE_JOURNAL_DIR))
+            self.jobs.append(job)
+            self.write()
+        self.notify(job)
+        self.schedule()
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job, or asks a running one to stop before its
+        next file.
+        :param job_id: Id of the job
+        :return: None
+        """
+        with self.locked():
+            for job in self.jobs:
+                if job.id != job_id:
+                    continue
+                if job.status == QUEUED:
+                    job.status = CANCELLED
+                elif job.status == RUNNING and not job.cancel_requested:
+                    job.cancel_requested = True
+                else:
+                    return
+                break
+            else:
+                return
+            self.write()
+        self.notify(job)
+
+    def clear_ended(self):
+        """
+        Removes the jobs that ended from the queue.
+        :return: None
+        """
+        with self.locked():
+            self.jobs = [job for job in self.jobs if job.status not in ENDED]
+            self.write()
+
+    def start(self):
+        """
+        Starts running the queued jobs.
+        :return: None
+        """
+        start_logging()
+        self.started = True
+        self.schedule()
+
+    def wait(self):
+        """
+        Waits for every job of the queue to end, the ones started
+        meanwhile included.
+        :return: None
+        """
+        while True:
+            with self.lock:
+                threads = list(self.threads.values())
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+    def schedule(self):
+        """
+        Starts the queued jobs, oldest first, whose devices have a free
+        slot. Younger jobs on other devices don't wait for the older ones,
+        and jobs running in other processes take their slots too. Calling
+        it again picks up the jobs other processes submitted meanwhile.
+        :return: None
+        """
+        starting = []
+        with self.locked():
+            if not self.started:
+                return
+
+            changed = False
+            busy = Counter()
+            for job in self.jobs:
+                if job.status == RUNNING and self.find_devices(job):
+                    busy.update(job.devices)
+
+            for job in self.jobs:
+                if len(self.threads) >= self.max_jobs:
+                    break
+                if job.status != QUEUED:
+                    continue
+
+                if not self.find_devices(job):
+                    changed = True
+                    continue
+
+                if any(busy[device] >= self.device_jobs
+                       for device in job.devices):
+                    continue
+
+                # The job's lock tells the other processes it's running
+                job.lock_file = open(job.journal + LOCK_SUFFIX, "a")
+                if not try_lock(job.lock_file):
+                    job.lock_file.close()
+                    job.lock_file = None
+                    continue
+
+                busy.update(job.devices)
+                job.status = RUNNING
+                thread = threading.Thread(target=self.run, args=(job,),
+                                          name="job-{}".format(job.id))
+                thread.daemon = True
+                self.threads[job.id] = thread
+                starting.append(job)
+
+            # Jobs only start once they're saved as RUNNING
+            if changed or starting:
+                self.write()
+            for job in starting:
+                self.threads[job.id].start()
+
+        for job in starting:
+            self.notify(job)
+
+    def find_devices(self, job):
+        """
+        Finds the devices of a job's folders, ending the job if they can't
+        be told.
+        :param job: QueuedJob
+        :return: True if the job's devices are known
+        """
+        if job.devices is None:
+            try:
+                job.devices = set([path_device(job.origin),
+                                   path_device(job.destination)])
+            except OSError as error:
+                if job.status == QUEUED:
+                    self.ended(job, FAILED, str(error))
+                return False
+        return True
+
+    def ended(self, job, status, error=None):
+        """
+        :param job: QueuedJob that ended
+        :param status: One of ENDED
+        :param error: Message of the error that ended it, or None
+        """
+        job.status = status
+        job.error = error
+        self.notify(job)
+
+    def run(self, job):
+        """
+        Runs a job in its thread, then schedules the next ones.
+        :param job: QueuedJob
+        :return: None
+        """
+        last_report = [0.0]
+
+        def progress(done, total, size):
+            job.done = done
+            job.total = total
+            now = time()
+            if done >= total or now - last_report[0] >= PROGRESS_INTERVAL:
+                last_report[0] = now
+                self.notify(job)
+
+        def cancelled():
+            return job.cancel_requested
+
+        log_info("Job %d started: %s to %s", job.id, job.origin,
+                 job.destination)
+        status, message = COMPLETED, None
+        try:
+            if job.resume:
+                FileOrganizer.resume_job(
+                    job.journal, progress, cancelled,
+                    job.keywords.get("workers", 1),
+                    job.keywords.get("verify", False),
+                    job.keywords.get("processes", 1),
+                    job.keywords.get("remote", False))
+            else:
+                FileOrganizer.move_files(*job.arguments, progress=progress,
+                                         cancelled=cancelled,
+                                         journal=job.journal,
+                                         **job.keywords)
+            if job.cancel_requested:
+                status = CANCELLED
+        except FileOrganizer.FilesNotProcessed as error:
+            status = FAILED
+            message = "{} files could not be processed".format(
+                len(error.errors))
+        except (FileOrganizer.NoSelectedFiles, IOError, OSError,
+                ValueError) as error:
+            status, message = FAILED, str(error)
+        except Exception as error:
+            # Nothing must stop the scheduler
+            log_error("Job %d crashed: %r", job.id, error)
+            status, message = FAILED, repr(error)
+
+        log_info("Job %d %s", job.id, status)
+        with self.locked():
+            del self.threads[job.id]
+            self.ended(job, status, message)
+            self.write()
+
+            # Its end is saved, so no process can take it for interrupted
+            job.lock_file.close()
+            job.lock_file = None
+            try:
+                os.remove(job.journal + LOCK_SUFFIX)
+            except OSError:
+                pass
+        self.schedule()
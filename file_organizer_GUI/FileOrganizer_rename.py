@@ -0,0 +1,145 @@
+"""
+FileOrganizer_rename.py: Compiles the renaming options of a job (numbering,
+                         templates, substitutions, character removal and
+                         lowercase) into a single function, once per job.
+"""
+__author__ = "Carlos Montes"
+
+import re
+from string import Formatter
+
+# Digits of the numbering when the given ones aren't a number
+DEFAULT_DIGITS = 4
+
+def numbering_template(numbering):
+    """
+    Converts the numbering option of the window into a name template.
+    :param numbering: Tuple of pattern (Boolean to actually rename with
+    numbers, number of digits for the renaming, 0: after 1: before the
+    custom pattern, string containing the custom pattern)
+    :return: Template string, or None if the files keep their names
+    """
+    if not numbering[0]:
+        return None
+
+    try:
+        digits = int(numbering[1])
+    except ValueError:
+        digits = DEFAULT_DIGITS
+
+    number = "{{n:0{}d}}".format(digits)
+    # Braces of the custom pattern are literal text
+    pattern = numbering[3].replace("{", "{{").replace("}", "}}")
+
+    # If the user checked the numeration checkbox but inserted no
+    # pattern, maybe they just want the number to be the filename.
+    # Otherwise the number goes after or before the custom pattern
+    if not pattern:
+        return number + "{ext}"
+    elif numbering[2] == 0:
+        return pattern + number + "{ext}"
+    else:
+        return number + pattern + "{ext}"
+
+def template_fields(template):
+    """
+    :param template: Format string of the new names
+    :return: Set of the names of the fields it uses, in the format specs
+    too; positional fields are named "" or by their number
+    """
+    fields = set()
+    for _, field, spec, _ in Formatter().parse(template):
+        if field is not None:
+            fields.add(field.split(".")[0].split("[")[0])
+            if spec:
+                fields |= template_fields(spec)
+    return fields
+
+def compile_renamer(numbering=(False, "", 0, ""), removing=(False, ""),
+                    lowercase=False, substitutions=(), template=None):
+    """
+    Builds the function giving each file its new name. Everything that
+    doesn't depend on the file (format strings, regular expressions, the
+    translation table) is prepared here, once.
+    :param numbering: Numbering option of move_files
+    :param removing: Tuple containing boolean to determine if to remove or
+    not and the characters to be removed from the filenames
+    :param lowercase: Boolean for whether to transform filenames to lowercase
+    :param substitutions: Sequence of (regular expression, replacement)
+    pairs applied to the original name, in order
+    :param template: Optional format string of the new names, overriding
+    numbering; it may use {n} (position in the pre-order), {name} (original
+    name), {stem} (name without extension) and {ext} (extension, period
+    included), e.g. "{n:04d}_{stem}{ext}"
+    :return: Callable taking (position, original name) and returning the
+    new name
+    """
+    if template is None:
+        template = numbering_template(numbering)
+
+    # Character removal and lowercase, fused in a single step
+    table = str.maketrans("", "", removing[1]) \
+        if removing[0] and removing[1] else None
+
+    if table is not None and lowercase:
+        def finish(name):
+            return name.translate(table).lower()
+    elif table is not None:
+        def finish(name):
+            return name.translate(table)
+    elif lowercase:
+        finish = str.lower
+    else:
+        finish = None
+
+    compiled = [(re.compile(pattern), replacement)
+                for pattern, replacement in substitutions]
+
+    def substitute(name):
+        for regex, replacement in compiled:
+            name = regex.sub(replacement, name)
+        return name
+
+    if template is None:
+        # The files keep their names, maybe transformed
+        if compiled and finish is not None:
+            def rename(i, name):
+                return finish(substitute(name))
+        elif compiled:
+            def rename(i, name):
+                return substitute(name)
+        elif finish is not None:
+            def rename(i, name):
+                return finish(name)
+        else:
+            def rename(i, name):
+                return name
+        return rename
+
+    # Empty and numeric fields ("{}", "{0}") are positional, and there is
+    # no positional argument
+    fields = template_fields(template)
+    unknown = fields - set(("n", "name", "stem", "ext"))
+    if unknown:
+        raise ValueError("Unknown fields in template: {}".format(
+            ", ".join("{" + field + "}" for field in sorted(unknown))))
+
+    render = template.format
+    split = "stem" in fields or "ext" in fields
+
+    def rename(i, name):
+        if compiled:
+            name = substitute(name)
+        if split:
+            # If the filename has no extension, nothing else is appended
+            period = name.rfind(".")
+            if period > 0:
+                new_name = render(n=i, name=name, stem=name[:period],
+                                  ext=name[period:])
+            else:
+                new_name = render(n=i, name=name, stem=name, ext="")
+        else:
+            new_name = render(n=i, name=name)
+        return finish(new_name) if finish is not None else new_name
+
+    return rename
@@ -0,0 +1,281 @@
+"""
+FileOrganizer_shard.py: Executes the plan of a huge job in several worker
+                        processes, so that the work done per file (logging,
+                        verifying copies, copy loops) isn't bound to a
+                        single interpreter. The plan is computed first, as
+                        usual, so every file already has its final name;
+                        it's then cut into shards of consecutive entries,
+                        each one executed by execute_plan in a worker.
+                        Workers send back what they did through the pool's
+                        pipes, and the parent journals it.
+"""
+__author__ = "Carlos Montes"
+
+import logging
+import logging.handlers
+import multiprocessing
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from logging import info as log_info
+from logging import error as log_error
+from FileOrganizer import execute_plan, FilesNotProcessed
+from FileOrganizer_plan import LINK
+from FileOrganizer_utils import same_directory
+from FileOrganizer_metrics import JobHooks
+
+# Most entries of a shard; shards are smaller on small jobs, so that every
+# process gets several of them
+SHARD_FILES = 1000
+SHARDS_PER_PROCESS = 4
+
+# Shards submitted ahead of the ones running, per process; cancelling a job
+# lets the shards submitted end
+QUEUED_PER_PROCESS = 2
+
+class ShardRecord(object):
+    """
+    Stands for the journal in a worker: records which entries of its shard
+    execute_plan completed, by their position in the shard.
+    """
+
+    def __init__(self, size, resumed=False):
+        """
+        :param size: Number of entries of the shard
+        :param resumed: Boolean telling whether the job is resumed, so the
+        operations right before the interruption may have happened already
+        """
+        self.resumed = resumed
+        self.done = bytearray(size)
+        # Position in the shard of the first entry given to execute_plan
+        self.offset = 0
+
+    def is_done(self, index):
+        return self.done[self.offset + index] == 1
+
+    def completed(self, index):
+        self.done[self.offset + index] = 1
+
+class ShardHooks(JobHooks):
+    """
+    Records the events of a shard, to be replayed in the parent's hooks.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.syscalls = {}
+        self.files = []
+
+    def stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def calls(self, name, count=1):
+        self.syscalls[name] = self.syscalls.get(name, 0) + count
+
+    def file_done(self, seconds, copied):
+        self.files.append((seconds, copied))
+
+    def replay(self, hooks):
+        """
+        :param hooks: JobHooks receiving the recorded events
+        :return: None
+        """
+        for name, seconds in self.stages.items():
+            hooks.stage(name, seconds)
+        for name, count in self.syscalls.items():
+            hooks.calls(name, count)
+        for seconds, copied in self.files:
+            hooks.file_done(seconds, copied)
+
+def init_worker(log_queue, level):
+    """
+    Sends the log records of a worker process to the parent, which writes
+    them to its own log. The messages are formatted in the worker.
+    :param log_queue: multiprocessing Queue read by the parent
+    :param level: Level of the parent's root logger
+    :return: None
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+def run_shard(origin, destination, shard, workers=1, verify=False,
+              timed=False, resumed=False):
+    """
+    Executes a shard, going on after the files that fail.
+    :param origin: Directory from which the files are moved/duplicated
+    :param destination: Pathname to contain the specified files
+    :param shard: List of (index in the plan, PlanEntry) tuples
+    :param workers: Number of copying threads, as in execute_plan
+    :param verify: Boolean for whether to compare every copy with its
+    original
+    :param timed: Boolean for whether to record the events of the shard
+    :param resumed: Boolean telling whether the job is resumed
+    :return: Tuple of (indexes in the plan of the entries completed, bytes
+    processed, list of (filename, error) tuples, ShardHooks or None)
+    """
+    entries = [entry for _, entry in shard]
+    record = ShardRecord(len(entries), resumed)
+    hooks = ShardHooks() if timed else None
+    errors = []
+
+    while record.offset < len(entries):
+        try:
+            execute_plan(origin, destination, entries[record.offset:],
+                         workers=workers, journal=record, verify=verify,
+                         metrics=hooks)
+            break
+        except FilesNotProcessed as error:
+            # Parallel copies already went through the whole shard
+            errors.extend(error.errors)
+            break
+        except (IOError, OSError) as error:
+            # Files are processed one by one otherwise: the first one not
+            # done failed, the next ones are still to do
+            failed = record.done.index(0, record.offset)
+            log_error("Could not process %s: %s", entries[failed].source,
+                      error)
+            errors.append((entries[failed].source, error))
+            record.offset = failed + 1
+
+    completed = [i for i, done in enumerate(record.done) if done]
+    return ([shard[i][0] for i in completed],
+            sum(entries[i].size for i in completed), errors, hooks)
+
+def execute_sharded(origin, destination, plan, progress=None,
+                    cancelled=None, workers=1, journal=None, verify=False,
+                    metrics=None, processes=2):
+    """
+    Applies a plan like FileOrganizer's execute_plan, in several processes.
+    The plan is held in memory, as it's cut into shards. Renaming files
+    within their own folder runs in this process instead: a file may take
+    the name another one leaves, so the order of the plan matters.
+    :param origin: Directory from which the files are moved/duplicated
+    :param destination: Pathname to contain the specified files
+    :param plan: Iterable of PlanEntry
+    :param progress: Optional callable receiving (files done, total files,
+    bytes processed since the last call) after each shard
+    :param cancelled: Optional callable returning True when the job should
+    stop; it's checked between shards, the ones submitted are finished
+    :param workers: Number of copying threads of each process
+    :param journal: Optional Journal of the plan; entries it has as done are
+    skipped, and the completed ones are recorded in it shard by shard
+    :param verify: Boolean for whether to compare every copy with its
+    original
+    :param metrics: Optional JobHooks receiving the events of every shard
+    :param processes: Number of worker processes. They start a fresh
+    interpreter, which imports the caller's main module again: scripts
+    calling this must do so under an 'if __name__ == "__main__":' guard. If
+    the workers can't run, the job goes on in this process
+    :return: Number of files processed
+    """
+    if processes <= 1 or same_directory(origin, destination):
+        return execute_plan(origin, destination, plan, progress, cancelled,
+                            workers, journal, verify, metrics)
+
+    is_done = journal.is_done if journal is not None else None
+    resumed = journal is not None and journal.resumed
+
+    # Hardlinks may point to copies made by any shard: they're made last,
+    # here
+    tasks = []
+    links = []
+    for i, entry in enumerate(plan):
+        if is_done is not None and is_done(i):
+            continue
+        (links if entry.action == LINK else tasks).append((i, entry))
+    total = len(tasks) + len(links)
+
+    # Plans go folder by folder, so consecutive entries mostly share their
+    # destination folder
+    size = max(1, min(SHARD_FILES,
+                      -(-len(tasks) // (processes * SHARDS_PER_PROCESS))))
+    shards = iter([tasks[start:start + size]
+                   for start in range(0, len(tasks), size)])
+    del tasks
+
+    done = [0]
+    errors = []
+
+    def collect(result):
+        """
+        Accounts for a finished shard.
+        :param result: Tuple returned by run_shard
+        :return: None
+        """
+        completed, processed, shard_errors, hooks = result
+        if journal is not None:
+            for index in completed:
+                journal.completed(index)
+        if hooks is not None and metrics is not None:
+            hooks.replay(metrics)
+        errors.extend(shard_errors)
+        done[0] += len(completed)
+        if progress is not None:
+            progress(done[0], total, processed)
+
+    log_info("Executing %d files in %d processes", total, processes)
+
+    # Workers start from a fresh interpreter: forking a process that runs
+    # threads, such as the log's, may copy locks held by them
+    context = multiprocessing.get_context("spawn")
+    log_queue = context.Queue()
+    root = logging.getLogger()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers)
+    listener.start()
+    # Shards submitted and not collected yet, by future
+    submitted = {}
+    try:
+        with ProcessPoolExecutor(processes, mp_context=context,
+                                 initializer=init_worker,
+                                 initargs=(log_queue, root.level)) as pool:
+            pending = set()
+            while True:
+                while len(pending) < processes * (1 + QUEUED_PER_PROCESS) \
+                        and not (cancelled is not None and cancelled()):
+                    shard = next(shards, None)
+                    if shard is None:
+                        break
+                    future = pool.submit(run_shard, origin, destination,
+                                         shard, workers, verify,
+                                         metrics is not None, resumed)
+                    submitted[future] = shard
+                    pending.add(future)
+                if not pending:
+                    break
+
+                finished, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                for future in finished:
+                    collect(future.result())
+                    del submitted[future]
+    except BrokenProcessPool as error:
+        # A worker died, or none could start (a caller script without a
+        # __main__ guard): the shards not collected run here instead
+        log_error("Worker processes failed (%s), going on in a single "
+                  "process", error)
+        for future, shard in list(submitted.items()):
+            if future.done() and future.exception() is None:
+                collect(future.result())
+                del submitted[future]
+        # A dead worker may have left operations half done
+        for shard in chain(list(submitted.values()), shards):
+            if cancelled is not None and cancelled():
+                break
+            collect(run_shard(origin, destination, shard, workers, verify,
+                              metrics is not None, True))
+    finally:
+        listener.stop()
+        log_queue.close()
+
+    if cancelled is not None and cancelled():
+        log_info("Job cancelled after %d of %d files", done[0], total)
+    elif links:
+        collect(run_shard(origin, destination, links, workers, verify,
+                          metrics is not None, resumed))
+
+    if errors:
+        raise FilesNotProcessed(errors, done[0])
+    return done[0]
@@ -0,0 +1,241 @@
+"""
+FileOrganizer_sort.py: Sort engine of the pre-orders. Every name gets a
+                       precomputed string key, so sorting is done by plain
+                       string comparisons: natural order ("img2" before
+                       "img10") and numbers found next to a pattern.
+"""
+__author__ = "Carlos Montes"
+
+import re
+import heapq
+import pickle
+from itertools import repeat
+from operator import itemgetter, add
+
+# Longest run of digits ordered by its value; filenames are far shorter
+NUMBER_MAX_DIGITS = 999
+
+# Separator of the parts of a key; it can't appear in a filename
+SEPARATOR = "\0"
+
+# Records held in memory by external_sort; larger sorts spill sorted runs
+# to temporary files
+SORT_MEMORY_ITEMS = 1000000
+
+# Records pickled together in the runs, and names keyed at once
+RUN_BLOCK_ITEMS = 10000
+KEY_CHUNK_ITEMS = 65536
+
+# Splits the names around their runs of digits, which are kept
+_digits = re.compile(r"(\d+)")
+
+# Every run of digits is prefixed with its length, leading zeros aside, so
+# that a longer number sorts after all the shorter ones
+_length_prefix = ["{:03d}".format(n) for n in range(NUMBER_MAX_DIGITS + 1)]
+
+def _number_key(digits):
+    """
+    :param digits: Run of digits
+    :return: Key of the run, ordered by its value
+    """
+    digits = digits.lstrip("0")
+    return _length_prefix[len(digits)] + digits
+
+def natural_keys(names):
+    """
+    Computes the natural sort key of every name: each run of digits is
+    compared by its numeric value and several numbers in a name are
+    compared in turn. Equal keys (e.g. "img02" and "img2") are tied by
+    the name itself.
+    :param names: Sequence of filenames
+    :return: List of string keys, in the same order
+    """
+    # A single split over all the names at once; every other part is a run
+    # of digits. Builtins map them, so no Python frame is created per number
+    parts = _digits.split(SEPARATOR.join(names))
+    runs = list(map(str.lstrip, parts[1::2], repeat("0")))
+    parts[1::2] = map(add, map(_length_prefix.__getitem__, map(len, runs)),
+                      runs)
+    keyed = "".join(parts).split(SEPARATOR)
+    return [key + SEPARATOR + name for key, name in zip(keyed, names)]
+
+def sort_by_keys(names, keys, reverse=False):
+    """
+    Sorts names by precomputed keys.
+    :param names: Sequence of filenames
+    :param keys: Sequence of keys, one per name
+    :param reverse: Boolean telling whether to sort in descending order
+    :return: List of sorted filenames
+    """
+    order = sorted(range(len(keys)), key=keys.__getitem__, reverse=reverse)
+    return [names[i] for i in order]
+
+def natural_sort(names, reverse=False):
+    """
+    Sorts filenames in natural order.
+    :param names: Sequence of filenames
+    :param reverse: Boolean telling whether to sort in descending order
+    :return: List of sorted filenames
+    """
+    names = list(names)
+    return sort_by_keys(names, natural_keys(names), reverse)
+
+def pattern_regex(pattern, before):
+    """
+    Compiles the regular expression finding the number of the custom
+    pre-order.
+    :param pattern: String next to the number; if empty, the number is the
+    whole name up to its extension
+    :param before: Boolean telling whether the number is before the pattern
+    (from the start of the name) or after it
+    :return: Compiled regular expression whose first group is the number
+    """
+    if not pattern:
+        return re.compile(r"^(\d+)(?:\.|$)")
+    elif before:
+        return re.compile(r"^(\d+)" + re.escape(pattern))
+    return re.compile(re.escape(pattern) + r"(\d+)")
+
+def pattern_keys(names, pattern, before):
+    """
+    Computes the keys of the custom pre-order: files are ordered by the
+    number found next to the pattern, then in natural order. Files without
+    such a number go after all the others, in natural order.
+    :param names: Sequence of filenames
+    :param pattern: String next to the number
+    :param before: Boolean telling whether the number is before the pattern
+    :return: List of string keys, in the same order
+    """
+    search = pattern_regex(pattern, before).search
+    keys = []
+
+    for name, key in zip(names, natural_keys(names)):
+        match = search(name)
+        if match is None:
+            keys.append("1" + SEPARATOR + key)
+        else:
+            keys.append("0" + _number_key(match.group(1)) + SEPARATOR +
+                        key)
+
+    return keys
+
+def pattern_sort(names, pattern, before):
+    """
+    Sorts filenames by the number found next to a pattern.
+    Parameters are the same as pattern_keys'.
+    :return: List of sorted filenames
+    """
+    names = list(names)
+    return sort_by_keys(names, pattern_keys(names, pattern, before))
+
+# ------- STREAMING SORT ------------
+# The pre-orders of a job are sorted as (key, filename) records, whose keys
+# are computed chunk by chunk and never need to be in memory all at once.
+# Record generators yield lists of records, one per chunk.
+
+def natural_records(names):
+    """
+    :param names: List of filenames
+    :return: Generator of lists of (natural key, filename) records
+    """
+    for start in range(0, len(names), KEY_CHUNK_ITEMS):
+        chunk = names[start:start + KEY_CHUNK_ITEMS]
+        yield list(zip(natural_keys(chunk), chunk))
+
+def pattern_records(names, pattern, before):
+    """
+    :param names: List of filenames
+    :param pattern: String next to the number
+    :param before: Boolean telling whether the number is before the pattern
+    :return: Generator of lists of (pattern key, filename) records, see
+    pattern_keys
+    """
+    for start in range(0, len(names), KEY_CHUNK_ITEMS):
+        chunk = names[start:start + KEY_CHUNK_ITEMS]
+        yield list(zip(pattern_keys(chunk, pattern, before), chunk))
+
+def value_records(names, value_of):
+    """
+    :param names: List of filenames
+    :param value_of: Callable returning the value of a filename, or None
+    :return: Generator of lists of (key, filename) records; files without
+    a value go after all the others
+    """
+    for start in range(0, len(names), KEY_CHUNK_ITEMS):
+        chunk = names[start:start + KEY_CHUNK_ITEMS]
+        records = []
+        for key, name in zip(natural_keys(chunk), chunk):
+            value = value_of(name)
+            if value is None:
+                records.append(((1, 0, key), name))
+            else:
+                records.append(((0, value, key), name))
+        yield records
+
+_record_key = itemgetter(0)
+
+def _write_run(records):
+    """
+    Pickles sorted records into a temporary file, in blocks.
+    :param records: Sorted list of records
+    :return: Temporary file, rewound
+    """
+    # Only sorts too large for memory need tempfile, so it isn't loaded
+    # with the module
+    from tempfile import TemporaryFile
+    run = TemporaryFile()
+    for start in range(0, len(records), RUN_BLOCK_ITEMS):
+        pickle.dump(records[start:start + RUN_BLOCK_ITEMS], run,
+                    pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+def _read_run(run):
+    """
+    :param run: Temporary file written by _write_run
+    :return: Generator of its records, reading a block at a time
+    """
+    while True:
+        try:
+            block = pickle.load(run)
+        except EOFError:
+            return
+        for record in block:
+            yield record
+
+def external_sort(chunks, reverse=False, max_items=SORT_MEMORY_ITEMS):
+    """
+    Sorts records holding about max_items of them in memory: every time
+    that many are gathered, they are sorted and written to a temporary
+    file, and the files are merged at the end. Small sorts never touch the
+    disk.
+    :param chunks: Iterable of lists of picklable (key, value) records;
+    keys must be unique and comparable, values are never compared
+    :param reverse: Boolean telling whether to sort in descending order
+    :param max_items: Number of records sorted in memory at once
+    :return: Generator of the sorted records
+    """
+    runs = []
+    buffer = []
+
+    try:
+        for chunk in chunks:
+            buffer.extend(chunk)
+            if len(buffer) > max_items:
+                buffer.sort(key=_record_key, reverse=reverse)
+                runs.append(_write_run(buffer))
+                buffer = []
+
+        buffer.sort(key=_record_key, reverse=reverse)
+        if not runs:
+            yield from buffer
+            return
+
+        runs.append(_write_run(buffer))
+        buffer = []
+        for record in heapq.merge(*[_read_run(run) for run in runs],
+                                  key=_record_key, reverse=reverse):
+            yield record
+    finally:
+        for run in runs:
+            run.close()
@@ -0,0 +1,336 @@
+"""
+FileOrganizer_spec.py: Job specs: every option of a job in a single typed
+                       object, validated once, saved as JSON or TOML and
+                       loaded as a preset by the window and the command
+                       line. A spec compiles into a CompiledJob, whose
+                       pre-order and renaming functions are built once, so
+                       recurring jobs skip parsing and validation.
+"""
+__author__ = "Carlos Montes"
+
+import os
+import re
+import json
+from os.path import expanduser
+import FileOrganizer
+from FileOrganizer_utils import retrieve_directory_content
+from FileOrganizer_rename import compile_renamer, DEFAULT_DIGITS
+from FileOrganizer_plan import plan_moves, compile_preorder
+from FileOrganizer_plan import COLLISIONS, SKIP_EXISTING, OVERWRITE
+from FileOrganizer_copy import DEFAULT_WORKERS
+from FileOrganizer_dedup import SKIP_DUPLICATES, LINK_DUPLICATES
+
+# Directory offered by the window for its presets
+PRESET_DIR = os.path.join(expanduser("~"), ".file_organizer", "presets")
+
+# Version of the format of saved specs
+SPEC_FORMAT = 1
+
+# Pre-order names and their id_order in move_files
+ORDERS = {"alpha": 0, "reverse": 1, "created": 2, "number": 3,
+          "modified": 4, "size": 5, "taken": 6}
+
+# Deduplication modes, None copying every file
+DEDUP_MODES = (None, SKIP_DUPLICATES, LINK_DUPLICATES)
+
+# Fields of a spec: name, type of the value (list for lists of strings,
+# tuple for lists of string pairs) and default. A None default also lets
+# the field be None; an empty origin or destination makes the spec invalid
+FIELDS = (
+    ("origin", str, ""),
+    ("destination", str, ""),
+    ("files", list, None),
+    ("recursive", bool, False),
+    ("flatten", bool, False),
+    ("include", list, []),
+    ("exclude", list, []),
+    ("order", str, "alpha"),
+    ("order_pattern", str, ""),
+    ("number_before_pattern", bool, False),
+    ("number", int, None),
+    ("name", str, ""),
+    ("name_after_number", bool, False),
+    ("template", str, None),
+    ("substitutions", tuple, []),
+    ("remove", str, ""),
+    ("lowercase", bool, False),
+    ("duplicate", bool, False),
+    ("collisions", str, SKIP_EXISTING),
+    ("dedup", str, None),
+    ("workers", int, DEFAULT_WORKERS),
+    ("verify", bool, False),
+    ("processes", int, 1),
+    ("remote", bool, False),
+)
+FIELD_NAMES = tuple(name for name, _, _ in FIELDS)
+
+class JobSpec(object):
+    """
+    Every option of a job, by name: the origin and destination, the files
+    (None for every file of origin, listed when the job runs), the filters,
+    the pre-order, the renaming and how files are transferred.
+    """
+
+    def __init__(self, **fields):
+        """
+        :param fields: Values of the fields of FIELDS; the others get their
+        default
+        """
+        unknown = set(fields).difference(FIELD_NAMES)
+        if unknown:
+            raise ValueError("Unknown job spec fields: {}".format(
+                ", ".join(sorted(unknown))))
+
+        for name, kind, default in FIELDS:
+            value = fields.get(name, default)
+            # Lists are copied, so that specs never share them, and pairs
+            # become lists, as they're read back from JSON
+            if isinstance(value, (list, tuple)):
+                value = [list(item) if kind is tuple and
+                         isinstance(item, tuple) else item
+                         for item in value]
+            setattr(self, name, value)
+
+    def validate(self):
+        """
+        Checks the type and value of every field.
+        :return: None
+        :raise ValueError: Describing the first invalid field
+        """
+        for name, kind, default in FIELDS:
+            value = getattr(self, name)
+            if value is None and default is None:
+                continue
+
+            if kind is list:
+                valid = isinstance(value, list) and \
+                    all(isinstance(item, str) for item in value)
+            elif kind is tuple:
+                valid = isinstance(value, list) and \
+                    all(isinstance(pair, (list, tuple)) and
+                        len(pair) == 2 and
+                        all(isinstance(item, str) for item in pair)
+                        for pair in value)
+            elif kind is int:
+                # True and False are ints too
+                valid = isinstance(value, int) and \
+                    not isinstance(value, bool)
+            else:
+                valid = isinstance(value, kind)
+
+            if not valid:
+                raise ValueError("Invalid job spec field {}: {!r}".format(
+                    name, value))
+
+        if not self.origin or not self.destination:
+            raise ValueError("A job spec needs an origin and a destination")
+        if self.order not in ORDERS:
+            raise ValueError("Unknown pre-order: {}".format(self.order))
+        if self.collisions not in COLLISIONS:
+            raise ValueError("Unknown collision strategy: {}".format(
+                self.collisions))
+        if self.dedup not in DEDUP_MODES:
+            raise ValueError("Unknown deduplication mode: {}".format(
+                self.dedup))
+        if self.number is not None and self.number < 1:
+            raise ValueError("Numbers need at least one digit")
+        if self.workers < 1:
+            raise ValueError("Jobs need at least one worker")
+        if self.processes < 1:
+            raise ValueError("Jobs need at least one process")
+
+        for pattern, _ in self.substitutions:
+            try:
+                re.compile(pattern)
+            except re.error as error:
+                raise ValueError("Invalid regular expression {!r}: "
+                                 "{}".format(pattern, error))
+
+    def to_dict(self):
+        """
+        :return: Dictionary of every field, ready for JSON
+        """
+        return dict((name, getattr(self, name)) for name in FIELD_NAMES)
+
+    @classmethod
+    def from_dict(cls, record):
+        """
+        :param record: Dictionary of fields, as saved; a "format" key is
+        checked and left out
+        :return: Validated JobSpec
+        """
+        record = dict(record)
+        if record.pop("format", SPEC_FORMAT) != SPEC_FORMAT:
+            raise ValueError("Unsupported job spec format")
+        spec = cls(**record)
+        spec.validate()
+        return spec
+
+    def save(self, pathname):
+        """
+        Writes the spec to a file: TOML if its extension is .toml, JSON
+        otherwise. Fields that are None are left out of TOML files.
+        :param pathname: Pathname of the file
+        :return: None
+        """
+        record = {"format": SPEC_FORMAT}
+        record.update(self.to_dict())
+
+        if pathname.lower().endswith(".toml"):
+            text = "".join("{} = {}\n".format(name, toml_value(value))
+                           for name, value in record.items()
+                           if value is not None)
+        else:
+            text = json.dumps(record, indent=2) + "\n"
+
+        with open(pathname, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    @classmethod
+    def load(cls, pathname):
+        """
+        Reads a spec saved by save.
+        :param pathname: Pathname of a .toml or JSON file
+        :return: Validated JobSpec
+        """
+        if pathname.lower().endswith(".toml"):
+            toml = toml_module()
+            with open(pathname, "rb") as f:
+                try:
+                    record = toml.load(f)
+                except toml.TOMLDecodeError as error:
+                    raise ValueError("{}: {}".format(pathname, error))
+        else:
+            with open(pathname, encoding="utf-8") as f:
+                record = json.load(f)
+
+        if not isinstance(record, dict):
+            raise ValueError("{}: not a job spec".format(pathname))
+        return cls.from_dict(record)
+
+    def compile(self):
+        """
+        :return: CompiledJob of the spec, once validated
+        """
+        return CompiledJob(self)
+
+class CompiledJob(object):
+    """
+    A validated JobSpec, turned into move_files' arguments, with its
+    pre-order and renaming functions already built. It can be planned and
+    run any number of times.
+    """
+
+    def __init__(self, spec):
+        """
+        :param spec: JobSpec; it's validated here
+        """
+        spec.validate()
+        self.spec = spec
+
+        self.id_order = ORDERS[spec.order]
+        self.custom_preorder = (int(spec.number_before_pattern),
+                                spec.order_pattern)
+        self.numbering = (spec.number is not None,
+                          str(spec.number or DEFAULT_DIGITS),
+                          int(spec.name_after_number), spec.name)
+        self.removing = (bool(spec.remove), spec.remove)
+        substitutions = tuple(tuple(pair) for pair in spec.substitutions)
+
+        self.preorder = compile_preorder(self.id_order, self.custom_preorder)
+        self.rename = compile_renamer(self.numbering, self.removing,
+                                      spec.lowercase, substitutions,
+                                      spec.template)
+
+    def arguments(self, files=None):
+        """
+        :param files: Filenames to process instead of the spec's
+        :return: Tuple of positional arguments of move_files. Without
+        files, in the spec or given, the origin is listed now (or walked
+        by the job, if recursive)
+        """
+        spec = self.spec
+        if files is None:
+            files = spec.files
+        if files is None and not spec.recursive:
+            files = retrieve_directory_content(spec.origin)
+
+        return (spec.origin, files, spec.destination, self.id_order,
+                self.custom_preorder, self.numbering, self.removing,
+                spec.lowercase, spec.duplicate,
+                spec.collisions == OVERWRITE)
+
+    def plan_keywords(self):
+        """
+        :return: Dictionary of the keyword arguments of plan_moves, the
+        compiled functions excepted
+        """
+        spec = self.spec
+        return {"substitutions": [list(pair) for pair in spec.substitutions],
+                "template": spec.template, "recursive": spec.recursive,
+                "include": list(spec.include), "exclude": list(spec.exclude),
+                "flatten": spec.flatten, "workers": spec.workers,
+                "collisions": spec.collisions}
+
+    def keywords(self):
+        """
+        :return: Dictionary of the keyword arguments of move_files, JSON
+        serializable, as the queue takes them
+        """
+        keywords = self.plan_keywords()
+        keywords.update({"dedup": self.spec.dedup,
+                         "verify": self.spec.verify,
+                         "processes": self.spec.processes,
+                         "remote": self.spec.remote})
+        return keywords
+
+    def plan(self, files=None):
+        """
+        :param files: Filenames to process instead of the spec's
+        :return: Tuple of PlanEntry of the job, see plan_moves
+        """
+        return plan_moves(*self.arguments(files), rename=self.rename,
+                          preorder=self.preorder, **self.plan_keywords())
+
+    def run(self, files=None, **options):
+        """
+        Runs the job.
+        :param files: Filenames to process instead of the spec's
+        :param options: Other keyword arguments of move_files, such as
+        progress, cancelled, journal or metrics
+        :return: Number of files processed
+        """
+        return FileOrganizer.move_files(*self.arguments(files),
+                                        rename=self.rename,
+                                        preorder=self.preorder,
+                                        **dict(self.keywords(), **options))
+
+def toml_value(value):
+    """
+    :param value: String, boolean, number or list of them, nested or not
+    :return: Its TOML representation
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(toml_value(item) for item in value) + "]"
+    # JSON escapes are valid in TOML basic strings, DEL aside
+    return json.dumps(value, ensure_ascii=False).replace("\x7f", "\\u007f")
+
+def toml_module():
+    """
+    :return: Module reading TOML: tomllib, from Python 3.11, or tomli
+    """
+    try:
+        import tomllib
+        return tomllib
+    except ImportError:
+        pass
+    try:
+        import tomli
+        return tomli
+    except ImportError:
+        raise ValueError("Reading TOML needs Python 3.11 or the tomli "
+                         "package")
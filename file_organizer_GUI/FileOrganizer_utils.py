@@ -1,44 +1,82 @@
 """"
-FileOrganizer_utils.py: Provides utilities for the GUI package.
-                        Mainly imports either PySide or PyQt4 in order
-                        to display a GUI for the user, along with logging
-                        and other utility functions.
+FileOrganizer_utils.py: Provides utilities for the package: logging,
+                        directory scanning and other utility functions.
+                        It doesn't import any GUI toolkit, so that
+                        FileOrganizer can run on headless machines.
 """
 
-try:
-    # GUI namespaces pulled from PySide, if present in the system.
-    # based on Robert Galanakis' "Practical Maya Programming with Python"
-    # available at https://books.google.ca/books?id=ESAZBAAAQBAJ
-
-    from PySide import QtCore, QtGui
-    import shiboken
-
-    # Signal class aliases the PySide.QtCore.Signal class
-    Signal = QtCore.SIGNAL
-
-except ImportError:
-    # Namespaces pulled from PyQt implementation, in the absence of PySide
-    from PyQt4 import QtCore, QtGui
-    import sip
-
-    # Signal class aliases the PyQt4.QtCore.pyqtSignal class
-    Signal = QtCore.SIGNAL
-
 import os
+import atexit
 import logging
+from collections import namedtuple
+from FileOrganizer_sort import natural_sort
 
 # ------- LOGGING FEATURE ------------
 LOG_FILENAME = "file_mover_log.log"
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(funcName)s - %(message)s"
 
+# Listener writing the records in the background, once logging started
+_log_listener = None
+
 def start_logging(filename=LOG_FILENAME,
                   log_level=logging.INFO,
-                  log_format=LOG_FORMAT):
+                  log_format=LOG_FORMAT,
+                  json_lines=False):
+    """
+    Starts logging into a rotating file through a queue, so that logging
+    costs the caller little more than creating the record; a background
+    thread formats the records and writes them in batches. Only the first
+    call has an effect.
+    :param filename: Pathname of the log file
+    :param log_level: Minimum level of the logged records
+    :param log_format: Format of the records, if not json_lines
+    :param json_lines: Boolean for whether to write records as JSON lines
+    """
+    global _log_listener
+
+    if _log_listener is not None:
+        return
+
+    # Loaded with the first job rather than with the program
+    import queue
+    from FileOrganizer_log import (LazyQueueHandler, BatchQueueListener,
+                                   BatchFileHandler, JsonFormatter)
+
+    handler = BatchFileHandler(os.path.normpath(filename))
+    handler.setFormatter(JsonFormatter() if json_lines
+                         else logging.Formatter(log_format))
+
+    log_queue = queue.SimpleQueue()
+    _log_listener = BatchQueueListener(log_queue, handler)
+    _log_listener.start()
+
+    root = logging.getLogger()
+    root.addHandler(LazyQueueHandler(log_queue))
+    root.setLevel(log_level)
+
+    atexit.register(stop_logging)
+
+def stop_logging():
     """
-    Starts basic logging of a module.
+    Writes any pending record and stops the logging thread.
     """
-    logging.basicConfig(filename=os.path.normpath(filename),
-                        level=log_level, format=log_format)
+    global _log_listener
+
+    if _log_listener is None:
+        return
+
+    from FileOrganizer_log import LazyQueueHandler
+
+    listener, _log_listener = _log_listener, None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.flush()
+        handler.close()
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, LazyQueueHandler):
+            root.removeHandler(handler)
 
 # ------- UTILITY FUNCTIONS ----------
 
@@ -54,6 +92,47 @@ def norm_pathname(pathname=""):
         # Convert QString to str to avoid posix difficulties
         return os.path.normpath(str(pathname))
 
+def same_directory(first, second):
+    """
+    :param first: Pathname of a directory
+    :param second: Pathname of another directory, existing or not
+    :return: Boolean telling whether both are the same directory
+    """
+    try:
+        return os.path.samefile(first, second)
+    except OSError:
+        return False
+
+# Lightweight record of a file, stat'ed once while listing its directory
+FileEntry = namedtuple("FileEntry", "name size mtime ctime inode")
+
+def scan_directory(directory, wanted=None):
+    """
+    Lists the files inside a directory with a single os.scandir pass,
+    reading the stat information of each file only once.
+    :param directory: Normalized pathname of a directory
+    :param wanted: Optional collection of filenames; if given, only those
+    files are stat'ed and returned
+    :return: List of FileEntry records (directories skipped), unsorted
+    """
+    # Convert directory to explicit str, to avoid posixpath complications
+    directory = str(directory)
+
+    content = []
+    for entry in os.scandir(directory):
+        if wanted is not None and entry.name not in wanted:
+            continue
+        try:
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+        except OSError:
+            # The file vanished (or is a broken link) while listing
+            continue
+        content.append(FileEntry(entry.name, st.st_size, st.st_mtime,
+                                 st.st_ctime, st.st_ino))
+    return content
+
 def retrieve_directory_content(directory):
     """
     Retrieves and sorts the filenames inside a specified directory.
@@ -63,22 +142,30 @@ def retrieve_directory_content(directory):
     # Convert directory to explicit str, to avoid posixpath complications
     directory = str(directory)
 
-    content = [f for f in os.listdir(directory)
-               if os.path.isfile(os.path.join(directory, f))]
+    # The file type comes with the directory listing itself on most
+    # systems, so no file needs to be stat'ed just to display its name
+    content = []
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file():
+                content.append(entry.name)
+        except OSError:
+            continue
     content.sort()
     return content
 
 def sort_list(lst, pairs=False, rev=False):
     """
-    Sorts a list and returns it.
+    Sorts a list and returns it. Filenames are sorted in natural order.
     :param lst: List to sort and return
     :param pairs: Boolean that tells if the list contains tuples
     that will contain a first value with purposes of ordering
     :param rev: Boolean that tells whether to reverse sort the list
     :return: List
     """
-    lst.sort(reverse=rev)
     if pairs:
+        lst.sort(reverse=rev)
         return [filename for organizer, filename in lst]
     else:
+        lst[:] = natural_sort(lst, rev)
         return lst
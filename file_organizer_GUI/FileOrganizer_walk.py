@@ -0,0 +1,150 @@
+"""
+FileOrganizer_walk.py: Walks a whole directory tree for the recursive mode
+                       of FileOrganizer. Directories are scanned by a pool
+                       of threads, and their files are streamed to the
+                       planner one directory at a time.
+"""
+__author__ = "Carlos Montes"
+
+import os
+import re
+from fnmatch import translate
+from concurrent.futures import ThreadPoolExecutor
+from logging import error as log_error
+from FileOrganizer_utils import FileEntry
+from FileOrganizer_copy import DEFAULT_WORKERS, QUEUED_PER_WORKER
+from FileOrganizer_sort import natural_sort
+
+def glob_matcher(patterns):
+    """
+    Compiles shell-style patterns ("*.jpg", "IMG_????.*", "raw/*.cr2") into
+    a single regular expression. Patterns without a slash are matched
+    against the filename, the others against the path relative to the root
+    of the walk.
+    :param patterns: Sequence of patterns
+    :return: Callable taking (filename, relative path) and returning True
+    if any pattern matches, or None if there are no patterns
+    """
+    def compile_patterns(selected):
+        if not selected:
+            return None
+        return re.compile("|".join(translate(os.path.normcase(pattern))
+                                   for pattern in selected)).match
+
+    match_name = compile_patterns([p for p in patterns if "/" not in p])
+    match_path = compile_patterns([p for p in patterns if "/" in p])
+
+    if match_name is None and match_path is None:
+        return None
+
+    def matches(name, path):
+        if match_name is not None and match_name(os.path.normcase(name)):
+            return True
+        if match_path is not None:
+            return match_path(os.path.normcase(path).replace(os.sep, "/")) \
+                is not None
+        return False
+
+    return matches
+
+def scan_tree_directory(directory):
+    """
+    Lists a directory of the tree with a single os.scandir pass. Symbolic
+    links to directories aren't followed, so the walk can't loop.
+    :param directory: Pathname of the directory
+    :return: Tuple of (list of FileEntry, list of subdirectory names); both
+    empty if the directory can't be read
+    """
+    files = []
+    subdirectories = []
+
+    try:
+        with os.scandir(directory) as iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.name)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    # The file vanished (or is a broken link) while listing
+                    continue
+                files.append(FileEntry(entry.name, st.st_size, st.st_mtime,
+                                       st.st_ctime, st.st_ino))
+    except OSError as error:
+        # Unreadable directories don't stop the walk
+        log_error("Could not list %s: %s", directory, error)
+
+    return files, subdirectories
+
+def walk_tree(root, include=(), exclude=(), wanted=None,
+              workers=DEFAULT_WORKERS, prune=()):
+    """
+    Walks a directory tree, depth first, subdirectories in natural order.
+    The directories coming next are scanned ahead by a pool of threads,
+    only a few at a time, so the walk never holds the whole tree in memory.
+    :param root: Pathname of the root directory
+    :param include: Patterns of the files to keep (all if empty)
+    :param exclude: Patterns of the files to leave out; directories
+    matching them aren't walked at all
+    :param wanted: Optional collection of paths relative to root; if given,
+    only those files are kept
+    :param workers: Number of scanning threads
+    :param prune: Paths relative to root of directories not to walk
+    :return: Generator of (directory path relative to root, "" for the root
+    itself, list of FileEntry of its files) pairs; directories without kept
+    files are not yielded
+    """
+    included = glob_matcher(include)
+    excluded = glob_matcher(exclude)
+    prune = set(os.path.normcase(path) for path in prune)
+    max_pending = max(1, workers) * QUEUED_PER_WORKER
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Directories still to yield, the next one last; each one with the
+        # future of its scan, or None until it's submitted
+        stack = [["", executor.submit(scan_tree_directory, root)]]
+        pending = 1
+
+        while stack:
+            relative, future = stack.pop()
+            if future is None:
+                future = executor.submit(scan_tree_directory,
+                                         os.path.join(root, relative))
+            else:
+                pending -= 1
+            files, subdirectories = future.result()
+
+            children = []
+            for name in natural_sort(subdirectories):
+                path = os.path.join(relative, name)
+                if os.path.normcase(path) in prune:
+                    continue
+                if excluded is None or not excluded(name, path):
+                    children.append([path, None])
+            stack.extend(reversed(children))
+
+            # Scan ahead the directories coming next
+            for item in reversed(stack):
+                if pending >= max_pending:
+                    break
+                if item[1] is None:
+                    item[1] = executor.submit(scan_tree_directory,
+                                              os.path.join(root, item[0]))
+                    pending += 1
+
+            kept = []
+            for entry in files:
+                path = os.path.join(relative, entry.name)
+                if wanted is not None and path not in wanted:
+                    continue
+                if included is not None and not included(entry.name, path):
+                    continue
+                if excluded is not None and excluded(entry.name, path):
+                    continue
+                kept.append(entry)
+
+            if kept:
+                yield relative, kept
@@ -6,12 +6,34 @@ FileOrganizer_window.py: Creates the interface's main window.
 """
 __author__ = "Carlos Montes"
 
+import os
 from os.path import expanduser
+from time import time
+from logging import error as log_error
+from itertools import compress
+from bisect import bisect_left
 import FileOrganizer
-from FileOrganizer_utils import (QtGui, QtCore, Signal,
-                                 norm_pathname,
+from FileOrganizer_copy import DEFAULT_WORKERS
+from FileOrganizer_plan import plan_moves, SKIP, OVERWRITE, COLLISIONS
+from FileOrganizer_journal import new_journal_path, interrupted_journals
+from FileOrganizer_journal import Journal, abandon_journal, prune_journals
+from FileOrganizer_metrics import JobMetrics
+from FileOrganizer_queue import JobQueue, RUNNING, ENDED
+from FileOrganizer_dedup import DedupIndex, deduplicate
+from FileOrganizer_rename import DEFAULT_DIGITS
+from FileOrganizer_spec import JobSpec, ORDERS, DEDUP_MODES, PRESET_DIR
+from FileOrganizer_qt import QtGui, QtCore, Signal
+from FileOrganizer_utils import (LOG_FILENAME, norm_pathname,
                                  retrieve_directory_content)
 
+# Milliseconds without folder changes before a list is refreshed, and
+# longest a refresh is postponed while the changes go on
+REFRESH_DELAY = 250
+REFRESH_MAX_DELAY = 2000
+
+# Milliseconds between two looks at the jobs other processes queued
+QUEUE_POLL_INTERVAL = 2000
+
 # --------- CLASSES AND SUBCLASSES ----------
 
 class FileOrganizerWindow(QtGui.QMainWindow):
@@ -51,9 +73,9 @@ class FileOrganizerWindow(QtGui.QMainWindow):
         self.origin_content = DirectoryContentList()
 
         # Fill the origin_content list with the user's Home content
-        # which will differ with the right side in that it's checkable
-        self.origin_content.populate_list(retrieve_directory_content(
-                                          expanduser("~")), True)
+        # which will differ with the right side in that it's checkable.
+        # It's listed in the background, so the window shows at once
+        self.origin_content.load(norm_pathname(expanduser("~")), True)
 
         # Set the content of the origin textbox to Home too
         self.browse_textbox1.setText(norm_pathname(expanduser("~")))
@@ -77,8 +99,7 @@ class FileOrganizerWindow(QtGui.QMainWindow):
         self.destination_content = DirectoryContentList()
 
         # Fill the Destination Content list with the script's location
-        self.destination_content.populate_list(retrieve_directory_content(
-                                               norm_pathname()), False)
+        self.destination_content.load(norm_pathname(), False)
 
         # Set the content of the destination textbox to getcwd() too
         self.browse_textbox2.setText(norm_pathname())
@@ -115,6 +136,19 @@ class FileOrganizerWindow(QtGui.QMainWindow):
         self.button_group.setId(date_radio, 2)
         date_label = new_label("Creation Date", 8)
 
+        # Metadata pre-orders
+        metadata_layouts = []
+        for order_id, text in ((4, "Modification Date"), (5, "Size"),
+                               (6, "Date Taken (photos, videos)")):
+            metadata_layout = QtGui.QHBoxLayout()
+            metadata_radio = QtGui.QRadioButton()
+            self.button_group.addButton(metadata_radio)
+            self.button_group.setId(metadata_radio, order_id)
+            metadata_layout.addWidget(metadata_radio)
+            metadata_layout.addWidget(new_label(text, 8))
+            metadata_layout.setAlignment(QtCore.Qt.AlignLeft)
+            metadata_layouts.append(metadata_layout)
+
         custom_layout = QtGui.QHBoxLayout()
         custom_radio = QtGui.QRadioButton()
         custom_layout.addStretch(1)
@@ -147,13 +181,83 @@ class FileOrganizerWindow(QtGui.QMainWindow):
         self.lowercase_check = new_checkbox("Transform to lowercase")
 
         # Process options combo
-        self.duplicate_check = new_checkbox("Duplicate files instead")
-
-        # Replace existing files checkbox
-        self.replace_files = new_checkbox("Avoid replacing existing files")
-
-        # Move Files button
+        duplicate_layout = QtGui.QHBoxLayout()
+        self.duplicate_check = new_checkbox("Duplicate files instead, with ")
+        self.workers_textbox = new_line_edit(40)
+        self.workers_textbox.setText(str(DEFAULT_WORKERS))
+        workers_label = new_label("threads", 9)
+
+        # What to do with files whose content is already in the destination
+        self.dedup_combo = new_combo(("Copy identical files too",
+                                      "Skip identical files",
+                                      "Hardlink identical files"))
+
+        # What to do with files whose name is taken in the destination
+        self.collisions_combo = new_combo(("Skip files already there",
+                                           "Replace existing files",
+                                           "Add a number to the name",
+                                           "Keep the newer file",
+                                           "Keep the larger file"))
+
+        # Compare copies with their originals
+        self.verify_check = new_checkbox("Verify copied files")
+
+        # Many operations in flight at once on network shares
+        self.remote_check = new_checkbox("Folders on a network share")
+
+        # Recursive mode and filters
+        self.recursive_check = new_checkbox("Include subfolders")
+        self.flatten_check = new_checkbox("Put every file in destination")
+        filters_layout = QtGui.QHBoxLayout()
+        include_label = new_label("Only:", 9)
+        self.include_textbox = new_line_edit(100)
+        self.include_textbox.setToolTip("Patterns of the files to process, "
+                                        "separated by spaces, e.g. *.jpg")
+        exclude_label = new_label("Skip:", 9)
+        self.exclude_textbox = new_line_edit(100)
+        self.exclude_textbox.setToolTip("Patterns of the files and folders "
+                                        "to leave out, separated by spaces")
+
+        # Preview, Move Files and Undo buttons
+        self.preview_button = new_button("Preview", 10, 350)
         self.apply_button = new_button("Move Files", 10, 350)
+        self.undo_button = new_button("Undo Last Job", 10, 350)
+        self.undo_button.setEnabled(False)
+        self.queue_button = new_button("Add to Queue", 10, 350)
+
+        # Presets: the options of the window saved as job specs, which the
+        # command line runs too
+        self.save_preset_button = new_button("Save Preset", 8)
+        self.load_preset_button = new_button("Load Preset", 8)
+        presets_layout = QtGui.QHBoxLayout()
+
+        # Queue panel: jobs waiting or running in the background, several
+        # at once when they're on different disks
+        queue_label = new_label("Queue", 10, True)
+        self.queue_list = QtGui.QListWidget()
+        self.queue_list.setMaximumWidth(350)
+        self.queue_list.setMaximumHeight(120)
+        self.queue_cancel_button = new_button("Cancel Job", 8)
+        self.queue_clear_button = new_button("Clear Finished", 8)
+        queue_buttons_layout = QtGui.QHBoxLayout()
+
+        # Persistent queue of jobs; its ids by row of the panel, and the
+        # jobs known to have ended
+        self.queue = JobQueue(listener=self.queue_listener)
+        self.queue_ids = []
+        self.queue_ended = set(job.id for job in self.queue.snapshot()
+                               if job.status in ENDED)
+
+        # Background worker running the current job, if any, and journal
+        # of the last job
+        self.worker = None
+        self.last_journal = None
+
+        # Background worker computing the plan being previewed, if any
+        self.planner = None
+
+        # Watcher of both folders, so their lists follow external changes
+        self.watcher = QtCore.QFileSystemWatcher(self)
 
         # --------- CONNECTIONS AND SIGNALS ---------
 
@@ -169,9 +273,38 @@ class FileOrganizerWindow(QtGui.QMainWindow):
         self.connect(self.toggle_all_left, Signal("clicked()"),
                      self.toggle_origin_items)
 
-        # Move Files button signal connection
+        # Preview and Move Files buttons signal connections
+        self.connect(self.preview_button, Signal("clicked()"),
+                     self.preview_plan)
         self.connect(self.apply_button, QtCore.SIGNAL("clicked()"),
                      self.move_files)
+        self.connect(self.undo_button, Signal("clicked()"), self.undo_job)
+
+        # Queue connections; the queue reports from the jobs' threads, so
+        # the panel is refreshed through the event loop
+        self.connect(self.queue_button, Signal("clicked()"), self.queue_job)
+
+        # Presets connections
+        self.connect(self.save_preset_button, Signal("clicked()"),
+                     self.save_preset)
+        self.connect(self.load_preset_button, Signal("clicked()"),
+                     self.load_preset)
+        self.connect(self.queue_cancel_button, Signal("clicked()"),
+                     self.cancel_queued_job)
+        self.connect(self.queue_clear_button, Signal("clicked()"),
+                     self.clear_queue)
+        self.connect(self, Signal("queueChanged()"), self.refresh_queue,
+                     QtCore.Qt.QueuedConnection)
+
+        # The command line may queue jobs too; they're picked up as they come
+        self.queue_timer = QtCore.QTimer(self)
+        self.connect(self.queue_timer, Signal("timeout()"),
+                     self.queue.schedule)
+
+        # Folder watcher connection
+        self.connect(self.watcher, Signal("directoryChanged(QString)"),
+                     self.folder_changed)
+        self.watch_folders()
 
         # --------- LAYOUTS ---------
 
@@ -233,6 +366,10 @@ class FileOrganizerWindow(QtGui.QMainWindow):
         add_space(order_layout, 0, 5)
         order_layout.addLayout(date_layout)
 
+        for metadata_layout in metadata_layouts:
+            add_space(order_layout, 0, 5)
+            order_layout.addLayout(metadata_layout)
+
         custom_layout.addWidget(custom_radio)
         custom_layout.addWidget(self.custom_combo)
         custom_layout.addWidget(self.custom_textbox)
@@ -275,11 +412,50 @@ class FileOrganizerWindow(QtGui.QMainWindow):
         add_space(options_vbox, 0, 20)
 
         # Additional Options' addition to layout
-        options_vbox.addWidget(self.duplicate_check)
+        duplicate_layout.addWidget(self.duplicate_check)
+        duplicate_layout.addWidget(self.workers_textbox)
+        duplicate_layout.addWidget(workers_label)
+        duplicate_layout.setAlignment(QtCore.Qt.AlignLeft)
+        options_vbox.addLayout(duplicate_layout)
+        add_space(options_vbox, 0, 5)
+        options_vbox.addWidget(self.dedup_combo)
+        add_space(options_vbox, 0, 5)
+        options_vbox.addWidget(self.collisions_combo)
+        add_space(options_vbox, 0, 5)
+        options_vbox.addWidget(self.verify_check)
         add_space(options_vbox, 0, 5)
-        options_vbox.addWidget(self.replace_files)
+        options_vbox.addWidget(self.remote_check)
+        add_space(options_vbox, 0, 5)
+        options_vbox.addWidget(self.recursive_check)
+        add_space(options_vbox, 0, 5)
+        options_vbox.addWidget(self.flatten_check)
+        filters_layout.addWidget(include_label)
+        filters_layout.addWidget(self.include_textbox)
+        filters_layout.addWidget(exclude_label)
+        filters_layout.addWidget(self.exclude_textbox)
+        filters_layout.setAlignment(QtCore.Qt.AlignLeft)
+        add_space(options_vbox, 0, 5)
+        options_vbox.addLayout(filters_layout)
         add_space(options_vbox, 0, 15)
+        options_vbox.addWidget(self.preview_button)
+        add_space(options_vbox, 0, 5)
         options_vbox.addWidget(self.apply_button)
+        add_space(options_vbox, 0, 5)
+        options_vbox.addWidget(self.undo_button)
+        add_space(options_vbox, 0, 5)
+        options_vbox.addWidget(self.queue_button)
+        add_space(options_vbox, 0, 5)
+        presets_layout.addWidget(self.save_preset_button)
+        presets_layout.addWidget(self.load_preset_button)
+        presets_layout.setAlignment(QtCore.Qt.AlignLeft)
+        options_vbox.addLayout(presets_layout)
+        add_space(options_vbox, 0, 15)
+        options_vbox.addWidget(queue_label)
+        options_vbox.addWidget(self.queue_list)
+        queue_buttons_layout.addWidget(self.queue_cancel_button)
+        queue_buttons_layout.addWidget(self.queue_clear_button)
+        queue_buttons_layout.setAlignment(QtCore.Qt.AlignLeft)
+        options_vbox.addLayout(queue_buttons_layout)
         options_vbox.setAlignment(QtCore.Qt.AlignTop)
 
         # Add each of the elements with a separation of 20 pixels
@@ -297,10 +473,39 @@ class FileOrganizerWindow(QtGui.QMainWindow):
         self.status_label = new_label("", 8, color="333333")
         self.statusBar().addPermanentWidget(self.status_label)
 
+        # Progress bar and Cancel button, only shown while a job runs
+        self.progress_bar = QtGui.QProgressBar()
+        self.progress_bar.setMaximumWidth(250)
+        self.progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.progress_bar)
+
+        self.cancel_button = new_button("Cancel", 8)
+        self.cancel_button.hide()
+        self.statusBar().addPermanentWidget(self.cancel_button)
+
+        self.connect(self.cancel_button, Signal("clicked()"),
+                     self.cancel_job)
+
+        # Saves the metrics of the last job, once there's one
+        self.metrics_button = new_button("Save metrics", 8)
+        self.metrics_button.hide()
+        self.statusBar().addPermanentWidget(self.metrics_button)
+        self.last_metrics = None
+
+        self.connect(self.metrics_button, Signal("clicked()"),
+                     self.save_metrics)
+
         main_container.setLayout(main_layout)
         self.setWindowTitle("File Organizer")
         self.setObjectName("fileorganizerUI")
 
+        # Once the window is shown, look for jobs left unfinished, and run
+        # the jobs queued before the last exit
+        QtCore.QTimer.singleShot(0, self.check_interrupted_jobs)
+        QtCore.QTimer.singleShot(0, self.queue.start)
+        self.queue_timer.start(QUEUE_POLL_INTERVAL)
+        self.refresh_queue()
+
     # --------- CALLBACK FUNCTIONS -----------
 
     def file_dialog1(self):
@@ -313,7 +518,8 @@ class FileOrganizerWindow(QtGui.QMainWindow):
 
         if path:
             self.browse_textbox1.setText(path)
-            self.origin_content.populate_list(retrieve_directory_content(path), True)
+            self.origin_content.load(norm_pathname(path), True)
+            self.watch_folders()
 
     def file_dialog2(self):
         """
@@ -325,66 +531,777 @@ class FileOrganizerWindow(QtGui.QMainWindow):
 
         if path:
             self.browse_textbox2.setText(path)
-            self.destination_content.populate_list(retrieve_directory_content(path), False)
+            self.destination_content.load(norm_pathname(path), False)
+            self.watch_folders()
 
-    def move_files(self):
+    def watch_folders(self):
         """
-        Callback function that invokes FileOrganizer's move_files function
+        Watches the current origin and destination folders, and only them.
         """
+        watched = self.watcher.directories()
+        if watched:
+            self.watcher.removePaths(watched)
+
+        self.watcher.addPaths(list(set(
+            [norm_pathname(self.browse_textbox1.text()),
+             norm_pathname(self.browse_textbox2.text())])))
+
+    def folder_changed(self, path):
+        """
+        Callback of the folder watcher; schedules a refresh of the lists
+        showing the folder.
+        :param path: Pathname of the changed folder
+        """
+        # A running job changes the folders constantly; its end will
+        # refresh them at once
+        if self.worker is not None:
+            return
+
+        path = norm_pathname(path)
+        for textbox, content in ((self.browse_textbox1, self.origin_content),
+                                 (self.browse_textbox2,
+                                  self.destination_content)):
+            if norm_pathname(textbox.text()) == path:
+                content.refresh(path)
+
+    def job_arguments(self):
+        """
+        Gathers the options of the window for FileOrganizer's move_files.
+        :return: Tuple of positional arguments for move_files, or None if
+        no file is checked
+        """
+        # Only consider the checked items; the recursive mode takes the
+        # whole tree
+        if self.recursive_check.isChecked():
+            origin_filenames = None
+        else:
+            origin_filenames = self.origin_content.model.checked_names()
+
+        if origin_filenames is not None and not origin_filenames:
+            self.status_label.setText("No selected files to move!")
+            return None
+
         # Explicit conversion to string to avoid complications in posixpath
-        # Skip the first two spaces displayed in each filename of the
-        # Destination directory. Only consider the checked items
-        origin_filenames = [str(self.origin_content.model.item(i).text()[2:])
-                            for i in range(self.origin_content.model.rowCount())
-                            if self.origin_content.model.item(i).checkState()]
+        return (str(self.browse_textbox1.text()),
+                origin_filenames,
+                str(self.browse_textbox2.text()),
+                self.button_group.checkedId(),
+                (self.custom_combo.currentIndex(),
+                 str(self.custom_textbox.text())),
+                (self.numbering_check.isChecked(),
+                 str(self.numbering_digits.text()),
+                 self.numbering_combo.currentIndex(),
+                 str(self.numbering_rename.text())),
+                (self.remove_check.isChecked(),
+                 str(self.remove_textbox.text())),
+                self.lowercase_check.isChecked(),
+                self.duplicate_check.isChecked(),
+                self.job_collisions() == OVERWRITE)
+
+    def job_tree(self):
+        """
+        :return: Dictionary of the recursive mode, filter and collision
+        keyword arguments of move_files chosen in the window
+        """
+        return {"recursive": self.recursive_check.isChecked(),
+                "flatten": self.flatten_check.isChecked(),
+                "include": str(self.include_textbox.text()).split(),
+                "exclude": str(self.exclude_textbox.text()).split(),
+                "collisions": self.job_collisions()}
 
+    def job_keywords(self):
+        """
+        :return: Dictionary of the keyword arguments of move_files chosen
+        in the window, journal and metrics excepted
+        """
+        keywords = {"workers": self.job_workers(),
+                    "dedup": self.job_dedup(),
+                    "verify": self.verify_check.isChecked(),
+                    "remote": self.remote_check.isChecked()}
+        keywords.update(self.job_tree())
+        return keywords
+
+    def job_collisions(self):
+        """
+        :return: Collision strategy chosen in the window
+        """
+        return COLLISIONS[self.collisions_combo.currentIndex()]
+
+    def job_workers(self):
+        """
+        :return: Number of copying threads chosen in the window
+        """
         try:
-            FileOrganizer.move_files(str(self.browse_textbox1.text()),
-                                     origin_filenames,
-                                     str(self.browse_textbox2.text()),
-                                     self.button_group.checkedId(),
-                                     (self.custom_combo.currentIndex(),
-                                     str(self.custom_textbox.text())),
-                                     (self.numbering_check.isChecked(),
-                                     str(self.numbering_digits.text()),
-                                      self.numbering_combo.currentIndex(),
-                                      str(self.numbering_rename.text())),
-                                     (self.remove_check.isChecked(),
-                                      str(self.remove_textbox.text())),
-                                     self.lowercase_check.isChecked(),
-                                     self.duplicate_check.isChecked(),
-                                     self.replace_files.isChecked())
+            return max(1, int(self.workers_textbox.text()))
+        except ValueError:
+            return DEFAULT_WORKERS
 
-        except FileOrganizer.NoSelectedFiles:
-            self.status_label.setText("No selected files to move!")
+    def job_dedup(self):
+        """
+        :return: Deduplication mode chosen in the window, or None
+        """
+        return DEDUP_MODES[self.dedup_combo.currentIndex()]
+
+    def job_spec(self):
+        """
+        :return: JobSpec of the options chosen in the window, not validated
+        yet. Files aren't part of it: the ones checked when it runs are
+        """
+        try:
+            digits = max(1, int(self.numbering_digits.text()))
+        except ValueError:
+            digits = DEFAULT_DIGITS
+        orders = dict((id_order, name) for name, id_order in ORDERS.items())
+
+        return JobSpec(
+            origin=norm_pathname(self.browse_textbox1.text()),
+            destination=norm_pathname(self.browse_textbox2.text()),
+            recursive=self.recursive_check.isChecked(),
+            flatten=self.flatten_check.isChecked(),
+            include=str(self.include_textbox.text()).split(),
+            exclude=str(self.exclude_textbox.text()).split(),
+            order=orders[self.button_group.checkedId()],
+            order_pattern=str(self.custom_textbox.text()),
+            number_before_pattern=self.custom_combo.currentIndex() == 1,
+            number=digits if self.numbering_check.isChecked() else None,
+            name=str(self.numbering_rename.text()),
+            name_after_number=self.numbering_combo.currentIndex() == 1,
+            remove=str(self.remove_textbox.text())
+            if self.remove_check.isChecked() else "",
+            lowercase=self.lowercase_check.isChecked(),
+            duplicate=self.duplicate_check.isChecked(),
+            collisions=self.job_collisions(), dedup=self.job_dedup(),
+            workers=self.job_workers(),
+            verify=self.verify_check.isChecked(),
+            remote=self.remote_check.isChecked())
+
+    def apply_spec(self, spec):
+        """
+        Sets the options of the window to those of a job spec, and lists
+        its folders.
+        :param spec: Validated JobSpec
+        """
+        origin = norm_pathname(spec.origin)
+        destination = norm_pathname(spec.destination)
+        self.browse_textbox1.setText(origin)
+        self.origin_content.load(origin, True)
+        self.browse_textbox2.setText(destination)
+        self.destination_content.load(destination, False)
+        self.watch_folders()
+
+        self.button_group.button(ORDERS[spec.order]).setChecked(True)
+        self.custom_combo.setCurrentIndex(int(spec.number_before_pattern))
+        self.custom_textbox.setText(spec.order_pattern)
+
+        self.numbering_check.setChecked(spec.number is not None)
+        if spec.number is not None:
+            self.numbering_digits.setText(str(spec.number))
+        self.numbering_combo.setCurrentIndex(int(spec.name_after_number))
+        self.numbering_rename.setText(spec.name)
+        self.remove_check.setChecked(bool(spec.remove))
+        self.remove_textbox.setText(spec.remove)
+        self.lowercase_check.setChecked(spec.lowercase)
+
+        self.duplicate_check.setChecked(spec.duplicate)
+        self.workers_textbox.setText(str(spec.workers))
+        self.dedup_combo.setCurrentIndex(DEDUP_MODES.index(spec.dedup))
+        self.collisions_combo.setCurrentIndex(
+            COLLISIONS.index(spec.collisions))
+        self.verify_check.setChecked(spec.verify)
+        self.remote_check.setChecked(spec.remote)
+        self.recursive_check.setChecked(spec.recursive)
+        self.flatten_check.setChecked(spec.flatten)
+        self.include_textbox.setText(" ".join(spec.include))
+        self.exclude_textbox.setText(" ".join(spec.exclude))
+
+    def save_preset(self):
+        """
+        Saves the options of the window as a job spec, JSON or TOML
+        depending on the extension chosen.
+        """
+        try:
+            spec = self.job_spec()
+            spec.validate()
+            if not os.path.isdir(PRESET_DIR):
+                os.makedirs(PRESET_DIR)
+        except (IOError, OSError, ValueError) as error:
+            self.status_label.setText("Error: {}".format(error))
             return
 
-        # Refill the ListViews with their new file content after
-        # the last operation
-        self.origin_content.populate_list(retrieve_directory_content(
-            self.browse_textbox1.text()), True)
-        self.destination_content.populate_list(retrieve_directory_content(
-            self.browse_textbox2.text()), False)
+        path = QtGui.QFileDialog.getSaveFileName(
+            self, "Save Preset", os.path.join(PRESET_DIR, "preset.json"),
+            "JSON (*.json);;TOML (*.toml)")
+        if isinstance(path, tuple):
+            # PySide returns the selected filter too
+            path = path[0]
+
+        if path:
+            try:
+                spec.save(str(path))
+            except (IOError, OSError) as error:
+                self.status_label.setText("Error: {}".format(error))
+                return
+            self.status_label.setText("Preset saved to {}".format(path))
+
+    def load_preset(self):
+        """
+        Sets the options of the window to those of a saved job spec.
+        """
+        path = QtGui.QFileDialog.getOpenFileName(
+            self, "Load Preset", PRESET_DIR, "Presets (*.json *.toml)")
+        if isinstance(path, tuple):
+            # PySide returns the selected filter too
+            path = path[0]
+        if not path:
+            return
+
+        try:
+            spec = JobSpec.load(str(path))
+        except (IOError, OSError, ValueError) as error:
+            self.status_label.setText("Error: {}".format(error))
+            return
+        self.apply_spec(spec)
+
+        # Options the window has no widget for
+        ignored = [name for name, value in
+                   (("files", spec.files is not None),
+                    ("template", spec.template is not None),
+                    ("substitutions", bool(spec.substitutions)),
+                    ("processes", spec.processes > 1)) if value]
+        message = "Preset {} loaded".format(os.path.basename(str(path)))
+        if ignored:
+            message += " (its {} only apply from the command " \
+                       "line)".format(", ".join(ignored))
+        self.status_label.setText(message)
+
+    def preview_plan(self):
+        """
+        Shows what Move Files would do, without touching any file. The plan
+        is computed in the background, then shown by plan_ready.
+        """
+        if self.planner is not None:
+            return
 
-        # Set the Toggle All Checkbox Off too
+        arguments = self.job_arguments()
+        if arguments is None:
+            return
+
+        dedup = self.job_dedup() if arguments[8] else None
+        self.planner = PlanWorker(arguments, self.job_tree(),
+                                  self.job_workers(), dedup, self)
+        self.connect(self.planner, Signal("finished()"), self.plan_ready)
+
+        self.preview_button.setEnabled(False)
+        self.status_label.setText("Computing the plan...")
+        self.planner.start()
+
+    def plan_ready(self):
+        """
+        Callback of the finished PlanWorker; shows its plan, or its error.
+        """
+        planner, self.planner = self.planner, None
+        planner.deleteLater()
+        self.preview_button.setEnabled(True)
+
+        if planner.error is not None:
+            self.status_label.setText("Error: {}".format(planner.error))
+            return
+
+        self.status_label.setText("{} files planned".format(
+            len(planner.plan)))
+        PlanDialog(planner.plan, self).exec_()
+
+    def move_files(self):
+        """
+        Callback function that invokes FileOrganizer's move_files function
+        in a background thread, so that the window stays responsive.
+        """
+        # Only one job at a time
+        if self.worker is not None:
+            return
+
+        arguments = self.job_arguments()
+        if arguments is None:
+            return
+
+        # Record the job in a journal, so that it can be undone
+        self.last_journal = new_journal_path()
+
+        keywords = self.job_keywords()
+        keywords.update({"journal": self.last_journal,
+                         "metrics": JobMetrics()})
+
+        self.start_job(JobWorker(FileOrganizer.move_files, arguments,
+                                 keywords,
+                                 "Moved files from {} to {}".format(
+                                     arguments[0], arguments[2]),
+                                 self),
+                       "Moving files...")
+
+    def queue_job(self):
+        """
+        Callback function that adds the job set up in the window to the
+        queue, to run in the background with the other queued jobs.
+        """
+        arguments = self.job_arguments()
+        if arguments is None:
+            return
+
+        job = self.queue.submit(arguments, self.job_keywords())
+        self.status_label.setText("Job {} queued: {} to {}".format(
+            job.id, job.origin, job.destination))
+
+    def queue_listener(self, job):
+        """
+        Called by the queue, from any thread, when a job changes.
+        :param job: QueuedJob
+        """
+        self.emit(Signal("queueChanged()"))
+
+    def refresh_queue(self):
+        """
+        Lists the jobs of the queue in its panel. When jobs end, their
+        folders are refreshed and the last of them can be undone.
+        """
+        jobs = self.queue.snapshot()
+        self.queue_list.clear()
+        self.queue_ids = []
+
+        for job in jobs:
+            text = "{} {}: {} -> {}".format(job.id, job.status, job.origin,
+                                             job.destination)
+            if job.status == RUNNING and job.total:
+                text += " ({}/{})".format(job.done, job.total)
+            elif job.error:
+                text += " ({})".format(job.error)
+            self.queue_list.addItem(text)
+            self.queue_ids.append(job.id)
+
+            if job.status in ENDED and job.id not in self.queue_ended:
+                self.queue_ended.add(job.id)
+                self.last_journal = job.journal
+                self.undo_button.setEnabled(self.worker is None)
+                self.origin_content.refresh(
+                    norm_pathname(self.browse_textbox1.text()))
+                self.destination_content.refresh(
+                    norm_pathname(self.browse_textbox2.text()))
+
+    def cancel_queued_job(self):
+        """
+        Cancels the job selected in the queue panel.
+        """
+        row = self.queue_list.currentRow()
+        if 0 <= row < len(self.queue_ids):
+            self.queue.cancel(self.queue_ids[row])
+
+    def clear_queue(self):
+        """
+        Removes the jobs that ended from the queue panel.
+        """
+        self.queue.clear_ended()
+        self.refresh_queue()
+
+    def undo_job(self):
+        """
+        Rolls back the last job run from the window.
+        """
+        if self.worker is not None or self.last_journal is None:
+            return
+
+        journal, self.last_journal = self.last_journal, None
+        self.start_job(JobWorker(FileOrganizer.rollback_job, (journal,), {},
+                                 "Last job undone", self),
+                       "Undoing last job...")
+
+    def check_interrupted_jobs(self):
+        """
+        Offers to resume the jobs that were interrupted, e.g. by a crash, one
+        after the other. Declined ones aren't offered again; the others are,
+        once the resumed job is over. Old journals are deleted meanwhile.
+        """
+        if self.worker is not None:
+            return
+
+        try:
+            prune_journals()
+            interrupted = interrupted_journals()
+        except (IOError, OSError):
+            return
+
+        for pathname in interrupted:
+            try:
+                journal = Journal.load(pathname)
+                journal.close()
+            except (IOError, OSError, ValueError, KeyError, IndexError):
+                # Not even its plan could be written
+                abandon_journal(pathname)
+                continue
+
+            answer = QtGui.QMessageBox.question(
+                self, "Interrupted job",
+                "A job from {} to {} was interrupted after {} of {} files.\n"
+                "Resume it? It won't be offered again otherwise, but it can "
+                "still be undone.".format(
+                    journal.origin, journal.destination,
+                    journal.done.count(1), len(journal)),
+                QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
+
+            if answer == QtGui.QMessageBox.Yes:
+                self.last_journal = pathname
+                self.start_job(JobWorker(FileOrganizer.resume_job,
+                                         (pathname,), {},
+                                         "Interrupted job resumed", self),
+                               "Resuming interrupted job...")
+                return
+            abandon_journal(pathname)
+
+    def start_job(self, worker, message):
+        """
+        Runs a job in the background, disabling the buttons that start
+        jobs until it's over.
+        :param worker: JobWorker of the job
+        :param message: Text of the status bar while the job runs
+        """
+        self.worker = worker
+
+        self.connect(self.worker,
+                     Signal("progress(int, int, double, double)"),
+                     self.job_progress)
+        self.connect(self.worker, Signal("finished()"), self.job_finished)
+
+        self.apply_button.setEnabled(False)
+        self.undo_button.setEnabled(False)
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.show()
+        self.cancel_button.setEnabled(True)
+        self.cancel_button.show()
+        self.status_label.setText(message)
+
+        self.worker.start()
+
+    def job_progress(self, done, total, files_rate, bytes_rate):
+        """
+        Updates the progress bar and status bar while a job runs.
+        :param done: Number of files processed so far
+        :param total: Number of files in the job
+        :param files_rate: Files processed per second
+        :param bytes_rate: Bytes processed per second
+        """
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.status_label.setText("{}/{} files - {:.1f} files/s - {}/s".format(
+            done, total, files_rate, format_size(bytes_rate)))
+
+    def job_finished(self):
+        """
+        Cleans up after the background job and refreshes both folders.
+        """
+        worker, self.worker = self.worker, None
+
+        self.apply_button.setEnabled(True)
+        self.undo_button.setEnabled(self.last_journal is not None)
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+
+        # Apply the changes of the last operation to the ListViews
+        self.origin_content.refresh(norm_pathname(self.browse_textbox1.text()))
+        self.destination_content.refresh(
+            norm_pathname(self.browse_textbox2.text()))
+
+        # Uncheck every file, and set the Toggle All Checkbox Off too
+        self.origin_content.model.set_all_checked(False)
         self.toggle_all_left.setChecked(False)
 
         # Update the status bar
-        self.status_label.setText("Moved files from {} to {}".format(
-            self.browse_textbox1.text(), self.browse_textbox2.text()))
+        if worker.error is not None:
+            self.status_label.setText("Error: {}".format(worker.error))
+        elif worker.is_cancelled():
+            self.status_label.setText("Cancelled after {} of {} files".format(
+                worker.done, worker.total))
+        else:
+            self.status_label.setText(worker.message)
+
+        # Where the time went, for jobs that were measured
+        metrics = worker.keywords.get("metrics")
+        if metrics is not None:
+            self.last_metrics = metrics
+            self.status_label.setText("{} - {}".format(
+                self.status_label.text(), metrics.summary()))
+            self.metrics_button.show()
+
+        # Other interrupted jobs wait for the resumed one to end
+        if worker.function is FileOrganizer.resume_job:
+            QtCore.QTimer.singleShot(0, self.check_interrupted_jobs)
+
+    def save_metrics(self):
+        """
+        Saves the metrics of the last job as JSON or Prometheus text,
+        depending on the extension chosen.
+        """
+        if self.last_metrics is None:
+            return
+
+        path = QtGui.QFileDialog.getSaveFileName(
+            self, "Save Metrics", "metrics.json",
+            "JSON (*.json);;Prometheus text (*.prom)")
+        if isinstance(path, tuple):
+            # PySide returns the selected filter too
+            path = path[0]
+
+        if path:
+            try:
+                self.last_metrics.save(str(path))
+            except (IOError, OSError) as error:
+                self.status_label.setText("Error: {}".format(error))
+
+    def cancel_job(self):
+        """
+        Asks the running job to stop before its next file.
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancel_button.setEnabled(False)
+            self.status_label.setText("Cancelling...")
 
     def toggle_origin_items(self):
         """
         Checks or unchecks all of the origin folder list's items at once.
         """
-        check_state = {
-            True: QtCore.Qt.Checked,
-            False: QtCore.Qt.Unchecked
-        }[self.toggle_all_left.isChecked()]
+        self.origin_content.model.set_all_checked(
+            self.toggle_all_left.isChecked())
+
+
+class JobWorker(QtCore.QThread):
+    """
+    QThread that runs a job of FileOrganizer (move_files, resume_job or
+    rollback_job) away from the GUI thread, reporting its progress through
+    the progress(int, int, double, double) signal: files done, total files,
+    files per second and bytes per second.
+    """
+
+    # Minimum seconds between two progress signals
+    PROGRESS_INTERVAL = 0.1
+
+    def __init__(self, function, arguments, keywords, message, parent=None):
+        """
+        Initializes the worker.
+        :param function: FileOrganizer function running the job; it has to
+        take progress and cancelled keyword arguments
+        :param arguments: Tuple of positional arguments for the function
+        :param keywords: Dictionary of other keyword arguments for it
+        :param message: Text of the status bar once the job is done
+        :param parent: Parent QObject
+        """
+        super(JobWorker, self).__init__(parent)
+
+        self.function = function
+        self.arguments = arguments
+        self.keywords = keywords
+        self.message = message
+        self.total = 0
+        self.done = 0
+        self.error = None
+
+        self._cancelled = False
+        self._bytes = 0
+        self._started = 0.0
+        self._last_report = 0.0
+
+    def run(self):
+        """
+        Runs the job; any error is kept for the window to display.
+        """
+        self._started = time()
+        try:
+            self.function(*self.arguments, progress=self.report_progress,
+                          cancelled=self.is_cancelled, **self.keywords)
+        except FileOrganizer.NoSelectedFiles:
+            self.error = "No selected files to move!"
+        except FileOrganizer.FilesNotProcessed as error:
+            self.error = "{} files could not be processed, see {}".format(
+                len(error.errors), LOG_FILENAME)
+        except (IOError, OSError, ValueError) as error:
+            # Corrupt journals and bad templates or presets included
+            self.error = str(error)
+        except Exception as error:
+            # The job must never be shown as done when it crashed
+            log_error("Job crashed: %r", error)
+            self.error = repr(error)
+
+    def report_progress(self, done, total, size):
+        """
+        Progress callback for move_files; throttles the emitted signals
+        so the GUI event loop isn't flooded on large batches.
+        """
+        self.done = done
+        self.total = total
+        self._bytes += size
+
+        now = time()
+        if done < total and now - self._last_report < self.PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+
+        elapsed = max(now - self._started, 1e-6)
+        self.emit(Signal("progress(int, int, double, double)"),
+                  done, total, done / elapsed, self._bytes / elapsed)
+
+    def cancel(self):
+        """
+        Requests the job to stop before its next file.
+        """
+        self._cancelled = True
+
+    def is_cancelled(self):
+        """
+        :return: Boolean telling whether the job was asked to stop
+        """
+        return self._cancelled
+
+
+class PlanWorker(QtCore.QThread):
+    """
+    QThread that computes the plan of a job for its preview, deduplicated
+    if asked to, away from the GUI thread: planning a large tree, or hashing
+    its files, would freeze the window. The plan, or the error, is read once
+    finished() is emitted.
+    """
+
+    def __init__(self, arguments, tree, workers, dedup, parent=None):
+        """
+        :param arguments: Tuple of positional arguments for plan_moves
+        :param tree: Dictionary of the keyword arguments of the recursive
+        mode for plan_moves
+        :param workers: Number of threads scanning and hashing the files
+        :param dedup: Deduplication mode, or None
+        :param parent: Parent QObject
+        """
+        super(PlanWorker, self).__init__(parent)
+
+        self.arguments = arguments
+        self.tree = tree
+        self.workers = workers
+        self.dedup = dedup
+        self.plan = ()
+        self.error = None
+
+    def run(self):
+        try:
+            plan = plan_moves(*self.arguments, workers=self.workers,
+                              **self.tree)
+            if self.dedup:
+                index = DedupIndex()
+                try:
+                    plan = deduplicate(plan, self.arguments[0],
+                                       self.arguments[2], index, self.dedup,
+                                       self.workers)[0]
+                finally:
+                    index.close()
+            self.plan = plan
+        except (IOError, OSError, ValueError) as error:
+            self.error = str(error)
+        except Exception as error:
+            log_error("Preview crashed: %r", error)
+            self.error = repr(error)
+
+
+class DirectoryLister(QtCore.QThread):
+    """
+    QThread that lists a directory away from the GUI thread, so that large
+    or slow folders (network shares, sleeping disks) don't freeze the
+    window. The names, or the error, are read once finished() is emitted.
+    """
+
+    def __init__(self, directory, checkable, parent=None):
+        """
+        :param directory: Normalized pathname of the directory
+        :param checkable: Boolean for the listed rows to have a checkbox
+        :param parent: Parent QObject
+        """
+        super(DirectoryLister, self).__init__(parent)
+
+        self.directory = directory
+        self.checkable = checkable
+        self.names = []
+        self.error = None
+
+    def run(self):
+        try:
+            self.names = retrieve_directory_content(self.directory)
+        except OSError as error:
+            self.error = str(error)
+
+
+class PlanTableModel(QtCore.QAbstractTableModel):
+    """
+    Read-only table model over a plan; rows are read straight from the
+    plan's tuple, so even huge plans display at once.
+    """
+
+    HEADERS = ("File", "New name", "Action", "Conflict")
+
+    def __init__(self, plan, parent=None):
+        """
+        :param plan: Tuple of PlanEntry
+        :param parent: Parent QObject
+        """
+        super(PlanTableModel, self).__init__(parent)
+        self.plan = plan
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.plan)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None
+        value = self.plan[index.row()][index.column()]
+        return "" if value is None else value
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and \
+                orientation == QtCore.Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+
+class PlanDialog(QtGui.QDialog):
+    """
+    Dialog previewing the plan of a job in a table.
+    """
+
+    def __init__(self, plan, parent=None):
+        """
+        :param plan: Tuple of PlanEntry
+        :param parent: Parent QWidget
+        """
+        super(PlanDialog, self).__init__(parent)
+
+        skipped = sum(1 for entry in plan if entry.action == SKIP)
+        conflicts = sum(1 for entry in plan if entry.conflict is not None)
+        summary = new_label("{} files: {} to process, {} skipped, "
+                            "{} conflicts".format(len(plan),
+                                                  len(plan) - skipped,
+                                                  skipped, conflicts), 9)
+
+        table = QtGui.QTableView()
+        table.setModel(PlanTableModel(plan, table))
+        table.horizontalHeader().setStretchLastSection(True)
+        table.verticalHeader().setDefaultSectionSize(24)
+
+        close_button = new_button("Close", 8)
+        self.connect(close_button, Signal("clicked()"), self.accept)
+
+        layout = QtGui.QVBoxLayout()
+        layout.addWidget(summary)
+        layout.addWidget(table)
+        layout.addWidget(close_button)
+        self.setLayout(layout)
 
-        # Travel through each item and check or uncheck it
-        [self.origin_content.model.item(i).setCheckState(check_state)
-         for i in range(self.origin_content.model.rowCount())]
+        self.resize(700, 500)
+        self.setWindowTitle("Preview")
 
 
 class BrowserTextbox(QtGui.QLineEdit):
@@ -422,12 +1339,195 @@ class BrowserTextbox(QtGui.QLineEdit):
             self.setText(path)
 
             # Also fill the corresponding ListView with the directory content
+            window = self.parent().parent()
             if self.left_side:
-                self.parent().parent().origin_content.populate_list(
-                    norm_pathname(path), True)
+                window.origin_content.load(norm_pathname(path), True)
             else:
-                self.parent().parent().destination_content.populate_list(
-                    norm_pathname(path), False)
+                window.destination_content.load(norm_pathname(path), False)
+            window.watch_folders()
+
+
+class DirectoryContentModel(QtCore.QAbstractListModel):
+    """
+    List model of the filenames of a directory. Names are kept in a plain
+    list and check states in a bytearray (one byte per row), so no Qt item
+    is ever created; rows are handed to the view in batches as it scrolls.
+    """
+
+    # Rows handed to the view on each fetchMore
+    BATCH_SIZE = 1000
+
+    def __init__(self, parent=None):
+        """
+        Initializes an empty model.
+        :param parent: Parent QObject
+        """
+        super(DirectoryContentModel, self).__init__(parent)
+
+        self.names = []
+        self.checked = bytearray()
+        self.checkable = False
+        self.loaded = 0
+
+        # Text of the single row shown instead of the names, e.g. while
+        # they're listed; None once they're there
+        self.placeholder = None
+
+    def set_placeholder(self, text):
+        """
+        Empties the model, showing a single inert row with a text.
+        :param text: Text of the row
+        :return: None
+        """
+        self.beginResetModel()
+        self.names = []
+        self.checked = bytearray()
+        self.loaded = 0
+        self.placeholder = text
+        self.endResetModel()
+
+    def set_names(self, names, checkable):
+        """
+        Replaces the content of the model.
+        :param names: List of filenames
+        :param checkable: Boolean for the rows to have a checkbox beside
+        :return: None
+        """
+        self.beginResetModel()
+        self.names = list(names)
+        self.checked = bytearray(len(self.names))
+        self.checkable = checkable
+        self.loaded = min(len(self.names), self.BATCH_SIZE)
+        self.placeholder = None
+        self.endResetModel()
+
+    def set_all_checked(self, checked):
+        """
+        Checks or unchecks every row at once.
+        :param checked: Boolean for the new check state
+        :return: None
+        """
+        self.checked = bytearray(b"\x01" if checked else b"\x00") * \
+                       len(self.names)
+        if self.loaded:
+            self.emit(Signal("dataChanged(QModelIndex,QModelIndex)"),
+                      self.index(0), self.index(self.loaded - 1))
+
+    def checked_names(self):
+        """
+        :return: List of the filenames whose row is checked
+        """
+        return list(compress(self.names, self.checked))
+
+    def apply_changes(self, added, removed):
+        """
+        Inserts and removes rows, keeping the names sorted and the check
+        state of the untouched rows. Only the changed rows are signaled to
+        the view, unless there are so many that a reset is cheaper.
+        :param added: Collection of new filenames
+        :param removed: Collection of filenames no longer present
+        :return: None
+        """
+        if len(added) + len(removed) > self.BATCH_SIZE:
+            checked = set(self.checked_names())
+            names = sorted(set(self.names).difference(removed).union(added))
+            self.set_names(names, self.checkable)
+            self.checked = bytearray(name in checked for name in names)
+            return
+
+        root = QtCore.QModelIndex()
+
+        for name in removed:
+            row = bisect_left(self.names, name)
+            if row == len(self.names) or self.names[row] != name:
+                continue
+
+            visible = row < self.loaded
+            if visible:
+                self.beginRemoveRows(root, row, row)
+            del self.names[row]
+            del self.checked[row]
+            if visible:
+                self.loaded -= 1
+                self.endRemoveRows()
+
+        for name in sorted(added):
+            row = bisect_left(self.names, name)
+            if row < len(self.names) and self.names[row] == name:
+                continue
+
+            # Rows past the loaded ones will come with the next fetchMore
+            visible = row < self.loaded or self.loaded == len(self.names)
+            if visible:
+                self.beginInsertRows(root, row, row)
+            self.names.insert(row, name)
+            self.checked.insert(row, 0)
+            if visible:
+                self.loaded += 1
+                self.endInsertRows()
+
+    # --------- QAbstractListModel INTERFACE -----------
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return 1 if self.placeholder is not None else self.loaded
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.loaded < len(self.names)
+
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        count = min(self.BATCH_SIZE, len(self.names) - self.loaded)
+        if count <= 0:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), self.loaded,
+                             self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if self.placeholder is not None:
+            if role == QtCore.Qt.DisplayRole:
+                return "  " + self.placeholder
+            if role == QtCore.Qt.SizeHintRole:
+                return QtCore.QSize(0, 40)
+            return None
+        if index.row() >= self.loaded:
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            return "  " + self.names[index.row()]
+        if role == QtCore.Qt.CheckStateRole and self.checkable:
+            return QtCore.Qt.Checked if self.checked[index.row()] \
+                else QtCore.Qt.Unchecked
+        if role == QtCore.Qt.SizeHintRole:
+            return QtCore.QSize(0, 40)
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if role != QtCore.Qt.CheckStateRole or not index.isValid() or \
+                self.placeholder is not None:
+            return False
+
+        # PyQt4's first API version wraps values in QVariants
+        if hasattr(value, "toInt"):
+            value = value.toInt()[0]
+
+        self.checked[index.row()] = value == QtCore.Qt.Checked
+        self.emit(Signal("dataChanged(QModelIndex,QModelIndex)"),
+                  index, index)
+        return True
+
+    def flags(self, index):
+        if self.placeholder is not None:
+            return QtCore.Qt.NoItemFlags
+        flags = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        if self.checkable:
+            flags |= QtCore.Qt.ItemIsUserCheckable
+        return flags
 
 
 class DirectoryContentList(QtGui.QListView):
@@ -437,15 +1537,72 @@ class DirectoryContentList(QtGui.QListView):
 
     def __init__(self):
         """
-        Initializaes the ListView; sets an StandardItemModel.
+        Initializaes the ListView; sets a DirectoryContentModel.
         """
         super(DirectoryContentList, self).__init__()
 
         self.setMinimumHeight(450)
         self.setStyleSheet("background-color:#AAAAAA;")
-        self.model = QtGui.QStandardItemModel(self)
+
+        # Every row has the same height, so the view doesn't need to ask
+        # the model for the size of rows out of sight
+        self.setUniformItemSizes(True)
+
+        self.model = DirectoryContentModel(self)
         self.setModel(self.model)
 
+        # DirectoryLister of the directory being listed, if any
+        self.lister = None
+
+        # Refreshes asked in a burst of changes are coalesced: the directory
+        # is read once the changes stop for a moment
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(REFRESH_DELAY)
+        self.connect(self.refresh_timer, Signal("timeout()"),
+                     self.apply_refresh)
+        # Directory to refresh, and time of the first refresh asked since
+        # the last one done
+        self.refresh_directory = None
+        self.refresh_asked = None
+        # DirectoryLister of the refresh going on, if any
+        self.refresher = None
+
+    def load(self, directory, checkable):
+        """
+        Lists a directory in the background, showing a placeholder until
+        its files are there. A listing started meanwhile supersedes it.
+        :param directory: Normalized pathname of the directory
+        :param checkable: Boolean for the items to have a checkbox beside
+        :return: None
+        """
+        self.model.set_placeholder("Loading...")
+        self.model.checkable = checkable
+        self.cancel_refresh()
+
+        lister = DirectoryLister(directory, checkable, self)
+        self.lister = lister
+        self.connect(lister, Signal("finished()"),
+                     lambda: self.listed(lister))
+        lister.start()
+
+    def listed(self, lister):
+        """
+        Callback of a finished DirectoryLister; shows its files, unless
+        another directory was chosen since.
+        :param lister: DirectoryLister
+        :return: None
+        """
+        lister.deleteLater()
+        if lister is not self.lister:
+            return
+        self.lister = None
+
+        if lister.error is not None:
+            self.model.set_placeholder(lister.error)
+        else:
+            self.populate_list(lister.names, lister.checkable)
+
     def populate_list(self, files, checkable):
         """
         Fills the ListView with the passed list of files.
@@ -453,23 +1610,79 @@ class DirectoryContentList(QtGui.QListView):
         :param checkable: Boolean for the item to have a checkbox beside
         :return: None
         """
-        # Clear the ListView's model first
-        self.model.clear()
+        self.model.set_names(files, checkable)
+
+    def refresh(self, directory):
+        """
+        Schedules an update of the ListView with the changes in its
+        directory, once no other refresh is asked for REFRESH_DELAY
+        milliseconds, or at most REFRESH_MAX_DELAY after the first one.
+        :param directory: Normalized pathname of the displayed directory
+        :return: None
+        """
+        now = time()
+        if self.refresh_asked is None:
+            self.refresh_asked = now
+        self.refresh_directory = directory
+
+        # Each change postpones the refresh, unless it waited long enough
+        if not self.refresh_timer.isActive() or \
+                now - self.refresh_asked < REFRESH_MAX_DELAY / 1000.0:
+            self.refresh_timer.start()
+
+    def cancel_refresh(self):
+        """
+        Drops the scheduled refresh, and the result of the one going on, if
+        any.
+        :return: None
+        """
+        self.refresh_timer.stop()
+        self.refresh_directory = None
+        self.refresh_asked = None
+        self.refresher = None
+
+    def apply_refresh(self):
+        """
+        Lists the directory again in the background; see refreshed.
+        :return: None
+        """
+        directory = self.refresh_directory
+        self.cancel_refresh()
+        if directory is None:
+            return
+
+        # Still listing, or the listing failed: list it again as a whole
+        if self.model.placeholder is not None:
+            self.load(directory, self.model.checkable)
+            return
 
-        # Create a new QStandardItem for each filename
-        for filename in files:
-            self.model.appendRow(self.new_item(filename, checkable))
+        refresher = DirectoryLister(directory, self.model.checkable, self)
+        self.refresher = refresher
+        self.connect(refresher, Signal("finished()"),
+                     lambda: self.refreshed(refresher))
+        refresher.start()
 
-    def new_item(self, name, checkable):
+    def refreshed(self, refresher):
         """
-        Create a new QStandardItem for the model.
-        :param files: Text to display
-        :param checkable: Boolean for the item to be checkable
+        Callback of a finished refresh; updates the ListView touching only
+        the rows of the files that appeared or disappeared, unless another
+        refresh or listing started since. A folder that can't be listed any
+        more (e.g. deleted) empties the view, showing why.
+        :param refresher: DirectoryLister
+        :return: None
         """
-        item = QtGui.QStandardItem("  " + name)
-        item.setCheckable(checkable)
-        item.setSizeHint(QtCore.QSize(0, 40))
-        return item
+        refresher.deleteLater()
+        if refresher is not self.refresher:
+            return
+        self.refresher = None
+
+        if refresher.error is not None:
+            self.model.set_placeholder(refresher.error)
+            return
+
+        current = set(self.model.names)
+        content = set(refresher.names)
+        self.model.apply_changes(content - current, current - content)
 
 # ------ UTILITY WIDGET FUNCTIONS ---------
 
@@ -498,6 +1711,18 @@ def add_line(length):
     line.setFrameShape(QtGui.QFrame.VLine)
     return line
 
+def format_size(size):
+    """
+    Return a human readable size
+    :param size: Size in bytes
+    :return: String such as "12.3 MB"
+    """
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f} TB".format(size)
+
 def new_button(text, font_size=None, length=None):
     """
     Returns a new button